@@ -1,21 +1,26 @@
-from region_estimators.region_estimator import RegionEstimator
+from region_estimators.region_estimator import RegionEstimator, _get_index_columns
+from region_estimators.estimation_data import _csr_gather
+import numpy as np
 import pandas as pd
 
 
 class ConcentricRegionsEstimator(RegionEstimator):
     MAX_RING_COUNT_DEFAULT = float("inf")
+    EXTRA_DATA_COLUMNS = {'rings': 'Int64'}
 
     def __init__(self, estimation_data=None,  verbose=RegionEstimator.VERBOSE_DEFAULT,
                  max_processors=RegionEstimator.MAX_NUM_PROCESSORS,
-                 progress_callback=None):
-        super(ConcentricRegionsEstimator, self).__init__(estimation_data, verbose, max_processors, progress_callback)
+                 progress_callback=None, backend=None):
+        super(ConcentricRegionsEstimator, self).__init__(estimation_data, verbose, max_processors, progress_callback, backend)
         self.__set_region_neighbours()
         self._max_ring_count = ConcentricRegionsEstimator.MAX_RING_COUNT_DEFAULT
+        self._ring_table = None
+        self._ring_table_neighbours = None
 
     class Factory:
         def create(self, estimation_data, verbose=RegionEstimator.VERBOSE_DEFAULT,
-                 max_processors=RegionEstimator.MAX_NUM_PROCESSORS, progress_callback=None):
-            return ConcentricRegionsEstimator(estimation_data, verbose, max_processors, progress_callback)
+                 max_processors=RegionEstimator.MAX_NUM_PROCESSORS, progress_callback=None, backend=None):
+            return ConcentricRegionsEstimator(estimation_data, verbose, max_processors, progress_callback, backend)
 
     @property
     def max_ring_count(self):
@@ -30,6 +35,32 @@ class ConcentricRegionsEstimator(RegionEstimator):
         """
 
         self._max_ring_count = new_count
+        self._ring_table = None
+        self._invalidate_workers()
+
+    @property
+    def ring_table(self):
+        """  The concentric rings of every region: the hop distance (number of rings) from each region to every other
+             region reachable within max_ring_count rings, found by a breadth first search of the region neighbours.
+             Ring membership only depends on the regions topology, so the table is computed once (on first use)
+             and re-used for all measurements and timestamps. With no limit on max_ring_count, the table of connected
+             regions has (number of regions)^2 entries (8 bytes each), so set max_ring_count for large sets of regions.
+
+            :return: tuple of numpy int arrays (indptr, ring_regions, ring_hops). The rings of the region at position
+                     i are ring_regions[indptr[i]:indptr[i + 1]] (region positions), ordered by
+                     ring_hops[indptr[i]:indptr[i + 1]] (ring number, starting with 0 for the region itself)
+        """
+        neighbours = self.estimation_data.region_neighbours
+        if self._ring_table is None or self._ring_table_neighbours is not neighbours:
+            self._ring_table = self.__get_ring_table(neighbours)
+            self._ring_table_neighbours = neighbours
+        return self._ring_table
+
+    def _prepare_workers(self):
+        """  Calculate the ring table (and the region neighbours it is found from) before the estimator is given to
+             worker processes (see RegionEstimator), so that it is not calculated again by every worker.
+        """
+        self.ring_table
 
     def get_estimate(self, measurement, timestamp, region_id, ignore_site_ids=[]):
         """  Find estimations for a region and timestamp using the concentric_regions rings method
@@ -45,108 +76,249 @@ class ConcentricRegionsEstimator(RegionEstimator):
             print('\n### Getting estimates for region {}, measurement {} at date {} ###\n'.format(
                 region_id, measurement, timestamp))
 
+        # Get the site readings for this measurement/timestamp, aggregated by site group
+        sums, counts = self.estimation_data.get_group_aggregates(measurement, [timestamp], ignore_site_ids)
+
+        values, rings = self.__get_ring_estimates(self.regions.index.get_loc(region_id), sums, counts)
+
+        if self.verbose > 0:
+            print('Result for region {}: {} (rings: {})'.format(region_id, values[0], rings[0]))
+
+        return None if np.isnan(values[0]) else values[0], {"rings": None if rings[0] < 0 else int(rings[0])}
+
+    def _get_vectorized_estimations(self, measurements, region_ids, timestamps, ignore_site_ids=[]):
+        """  Find estimations for all of the measurements, regions and timestamps at once using the concentric_regions
+             rings method. The measurements' aggregate cubes (timestamps x site groups sums and counts, see
+             EstimationData.get_group_aggregates) are stacked, so that the ring of each site group and the nearest ring
+             with readings are resolved for each region once, for all measurements and timestamps together.
+
+            :param measurements: measurements to be estimated (list of str)
+            :param region_ids: region identifiers (list of str)
+            :param timestamps: timestamp identifiers (sorted list of str)
+            :param ignore_site_ids: site id(s) to be ignored during the estimations
+
+            :return: dict of result columns (one item per measurement, region and timestamp, in measurement, region
+                        then timestamp order): 'measurement', 'region_id', 'timestamp', (estimated) 'value' and 'rings'
+        """
+        if self.verbose > 0:
+            print('\n### Getting vectorized estimates for {} regions, measurements {} at {} timestamps ###\n'.format(
+                len(region_ids), measurements, len(timestamps)))
+
+        aggregates = [self.estimation_data.get_group_aggregates(measurement, timestamps, ignore_site_ids)
+                      for measurement in measurements]
+        sums = np.concatenate([measurement_sums for measurement_sums, _ in aggregates])
+        counts = np.concatenate([measurement_counts for _, measurement_counts in aggregates])
+
+        shape = (len(measurements), len(region_ids), len(timestamps))
+        values = np.empty(shape)
+        rings = np.empty(shape, dtype=np.int64)
+        for index, position in enumerate(self.estimation_data.get_region_positions(region_ids)):
+            region_values, region_rings = self.__get_ring_estimates(position, sums, counts)
+            values[:, index, :] = region_values.reshape(len(measurements), len(timestamps))
+            rings[:, index, :] = region_rings.reshape(len(measurements), len(timestamps))
+
+        result_columns = _get_index_columns(measurements, region_ids, timestamps)
+        result_columns['value'] = values.ravel()
+        result_columns['rings'] = pd.arrays.IntegerArray(rings.ravel(), rings.ravel() < 0)
+        return result_columns
+
+    def _get_held_out_estimates(self, measurement, timestamps, site_position, region_positions, rows):
+        """  Find the estimations of the regions containing a held out site (see RegionEstimator), by subtracting the
+             site's readings from the aggregates of its site group, instead of re-aggregating without the site.
+        """
+        sums, counts = self.estimation_data.get_group_aggregates(measurement, timestamps)
+        site_sums, site_counts = self.estimation_data.get_site_aggregates(measurement, timestamps)
+        _, _, site_groups = self.estimation_data.site_groups
+
+        held_out_sums = sums[rows]
+        held_out_counts = counts[rows]
+        held_out_sums[:, site_groups[site_position]] -= site_sums[rows, site_position]
+        held_out_counts[:, site_groups[site_position]] -= site_counts[rows, site_position]
+
+        return np.array([self.__get_ring_estimates(position, held_out_sums, held_out_counts)[0]
+                         for position in region_positions])
+
+    def _get_affected_regions(self, measurement, timestamp, site_positions, ignore_site_ids=[]):
+        """  Find the regions whose estimate at a timestamp can change when the readings of some sites change (see
+             RegionEstimator.update_estimations): the regions that have a ring containing one of the sites no further
+             out than their nearest ring with readings from the other sites. If the other sites have no readings at the
+             timestamp, every region is affected (regions that cannot reach any site with readings are estimated
+             differently when there are no readings at all).
+        """
+        region_count = len(self.regions.index)
+        site_regions_indptr, site_regions = self.estimation_data.site_regions
+        changed_regions = np.unique(_csr_gather(site_regions_indptr, site_regions, site_positions))
+
+        # Ring number of the nearest ring of each region containing one of the sites
+        ring_indptr, ring_regions, ring_hops = self.ring_table
+        changed = np.isin(ring_regions, changed_regions)
+        changed_hops = np.full(region_count, np.inf)
+        np.minimum.at(changed_hops, np.repeat(np.arange(region_count), np.diff(ring_indptr))[changed],
+                      ring_hops[changed])
+
+        # Ring number of the nearest ring with readings, without the sites' readings (aggregated by site group from
+        # the readings of the timestamp only, rather than from the cube of all timestamps without the ignored sites)
+        reading_positions, reading_sums, reading_counts = self.estimation_data.get_timestamp_site_readings(
+            measurement, timestamp, ignore_site_ids)
+        others = ~np.isin(reading_positions, site_positions)
+        if reading_counts[others].sum() == 0:
+            return np.ones(region_count, dtype=bool)
+        _, _, site_groups = self.estimation_data.site_groups
+        group_count = site_groups.max() + 1
+        reading_groups = site_groups[reading_positions[others]]
+        sums = np.bincount(reading_groups, weights=reading_sums[others], minlength=group_count)[np.newaxis, :]
+        counts = np.bincount(reading_groups, weights=reading_counts[others], minlength=group_count) \
+            .astype(np.int64)[np.newaxis, :]
+
+        affected = np.zeros(region_count, dtype=bool)
+        for position in np.flatnonzero(np.isfinite(changed_hops)):
+            values, rings = self.__get_ring_estimates(position, sums, counts)
+            affected[position] = np.isnan(values[0]) or changed_hops[position] <= rings[0]
+        return affected
+
+    def _get_extra_data_json(self, extra_data):
+        """  Convert the rings column to the (json string) extra_data of each estimate, as returned by get_estimate
+
+            :param extra_data: pandas dataframe with column 'rings'
+
+            :return: list of json strings, one per estimate
+        """
+        return ['{"rings": null}' if pd.isna(ring) else '{"rings": %d}' % ring for ring in extra_data['rings']]
+
+    def __get_ring_estimates(self, position, sums, counts):
+        '''
+        Find the concentric_regions estimates of a region for each timestamp of a set of aggregates: the mean of the
+        site readings in the nearest ring (using the ring table) that has readings.
+
+        :param position: (int) position of the region in self.regions
+        :param sums: (numpy array) sums of site readings, of shape (timestamps, site groups)
+        :param counts: (numpy array) counts of site readings, of shape (timestamps, site groups)
+
+        :return: tuple of numpy arrays (values, rings) with one item per timestamp. values are nan and
+                 rings are -1 where there is no estimate (or no ring number)
+        '''
+        values = np.full(len(sums), np.nan)
+        rings = np.full(len(sums), -1, dtype=np.int64)
+
         # Check sites exist (in any region) for this measurement/timestamp
-        if self.estimation_data.site_datapoint_count(measurement, timestamp, ignore_site_ids=ignore_site_ids) == 0:
+        unresolved = counts.sum(axis=1) > 0
+        if not unresolved.any():
             if self.verbose > 0:
-                print('No sites exist for region {}, measurement {} at date {}'.format(
-                    region_id, measurement, timestamp))
-            return None, {"rings": None}
-
-        if self.verbose > 1:
-            print('sites exist for region {}, measurement {} at date {}'.format(region_id, measurement, timestamp))
+                print('No sites exist for region {}'.format(self.regions.index[position]))
+            return values, rings
 
         # Check region is not an island (has no touching adjacent regions) which has no sites within it
         # If it is, return null
-        region_sites = set(self.regions.loc[region_id]['sites']) - set(ignore_site_ids)
-        if len(region_sites) == 0 and len(self.estimation_data.get_adjacent_regions([region_id])) == 0:
+        neighbours_indptr, _ = self.estimation_data.region_neighbours
+        sites_indptr, _ = self.estimation_data.region_sites
+        if sites_indptr[position + 1] == sites_indptr[position] and \
+                neighbours_indptr[position + 1] == neighbours_indptr[position]:
             if self.verbose > 0:
-                print('Region {} is an island and does not have sites, so can\'t do concentric_regions'.format(region_id))
-            return None, {"rings": None}
+                print('Region {} is an island and does not have sites, so can\'t do concentric_regions'.format(
+                    self.regions.index[position]))
+            return values, rings
 
-        if self.verbose > 1:
-            print('Region {} is not an island'.format(region_id))
+        # Ring number of each site group: the nearest ring of any of the group's regions
+        ring_indptr, ring_regions, ring_hops = self.ring_table
+        group_indptr, group_regions, _ = self.estimation_data.site_groups
+        ring_slice = slice(ring_indptr[position], ring_indptr[position + 1])
+        region_hops = np.full(len(self.regions.index), np.inf)
+        region_hops[ring_regions[ring_slice]] = ring_hops[ring_slice]
+        group_hops = self.__get_group_hops(group_indptr, region_hops[group_regions])
+        max_ring = ring_hops[ring_slice].max()
 
-        # Create an empty list for storing completed regions
-        regions_completed = []
+        for ring in range(max_ring + 1):
+            rows = np.flatnonzero(unresolved)
+            if len(rows) == 0:
+                break
+            columns = np.flatnonzero(group_hops == ring)
+            ring_counts = counts[np.ix_(rows, columns)].sum(axis=1)
+            found = ring_counts > 0
+            rows = rows[found]
+            # If readings found for the sites, take the average
+            values[rows] = sums[np.ix_(rows, columns)].sum(axis=1) / ring_counts[found]
+            rings[rows] = ring
+            unresolved[rows] = False
 
-        # Recursively find the sites in each concentric_regions ring (starting at 0)
-        if self.verbose > 0:
-            print('Beginning recursive region estimation for region {}, timestamp: {}'.format(region_id, timestamp))
+        # No readings found in any ring (up to max_ring_count, or the last ring of regions)
+        rings[unresolved] = max_ring
+        return values, rings
+
+    @staticmethod
+    def __get_group_hops(group_indptr, group_region_hops):
+        '''
+        Find the ring number of each site group: the minimum ring number of the group's regions
+
+        :param group_indptr: (numpy int array) CSR row pointers of the site groups' regions
+        :param group_region_hops: (numpy float array) the ring number of each of the site groups' regions
+            (inf if not within any ring)
 
-        return self.__get_concentric_regions_estimate_recursive(measurement, [region_id], timestamp, 0, regions_completed,
-                                                       ignore_site_ids)
+        :return: numpy float array of the ring number of each group (inf if not within any ring)
+        '''
+        group_hops = np.full(len(group_indptr) - 1, np.inf)
+        non_empty = np.diff(group_indptr) > 0
+        if non_empty.any():
+            group_hops[non_empty] = np.minimum.reduceat(group_region_hops, group_indptr[:-1][non_empty])
+        return group_hops
 
-    def __get_concentric_regions_estimate_recursive(self, measurement, region_ids, timestamp, diffuse_level, regions_completed,
-                                           ignore_site_ids=[]):
-        # Find all sites in regions
-        sites = self.estimation_data.get_regions_sites(region_ids, ignore_site_ids)
+    def __get_ring_table(self, neighbours):
+        '''
+        Calculate the ring table (see ring_table) by a breadth first search from every region over the
+        region neighbours CSR arrays, stopping at max_ring_count rings.
 
-        # Get values from sites
+        :param neighbours: tuple of numpy int arrays (indptr, indices): CSR adjacency of region positions
+
+        :return: tuple of numpy int arrays (indptr, ring_regions, ring_hops)
+        '''
         if self.verbose > 0:
-            print('obtaining values from sites')
-        actuals = self.actuals.loc[(self.actuals['timestamp'] == timestamp) & (self.actuals['site_id'].isin(sites))]
+            print('\ncalculating ring table (max rings: {})'.format(self.max_ring_count))
 
-        result = None
-        if len(actuals.index) > 0:
-            # If readings found for the sites, take the average
-            result = actuals[measurement].mean(axis=0)
-            if self.verbose > 0:
-                print('Found result (for regions: {}) from sites:\n {}, average: {}'.format(region_ids, actuals, result))
+        neighbours_indptr, neighbours_indices = neighbours
+        region_count = len(neighbours_indptr) - 1
 
-        if result is None or pd.isna(result):
-            if self.verbose > 0:
-                print('No sites found. Current ring count: {}. Max concentric_regions level: {}'.format(
-                    diffuse_level, self._max_ring_count))
-            # If no readings/sites found, go up a concentric_regions level (adding completed regions to ignore list)
-            if diffuse_level >= self.max_ring_count:
-                if self.verbose > 0:
-                    print('Max concentric_regions level reached so returning null.')
-                return None, {"rings": diffuse_level}
-
-            regions_completed.extend(region_ids)
-            diffuse_level += 1
-
-            # Find the next set of regions
-            next_regions = self.estimation_data.get_adjacent_regions(region_ids, regions_completed)
-            if self.verbose > 0:
-                print('Found next set of regions: {}.'.format(next_regions))
-
-            # If regions are found, continue, if not exit from the process
-            if len(next_regions) > 0:
-                if self.verbose > 0:
-                    print('Next set of regions non empty so recursively getting concentric_regions estimates for those: {}.'
-                          .format(next_regions))
-                return self.__get_concentric_regions_estimate_recursive(measurement,
-                                                               next_regions,
-                                                               timestamp,
-                                                               diffuse_level,
-                                                               regions_completed,
-                                                               ignore_site_ids)
-            else:
-                if self.verbose > 0:
-                    print('No next set of regions found so returning null')
-                return None, {"rings": diffuse_level-1}
-        else:
-            if self.verbose > 0:
-                print('Returning the result')
-            return result, {"rings": diffuse_level}
+        table_counts = np.zeros(region_count, dtype=np.int64)
+        table_regions = []
+        table_hops = []
+        # The source region from which each region was last visited (so the array is shared by all searches)
+        visited_from = np.full(region_count, -1, dtype=np.int64)
+        for source in range(region_count):
+            visited_from[source] = source
+            ring = np.array([source], dtype=np.int64)
+            hop = 0
+            while len(ring) > 0:
+                table_regions.append(ring.astype(np.int32))
+                table_hops.append(np.full(len(ring), hop, dtype=np.int32))
+                table_counts[source] += len(ring)
+                if hop >= self.max_ring_count:
+                    break
+                # Next ring: unvisited neighbours of the current ring
+                ring = np.unique(_csr_gather(neighbours_indptr, neighbours_indices, ring))
+                ring = ring[visited_from[ring] != source]
+                visited_from[ring] = source
+                hop += 1
+
+        indptr = np.zeros(region_count + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(table_counts)
+        return indptr, np.concatenate(table_regions), np.concatenate(table_hops)
 
     def __set_region_neighbours(self):
         '''
-        Find all of the neighbours of each region and add to a 'neighbours' column in self.regions -
-        as comma-delimited string of region_ids
+        Find all of the neighbours of each region (see EstimationData.region_neighbours, which holds them as
+        CSR arrays of region positions) and add to a 'neighbours' column in self.regions -
+        as comma-delimited string of region_ids, for reference.
 
         :return: No return value
         '''
 
-        if self.verbose > 0:
-            print('\ngetting all region neighbours')
+        indptr, indices = self.estimation_data.region_neighbours
+        region_ids = self.regions.index.values
 
-        for index, region in self.regions.iterrows():
-            neighbors = self.regions[self.regions.geometry.touches(region.geometry)].index.tolist()
-            neighbors = filter(lambda item: item != index, neighbors)
-            neighbors_str = ",".join(neighbors)
-            self.regions.at[index, "neighbours"] = neighbors_str
+        neighbours = []
+        for position, index in enumerate(region_ids):
+            neighbors_str = ",".join(region_ids[indices[indptr[position]:indptr[position + 1]]])
+            neighbours.append(neighbors_str)
 
             if self.verbose > 1:
                 print('neighbours for {}: {}'.format(index, neighbors_str))
+
+        self.regions['neighbours'] = neighbours
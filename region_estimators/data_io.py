@@ -0,0 +1,329 @@
+import os
+import string
+import pandas as pd
+import geopandas as gpd
+
+WINDOW_SIZE_DEFAULT = 100000
+PARQUET_EXTENSIONS = ['.parquet', '.pq']
+FEATHER_EXTENSIONS = ['.feather', '.arrow']
+
+
+def get_file_format(filespec):
+    '''
+        Find the format of a data file from its extension: 'parquet' ('.parquet' or '.pq', or a directory of a
+        partitioned parquet dataset), 'feather' ('.feather' or '.arrow') or otherwise 'csv'
+
+        :param filespec: (str) filespec of the file
+
+        :return: (str) 'csv', 'parquet' or 'feather'
+    '''
+    extension = os.path.splitext(filespec)[1].lower()
+    if extension in PARQUET_EXTENSIONS or os.path.isdir(filespec):
+        return 'parquet'
+    if extension in FEATHER_EXTENSIONS:
+        return 'feather'
+    return 'csv'
+
+
+def read_sites(filespec):
+    '''
+        Read a sites file (csv, parquet or feather, see get_file_format) into a sites dataframe for EstimationData
+
+        :param filespec: (str) filespec of the sites file, with 'site_id', 'latitude' and 'longitude' (and optional
+                         'name') columns
+
+        :return: pandas.DataFrame indexed by 'site_id'
+    '''
+    return _read_table(filespec).set_index('site_id')
+
+
+def read_regions(filespec, simplify_tolerance=None):
+    '''
+        Read a regions file into a regions GeoDataFrame for EstimationData: a csv file with wkt (or hex wkb)
+        geometries, or a (geo)parquet or feather file written by geopandas (see get_file_format)
+
+        :param filespec: (str) filespec of the regions file, with 'region_id' and 'geometry' columns
+        :param simplify_tolerance: (float) tolerance (in the units of the coordinates) to simplify the region
+                                   geometries to, or None not to simplify them (see get_regions_geodataframe)
+
+        :return: geopandas.GeoDataFrame indexed by 'region_id'
+    '''
+    file_format = get_file_format(filespec)
+    if file_format == 'csv':
+        df_regions = pd.read_csv(filespec, index_col='region_id')
+    else:
+        _import_pyarrow()
+        df_regions = gpd.read_parquet(filespec) if file_format == 'parquet' else gpd.read_feather(filespec)
+        if 'region_id' in list(df_regions.columns):
+            df_regions = df_regions.set_index('region_id')
+    return get_regions_geodataframe(df_regions, simplify_tolerance)
+
+
+def get_regions_geodataframe(df_regions, simplify_tolerance=None):
+    '''
+        Convert a regions dataframe, with geometries as wkt strings, wkb (bytes or hex strings) or shapely
+        geometries, into a GeoDataFrame for EstimationData. All of the geometries are parsed at once (rather than
+        calling shapely.wkt.loads per region).
+        Simplifying detailed region outlines makes finding the sites in each region and the region neighbours faster,
+        but regions' boundaries move by about the tolerance: sites close to a boundary may change region, and
+        regions that only just touch may no longer be neighbours (or vice versa).
+
+        :param df_regions: pandas.DataFrame of regions indexed by 'region_id', with a 'geometry' column
+        :param simplify_tolerance: (float) tolerance (in the units of the coordinates) to simplify the region
+                                   geometries to (preserving their topology), or None not to simplify them
+
+        :return: geopandas.GeoDataFrame (a new dataframe: df_regions is not changed)
+    '''
+    assert 'geometry' in list(df_regions.columns), "There is no geometry column in regions dataframe."
+    assert simplify_tolerance is None or simplify_tolerance >= 0, "simplify_tolerance must be None or >= 0"
+
+    geometry = df_regions['geometry']
+    if not isinstance(geometry, gpd.GeoSeries):
+        values = geometry.dropna()
+        first = values.iloc[0] if len(values.index) > 0 else None
+        if isinstance(first, bytes) or (isinstance(first, str) and len(first) > 0 and all(c in string.hexdigits for c in first)):
+            geometry = gpd.GeoSeries.from_wkb(geometry.values, index=geometry.index)
+        elif isinstance(first, str):
+            geometry = gpd.GeoSeries.from_wkt(geometry.values, index=geometry.index)
+        else:
+            geometry = gpd.GeoSeries(geometry)
+    if simplify_tolerance:
+        geometry = geometry.simplify(simplify_tolerance, preserve_topology=True)
+
+    return gpd.GeoDataFrame(df_regions.drop(columns=['geometry']), geometry=geometry, crs=geometry.crs)
+
+
+def read_actuals(filespec, measurements=None):
+    '''
+        Read an actuals file (csv, parquet or feather, see get_file_format) into an actuals dataframe for
+        EstimationData. Only the columns of the required measurements are read (parquet and feather files are
+        memory-mapped).
+
+        :param filespec: (str) filespec of the actuals file, with 'timestamp', 'site_id' and measurement columns
+        :param measurements: (str or list of str) measurement(s) to read, or None for all of the measurements
+
+        :return: pandas.DataFrame
+    '''
+    return _read_table(filespec, _get_actuals_columns(measurements))
+
+
+def write_estimations(df_estimates, filespec, partition_cols=['measurement'], append=False):
+    '''
+        Write estimations (as returned by RegionEstimator.get_estimations) to a csv file, or a parquet dataset
+        partitioned by measurement (see get_file_format)
+
+        :param df_estimates: pandas.DataFrame of estimations
+        :param filespec: (str) filespec of the csv file or parquet dataset directory
+        :param partition_cols: (list of str) columns to partition a parquet dataset by (default: ['measurement']),
+                               or None for a single parquet file
+        :param append: (bool) add the estimations to an existing csv file or parquet dataset (e.g. when writing
+                       the estimations of a series of time windows)
+
+        :return: No return value
+    '''
+    if get_file_format(filespec) == 'parquet':
+        _import_pyarrow()
+        if partition_cols:
+            # Each write adds new files to the partition directories (or first replaces the partitions written)
+            df_estimates.reset_index().to_parquet(
+                filespec, partition_cols=partition_cols, index=False,
+                existing_data_behavior='overwrite_or_ignore' if append else 'delete_matching')
+        else:
+            assert not append, "Cannot append to a single parquet file (give partition_cols)"
+            df_estimates.to_parquet(filespec)
+    else:
+        df_estimates.to_csv(filespec, mode='a' if append else 'w', header=not append)
+
+
+def read_actuals_windows(filespec, window_size=WINDOW_SIZE_DEFAULT, measurements=None):
+    '''
+        Read an actuals file in time windows, so that only one window of readings is held in memory at a time.
+        The file is read in chunks of (about) window_size rows (csv chunks, or batches of parquet row groups), and
+        each window holds the readings of whole timestamps: readings of the last timestamp of a chunk are held back
+        until the next chunk.
+        The readings of each timestamp must be together in the file (e.g. the file is sorted by timestamp).
+
+        :param filespec: (str) filespec of the actuals file (csv, parquet or feather, see get_file_format), with
+                         'timestamp', 'site_id' and measurement columns
+        :param window_size: (int) number of rows read at a time (a window can be larger if a single timestamp has
+                            more readings)
+        :param measurements: (str or list of str) measurement(s) to read, or None for all of the measurements
+
+        :return: generator of pandas.DataFrame actuals windows, in file order
+    '''
+    assert isinstance(window_size, int) and window_size > 0, "window_size must be a positive integer"
+
+    columns = _get_actuals_columns(measurements)
+    file_format = get_file_format(filespec)
+    if file_format == 'parquet':
+        chunks = _read_parquet_chunks(filespec, window_size, columns)
+    elif file_format == 'feather':
+        chunks = _read_feather_chunks(filespec, window_size, columns)
+    else:
+        chunks = pd.read_csv(filespec, chunksize=window_size, usecols=columns)
+    return _get_timestamp_windows(chunks)
+
+
+def iter_window_estimations(estimator, actuals_windows, measurement, region_id=None, ignore_site_ids=[],
+                            backend=None, json_extra_data=True):
+    '''
+        Estimate a series of actuals windows (e.g. from read_actuals_windows) one window at a time.
+        Each window's estimation data is made from the estimator's estimation data (see EstimationData.with_actuals),
+        so the topology is calculated once and shared by all of the windows.
+        The estimator's estimation data is restored when the generator is finished (or closed).
+
+        :param estimator: region estimator (e.g. from RegionEstimatorFactory), with estimation data for the sites and
+                          regions of the actuals
+        :param actuals_windows: iterable of pandas.DataFrame actuals
+        :param measurement: measurement(s) to be estimated (see RegionEstimator.get_estimations)
+        :param region_id: region identifier (string or None for all regions)
+        :param ignore_site_ids: site id(s) to be ignored during the estimations (default: empty list [])
+        :param backend: (str) how to calculate the estimations (see RegionEstimator.get_estimations)
+        :param json_extra_data: (bool) extra data as a json string column (see RegionEstimator.get_estimations)
+
+        :return: generator of pandas dataframes of the estimations of each window, as returned by get_estimations
+    '''
+    original_data = estimator.estimation_data
+    estimation_data = original_data
+    try:
+        for actuals in actuals_windows:
+            # Topology calculated (on first use) by one window is shared with the next
+            estimation_data = estimation_data.with_actuals(actuals)
+            estimator.estimation_data = estimation_data
+            yield estimator.get_estimations(measurement, region_id, None, ignore_site_ids, backend, json_extra_data)
+    finally:
+        estimator.estimation_data = original_data
+
+
+def _import_pyarrow():
+    '''
+        Import pyarrow, which is needed for parquet and feather files (but is not otherwise required)
+
+        :return: the pyarrow module
+    '''
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Parquet and feather files require pyarrow (pip install pyarrow)')
+    return pyarrow
+
+
+def _get_actuals_columns(measurements):
+    '''
+        Get the actuals columns to read for a set of measurements
+
+        :param measurements: (str or list of str) measurement(s), or None for all of the measurements
+
+        :return: list of column names, or None for all columns
+    '''
+    if measurements is None:
+        return None
+    measurements = list(measurements) if isinstance(measurements, (list, tuple)) else [measurements]
+    return ['timestamp', 'site_id'] + measurements
+
+
+def _read_table(filespec, columns=None):
+    '''
+        Read a data file (csv, parquet or feather, see get_file_format) into a dataframe, memory-mapping parquet and
+        feather files
+
+        :param filespec: (str) filespec of the file
+        :param columns: (list of str) the columns to read, or None for all columns
+
+        :return: pandas.DataFrame
+    '''
+    file_format = get_file_format(filespec)
+    if file_format == 'csv':
+        return pd.read_csv(filespec, usecols=columns)
+
+    _import_pyarrow()
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_table(filespec, columns=columns, memory_map=True).to_pandas()
+    import pyarrow.feather as feather
+    return feather.read_table(filespec, columns=columns, memory_map=True).to_pandas()
+
+
+def _read_parquet_chunks(filespec, chunk_size, columns=None):
+    '''
+        Read a parquet file in batches of rows
+
+        :param filespec: (str) filespec of the parquet file
+        :param chunk_size: (int) maximum number of rows per batch
+        :param columns: (list of str) the columns to read, or None for all columns
+
+        :return: generator of pandas.DataFrame
+    '''
+    _import_pyarrow()
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(filespec, memory_map=True).iter_batches(batch_size=chunk_size, columns=columns):
+        yield batch.to_pandas()
+
+
+def _read_feather_chunks(filespec, chunk_size, columns=None):
+    '''
+        Read a feather (arrow ipc) file, memory-mapped, in batches of rows
+
+        :param filespec: (str) filespec of the feather file
+        :param chunk_size: (int) maximum number of rows per batch
+        :param columns: (list of str) the columns to read, or None for all columns
+
+        :return: generator of pandas.DataFrame
+    '''
+    pyarrow = _import_pyarrow()
+    import pyarrow.ipc
+
+    with pyarrow.memory_map(filespec) as source:
+        reader = pyarrow.ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index)
+            if columns is not None:
+                batch = batch.select(columns)
+            for offset in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(offset, chunk_size).to_pandas()
+
+
+def _get_timestamp_windows(chunks):
+    '''
+        Regroup chunks of actuals into windows of whole timestamps
+
+        :param chunks: iterable of pandas.DataFrame actuals, in file order
+
+        :return: generator of pandas.DataFrame actuals windows
+    '''
+    held_back = None
+    window_timestamps = set()
+    for chunk in chunks:
+        if held_back is not None:
+            chunk = pd.concat([held_back, chunk], ignore_index=True)
+        if len(chunk.index) == 0:
+            continue
+
+        # The readings of the last timestamp may continue in the next chunk
+        is_last = (chunk['timestamp'] == chunk['timestamp'].iloc[-1]).values
+        window, held_back = chunk.loc[~is_last], chunk.loc[is_last]
+        if len(window.index) > 0:
+            window_timestamps = _check_window_timestamps(window, window_timestamps)
+            yield window
+
+    if held_back is not None and len(held_back.index) > 0:
+        _check_window_timestamps(held_back, window_timestamps)
+        yield held_back
+
+
+def _check_window_timestamps(window, previous_timestamps):
+    '''
+        Check that none of the timestamps of a window were in previous windows
+
+        :param window: pandas.DataFrame actuals window
+        :param previous_timestamps: (set) timestamps of the previous windows
+
+        :return: (set) timestamps of the previous windows and the window
+    '''
+    timestamps = set(pd.unique(window['timestamp']))
+    repeated = timestamps & previous_timestamps
+    assert len(repeated) == 0, \
+        "The readings of each timestamp must be together in the actuals file (e.g. sorted by timestamp). " \
+        "Timestamps split: " + str(sorted(repeated)[:5])
+    return previous_timestamps | timestamps
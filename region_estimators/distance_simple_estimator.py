@@ -1,20 +1,52 @@
-import pandas as pd
-import geopandas as gpd
+from shapely.geometry import box
+import numpy as np
+import json
 
-from region_estimators.region_estimator import RegionEstimator
+from region_estimators.region_estimator import RegionEstimator, _get_index_columns
 
 
 class DistanceSimpleEstimator(RegionEstimator):
+    MAX_DISTANCE_MATRIX_SIZE_DEFAULT = 10000000
+    EXTRA_DATA_COLUMNS = {'closest_sites': 'object'}
 
     def __init__(self, estimation_data=None,  verbose=RegionEstimator.VERBOSE_DEFAULT,
                  max_processors=RegionEstimator.MAX_NUM_PROCESSORS,
-                 progress_callback=None):
-        super(DistanceSimpleEstimator, self).__init__(estimation_data, verbose, max_processors, progress_callback)
+                 progress_callback=None, backend=None):
+        super(DistanceSimpleEstimator, self).__init__(estimation_data, verbose, max_processors, progress_callback, backend)
+        self._max_distance_matrix_size = DistanceSimpleEstimator.MAX_DISTANCE_MATRIX_SIZE_DEFAULT
 
     class Factory:
         def create(self, estimation_data=None, verbose=RegionEstimator.VERBOSE_DEFAULT,
-                   max_processors=RegionEstimator.MAX_NUM_PROCESSORS, progress_callback=None):
-            return DistanceSimpleEstimator(estimation_data, verbose, max_processors, progress_callback)
+                   max_processors=RegionEstimator.MAX_NUM_PROCESSORS, progress_callback=None, backend=None):
+            return DistanceSimpleEstimator(estimation_data, verbose, max_processors, progress_callback, backend)
+
+    @property
+    def max_distance_matrix_size(self):
+        return self._max_distance_matrix_size
+
+    @max_distance_matrix_size.setter
+    def max_distance_matrix_size(self, new_size=MAX_DISTANCE_MATRIX_SIZE_DEFAULT):
+        """  Set the maximum size of the precomputed region to site distances (number of regions x number of sites)
+             and of the site readings cube they are searched with (number of timestamps x number of sites).
+             Above this size, the closest sites are found with a spatial index of the sites, from one timestamp's
+             readings at a time, so that memory stays proportional to the number of sites.
+
+                   :param new_size:
+                    the maximum number of regions x sites distances and of timestamps x sites readings
+                    (integer, default=MAX_DISTANCE_MATRIX_SIZE_DEFAULT)
+        """
+        assert isinstance(new_size, int), "max_distance_matrix_size must be an integer."
+        assert new_size >= 0, "max_distance_matrix_size cannot be negative"
+        self._max_distance_matrix_size = new_size
+        self._invalidate_workers()
+
+    @property
+    def uses_spatial_index(self):
+        """  Whether the closest sites are found with a spatial index of the sites (True) or from the precomputed
+             region to site distances (False), depending on max_distance_matrix_size
+        """
+        return max(len(self.regions.index), len(self.estimation_data.timestamps)) * len(self.sites.index) > \
+            self.max_distance_matrix_size
 
     def get_estimate(self, measurement, timestamp, region_id, ignore_site_ids=[]):
         """  Find estimations for a region and timestamp using the simple distance method: value of closest actual site
@@ -29,48 +61,239 @@ class DistanceSimpleEstimator(RegionEstimator):
                 ii) dict: {"closest_sites": [IDs of closest site(s)]}
 
         """
-        result = None, {'closest_site_data': None}
-
-        # Get the actual values
-        df_actuals = self.actuals.loc[
-            (~self.actuals['site_id'].isin(ignore_site_ids)) &
-            (self.actuals['timestamp'] == timestamp) &
-            (self.actuals[measurement].notnull())
-        ]
-
-        df_sites = self.sites.reset_index()
-
-        df_actuals = pd.merge(left=df_actuals,
-                           right= df_sites,
-                           on='site_id',
-                           how='left')
-        gdf_actuals = gpd.GeoDataFrame(data=df_actuals, geometry='geometry')
-
-        # Get the closest site to the region
-        if len(gdf_actuals) > 0:
-            # Get region geometry
-            df_reset = pd.DataFrame(self.regions.reset_index())
-            regions_temp = df_reset.loc[df_reset['region_id'] == region_id]
-            if len(regions_temp.index) > 0:
-                region = regions_temp.iloc[0]
-
-            # Calculate distances
-            gdf_actuals['distance'] = pd.DataFrame(gdf_actuals['geometry'].distance(region.geometry))
-
-            # Get site(s) with shortest distance
-            top_result = gdf_actuals.sort_values(by=['distance'], ascending=True).iloc[0] #returns the whole row as a series
-
-            if top_result is not None:
-                # Take the average of all sites with the closest distance
-                closest_sites = gdf_actuals.loc[gdf_actuals['distance'] == top_result['distance']]
-                closest_values_mean = closest_sites[measurement].mean(axis=0)
-
-                # In extra data, return closest site name if it exists, otherwise closest site id
-                if 'name' in list(closest_sites.columns):
-                    closest_sites_result = list(closest_sites['name'])
-                else:
-                    closest_sites_result = list(closest_sites['site_id'])
-
-                result = closest_values_mean, {"closest_sites": closest_sites_result}
-
-        return result
+        position = self.regions.index.get_loc(region_id)
+
+        if self.uses_spatial_index:
+            # Get the actual values of the sites with readings
+            readings = self.estimation_data.get_timestamp_site_readings(measurement, timestamp, ignore_site_ids)
+            value, closest_sites = self.__get_nearest_estimate(position, *readings)
+            values, closest_sites = [value], [closest_sites]
+        else:
+            # Get the actual values of each site
+            sums, counts = self.estimation_data.get_site_aggregates(measurement, [timestamp], ignore_site_ids)
+            values, closest_sites = self.__get_closest_estimates(position, sums, counts)
+
+        if closest_sites[0] is None:
+            return None, {'closest_site_data': None}
+        return values[0], {"closest_sites": closest_sites[0]}
+
+    def _get_vectorized_estimations(self, measurements, region_ids, timestamps, ignore_site_ids=[]):
+        """  Find estimations for all of the measurements, regions and timestamps at once using the simple distance
+             method. The measurements' (timestamps x sites) readings are stacked and searched in each region's
+             precomputed order of site distances, for all measurements and timestamps together.
+
+            :param measurements: measurements to be estimated (list of str)
+            :param region_ids: region identifiers (list of str)
+            :param timestamps: timestamp identifiers (sorted list of str)
+            :param ignore_site_ids: site id(s) to be ignored during the estimations
+
+            :return: dict of result columns (one item per measurement, region and timestamp, in measurement, region
+                        then timestamp order): 'measurement', 'region_id', 'timestamp', (estimated) 'value' and
+                        'closest_sites' (None where there are no site readings)
+        """
+        if self.verbose > 0:
+            print('\n### Getting vectorized estimates for {} regions, measurements {} at {} timestamps ###\n'.format(
+                len(region_ids), measurements, len(timestamps)))
+
+        positions = self.estimation_data.get_region_positions(region_ids)
+        shape = (len(measurements), len(region_ids), len(timestamps))
+        values = np.empty(shape)
+        closest_sites = np.empty(shape, dtype=object)
+
+        if self.uses_spatial_index:
+            # Find the nearest sites timestamp by timestamp, so only one timestamp's readings are held at a time
+            for measurement_index, measurement in enumerate(measurements):
+                for timestamp_index, timestamp in enumerate(timestamps):
+                    readings = self.estimation_data.get_timestamp_site_readings(measurement, timestamp,
+                                                                                ignore_site_ids)
+                    for index, position in enumerate(positions):
+                        values[measurement_index, index, timestamp_index], \
+                            closest_sites[measurement_index, index, timestamp_index] = \
+                            self.__get_nearest_estimate(position, *readings)
+        else:
+            aggregates = [self.estimation_data.get_site_aggregates(measurement, timestamps, ignore_site_ids)
+                          for measurement in measurements]
+            sums = np.concatenate([measurement_sums for measurement_sums, _ in aggregates])
+            counts = np.concatenate([measurement_counts for _, measurement_counts in aggregates])
+            for index, position in enumerate(positions):
+                region_values, region_closest_sites = self.__get_closest_estimates(position, sums, counts)
+                values[:, index, :] = region_values.reshape(len(measurements), len(timestamps))
+                for row, sites in enumerate(region_closest_sites):
+                    closest_sites[row // len(timestamps), index, row % len(timestamps)] = sites
+
+        result_columns = _get_index_columns(measurements, region_ids, timestamps)
+        result_columns['value'] = values.ravel()
+        result_columns['closest_sites'] = closest_sites.ravel()
+        return result_columns
+
+    def _get_held_out_estimates(self, measurement, timestamps, site_position, region_positions, rows):
+        """  Find the estimations of the regions containing a held out site (see RegionEstimator), from the
+             precomputed order of site distances with the site's readings removed.
+        """
+        if self.uses_spatial_index:
+            return super(DistanceSimpleEstimator, self)._get_held_out_estimates(
+                measurement, timestamps, site_position, region_positions, rows)
+
+        sums, counts = self.estimation_data.get_site_aggregates(measurement, timestamps)
+        held_out_sums = sums[rows]
+        held_out_counts = counts[rows]
+        held_out_counts[:, site_position] = 0
+
+        return np.array([self.__get_closest_estimates(position, held_out_sums, held_out_counts)[0]
+                         for position in region_positions])
+
+    def _get_affected_regions(self, measurement, timestamp, site_positions, ignore_site_ids=[]):
+        """  Find the regions whose estimate at a timestamp can change when the readings of some sites change (see
+             RegionEstimator.update_estimations): the regions at least as close to one of the sites as to the closest
+             of the other sites with readings.
+        """
+        if self.uses_spatial_index:
+            site_geometries = self.sites.geometry.values[site_positions]
+            changed_distances = np.array([self.regions.geometry.distance(site).values for site in site_geometries]) \
+                .min(axis=0)
+            readings_positions, _, _ = self.estimation_data.get_timestamp_site_readings(
+                measurement, timestamp, list(ignore_site_ids) + list(self.sites.index[site_positions]))
+            other_distances = np.array([self.__get_nearest_sites(position, readings_positions)[2]
+                                        for position in range(len(self.regions.index))])
+        else:
+            distances, _ = self.estimation_data.region_site_distances
+            changed_distances = distances[:, site_positions].min(axis=1)
+            readings_positions, _, _ = self.estimation_data.get_timestamp_site_readings(measurement, timestamp,
+                                                                                        ignore_site_ids)
+            has_readings = np.zeros(len(self.sites.index), dtype=bool)
+            has_readings[readings_positions] = True
+            has_readings[site_positions] = False
+            other_distances = distances[:, has_readings].min(axis=1) if has_readings.any() else \
+                np.full(len(self.regions.index), np.inf)
+
+        return changed_distances <= other_distances
+
+    def _get_extra_data_json(self, extra_data):
+        """  Convert the closest_sites column to the (json string) extra_data of each estimate, as returned by
+             get_estimate
+
+            :param extra_data: pandas dataframe with column 'closest_sites'
+
+            :return: list of json strings, one per estimate
+        """
+        return [json.dumps({'closest_site_data': None} if sites is None else {"closest_sites": sites})
+                for sites in extra_data['closest_sites']]
+
+    def __get_closest_estimates(self, position, sums, counts):
+        '''
+        Find the simple distance estimates of a region for each timestamp of a set of site aggregates: the mean of
+        the readings of the closest site(s) with readings, using the precomputed region to site distances.
+
+        :param position: (int) position of the region in self.regions
+        :param sums: (numpy array) sums of site readings, of shape (timestamps, sites)
+        :param counts: (numpy array) counts of site readings, of shape (timestamps, sites)
+
+        :return: tuple of (numpy array of values, list of closest sites) with one item per timestamp.
+                 The closest sites are a list of site names (or IDs if sites have no 'name' column) and are
+                 None where there are no site readings
+        '''
+        distances, orders = self.estimation_data.region_site_distances
+        region_distances = distances[position]
+        has_readings = counts > 0
+
+        # Get the closest site with readings, for each timestamp
+        ordered_readings = has_readings[:, orders[position]]
+        found = ordered_readings.any(axis=1)
+        closest_distances = region_distances[orders[position][ordered_readings.argmax(axis=1)]]
+
+        # Take the average of all sites with the closest distance
+        closest = has_readings & (region_distances[np.newaxis, :] == closest_distances[:, np.newaxis])
+        values = np.full(len(sums), np.nan)
+        values[found] = (sums * closest).sum(axis=1)[found] / (counts * closest).sum(axis=1)[found]
+
+        # In extra data, return closest site name if it exists, otherwise closest site id
+        site_names = self.__get_site_names()
+        site_ranks = self.estimation_data.site_ranks
+
+        closest_sites = []
+        for timestamp_closest, timestamp_found in zip(closest, found):
+            if timestamp_found:
+                sites = np.flatnonzero(timestamp_closest)
+                closest_sites.append(site_names[sites[np.argsort(site_ranks[sites], kind='stable')]].tolist())
+            else:
+                closest_sites.append(None)
+
+        return values, closest_sites
+
+    def __get_site_names(self):
+        '''
+        Get the names of the sites (in sites order), for the extra data of estimates
+
+        :return: numpy array of site names if the sites have a 'name' column, otherwise site ids
+        '''
+        if 'name' in list(self.sites.columns):
+            return self.sites['name'].values
+        return self.sites.index.values
+
+    def __get_nearest_estimate(self, position, site_positions, sums, counts):
+        '''
+        Find the simple distance estimate of a region from the readings of a single timestamp, using a spatial index
+        of the sites (see __get_nearest_sites).
+
+        :param position: (int) position of the region in self.regions
+        :param site_positions: (numpy int array) sorted positions of the sites with readings
+        :param sums: (numpy array) sums of the readings of those sites
+        :param counts: (numpy array) counts of the readings of those sites
+
+        :return: tuple of (value, closest sites). The closest sites are a list of site names (or IDs if sites have no
+                 'name' column) and are None where there are no site readings
+        '''
+        sites, reading_indexes, _ = self.__get_nearest_sites(position, site_positions)
+        if len(sites) == 0:
+            return np.nan, None
+
+        # Take the average of all sites with the closest distance
+        value = sums[reading_indexes].sum() / counts[reading_indexes].sum()
+
+        # In extra data, return closest site name if it exists, otherwise closest site id
+        sites = sites[np.argsort(self.estimation_data.site_ranks[sites], kind='stable')]
+        return value, self.__get_site_names()[sites].tolist()
+
+    def __get_nearest_sites(self, position, site_positions):
+        '''
+        Find the closest sites to a region, of a set of sites, using a spatial index of the sites: sites are searched
+        within a bounding box around the region that doubles in size until it contains one of the set that is no
+        further away than the box margin (so no site outside the box can be closer).
+
+        :param position: (int) position of the region in self.regions
+        :param site_positions: (numpy int array) sorted positions of the set of sites (e.g. the sites with readings)
+
+        :return: tuple of (numpy int array of the positions of the closest sites (all at the closest distance),
+                 numpy int array of their indexes in site_positions, closest distance (inf if the set is empty))
+        '''
+        no_sites = np.array([], dtype=np.int64)
+        if len(site_positions) == 0:
+            return no_sites, no_sites, np.inf
+
+        region = self.regions.geometry.values[position]
+        min_x, min_y, max_x, max_y = region.bounds
+        sites_min_x, sites_min_y, sites_max_x, sites_max_y = self.sites.total_bounds
+        # Margin at which the box covers all of the sites
+        max_margin = max(min_x - sites_min_x, min_y - sites_min_y, sites_max_x - max_x, sites_max_y - max_y, 0)
+        margin = 0
+        step = max(max_x - min_x, max_y - min_y, max_margin / 1024, np.finfo(float).eps)
+
+        while True:
+            candidates = self.sites.sindex.query(box(min_x - margin, min_y - margin, max_x + margin, max_y + margin))
+            # Candidates with readings (and the index of their readings)
+            reading_indexes = np.searchsorted(site_positions, candidates)
+            has_readings = reading_indexes < len(site_positions)
+            has_readings[has_readings] = site_positions[reading_indexes[has_readings]] == candidates[has_readings]
+            candidates, reading_indexes = candidates[has_readings], reading_indexes[has_readings]
+
+            if len(candidates) > 0:
+                distances = self.sites.geometry.values[candidates].distance(region)
+                closest_distance = distances.min()
+                if closest_distance <= margin or margin >= max_margin:
+                    break
+            elif margin >= max_margin:
+                return no_sites, no_sites, np.inf
+            margin = min(max(margin * 2, step), max_margin)
+
+        closest = distances == closest_distance
+        return candidates[closest], reading_indexes[closest], closest_distance
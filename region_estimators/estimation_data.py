@@ -1,13 +1,69 @@
 import geopandas as gpd
 import pandas as pd
 import numpy as np
+import shapely
 import multiprocessing
+import hashlib
+import tempfile
+import copy
+import os
+
+from region_estimators import data_io
+
+
+def _pairs_to_csr(row_positions, column_positions, row_count):
+    '''
+        Convert (row, column) pairs, sorted by row, into compressed sparse row (CSR) arrays
+
+        :param row_positions: (numpy array of int) row position of each pair (sorted ascending)
+        :param column_positions: (numpy array of int) column position of each pair
+        :param row_count: (int) total number of rows
+
+        :return: tuple (indptr, indices) where the columns of row i are indices[indptr[i]:indptr[i + 1]]
+    '''
+    indptr = np.searchsorted(row_positions, np.arange(row_count + 1)).astype(np.int64)
+    return indptr, np.asarray(column_positions, dtype=np.int64)
+
+
+def _csr_gather(indptr, indices, rows):
+    '''
+        Gather the columns of several rows of compressed sparse row (CSR) arrays
+
+        :param indptr: (numpy array of int) CSR row pointers
+        :param indices: (numpy array of int) CSR column positions
+        :param rows: (numpy array of int) positions of the rows to gather
+
+        :return: numpy array of the column positions of all the rows, concatenated in rows order
+    '''
+    starts = indptr[rows]
+    counts = indptr[np.asarray(rows) + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return indices[offsets + np.arange(counts.sum())]
+
+
+def _is_numeric(values, nulls=True):
+    '''
+        Check that values are numbers: a numeric dtype, or (e.g. for object columns) values that can all be converted
+        to numbers
+
+        :param values: (pandas.Series) values to check
+        :param nulls: (bool) whether null values are accepted
+
+        :return: (bool) True if the values are numeric
+    '''
+    if not pd.api.types.is_numeric_dtype(values):
+        try:
+            values = pd.to_numeric(values, errors='raise')
+        except (ValueError, TypeError):
+            return False
+    return nulls or values.notnull().all()
+
 
 class EstimationData(object):
     VERBOSE_DEFAULT = 0
     VERBOSE_MAX = 2
 
-    def __init__(self, sites, regions, actuals, verbose=0):
+    def __init__(self, sites, regions, actuals, verbose=0, cache_dir=None, trusted=False, compact=False):
         """
          Initialise instance of the RegionEstimator class.
 
@@ -26,12 +82,33 @@ class EstimationData(object):
 
              actuals: list of site values as pandas.DataFrame
                  Required columns:
-                     'timestamp' (str): timestamp of actual reading
+                     'timestamp' (str): timestamp of actual reading (timestamps are sorted chronologically if they
+                         can all be parsed as dates/times, otherwise alphabetically)
                      'site_id': (str or int) ID of site which took actual reading - must match an index
                          value in sites. (will be converted to str)
                      [one or more value columns] (float):    value of actual measurement readings.
                                                              each column name is the name of the measurement
                                                              e.g. 'NO2'
+                 The given dataframes are never changed. Actuals whose columns are already in order (timestamp,
+                 site_id, measurements), with string site IDs and numeric measurements, sorted by timestamp, are used
+                 without copying them (whether or not they are trusted), so they must not be changed afterwards.
+
+             verbose: (int) level of debug output (0 = no verbose output)
+
+             cache_dir: (str) directory in which to cache the region/site topology (which sites are within each
+                 region, region neighbours and region to site distances) between runs, or None for no cache.
+                 Cached topology is keyed by a hash of the region geometries and IDs and of the site coordinates
+                 and IDs, so it is recalculated whenever any of them change.
+
+             trusted: (bool) the data has already been checked (e.g. it was taken from other estimation data), so
+                 skip checking it.
+
+             compact: (bool) store the actuals compactly: measurement values as float32, and site IDs and timestamps
+                 as categoricals (of the sites and of the timestamps, in order). This takes a fraction of the memory
+                 of float64 values and object (string) IDs, but measurement values are rounded to float32 (about 7
+                 significant digits, a relative error of at most 6e-8), so estimations can differ from those of
+                 uncompacted actuals by about the same relative amount. Estimations are otherwise unchanged (they
+                 are calculated in float64).
 
          Returns:
              Initialised instance of subclass of RegionEstimator
@@ -39,17 +116,60 @@ class EstimationData(object):
          """
         ### Check and set verbose
         self.verbose = verbose
+        self._cache_dir = cache_dir
+        self._compact = compact
+        self._topology_keys = {}
+        self._version = 0
+
+        if not trusted:
+            self.__check_data(sites, regions, actuals)
+
+        # Convert to geo dataframe (with string site IDs, leaving the given sites unchanged)
+        try:
+            gdf_sites = gpd.GeoDataFrame(data=sites.drop(columns=['longitude', 'latitude']),
+                                         geometry=gpd.points_from_xy(sites.longitude, sites.latitude))
+        except Exception as err:
+            raise ValueError('Error converting sites DataFrame to a GeoDataFrame: ' + str(err))
+        gdf_sites.index = sites.index.map(str)
+
+        try:
+            gdf_regions = gpd.GeoDataFrame(data=regions, geometry='geometry')
+        except Exception as err:
+            raise ValueError('Error converting regions DataFrame to a GeoDataFrame: ' + str(err))
+
+        # Set data properties
+        self._sites = gdf_sites
+        self._regions = gdf_regions
+        self._region_neighbours = None
+        self._region_sites = None
+        self._site_groups = None
+        self._site_regions = None
+        self._site_region = None
+        self._region_site_distances = None
+        self.__set_actuals(actuals)
+
+        # Set extra useful data for estimation calculations
+        self.__set_site_region_relationships()
+
+    @staticmethod
+    def __check_data(sites, regions, actuals):
+        '''
+            Check the sites, regions and actuals given to the constructor
 
+            :param sites: pandas.DataFrame of sites
+            :param regions: pandas.DataFrame of regions
+            :param actuals: pandas.DataFrame of actuals
+
+            :return: No return value (raises AssertionError for invalid data)
+        '''
         ### Check sites:
 
         assert sites.index.name == 'site_id', "sites dataframe index name must be 'site_id'"
         # (Not checking site_id data as that forms the index)
         assert 'latitude' in list(sites.columns), "There is no latitude column in sites dataframe"
-        assert pd.to_numeric(sites['latitude'], errors='coerce').notnull().all(), \
-            "latitude column contains non-numeric values."
+        assert _is_numeric(sites['latitude'], nulls=False), "latitude column contains non-numeric values."
         assert 'longitude' in list(sites.columns), "There is no longitude column in sites dataframe"
-        assert pd.to_numeric(sites['longitude'], errors='coerce').notnull().all(), \
-            "longitude column contains non-numeric values."
+        assert _is_numeric(sites['longitude'], nulls=False), "longitude column contains non-numeric values."
 
         ### Check regions
         # (Not checking region_id data as that forms the index)
@@ -62,53 +182,38 @@ class EstimationData(object):
         assert len(list(actuals.columns)) > 2, "There are no measurement value columns in the actuals dataframe."
 
         # Check measurement columns have either numeric or null data
-        for column in list(actuals.columns):
-            if column not in ['timestamp', 'site_id']:
-                # Check measurement does not contain numeric (nulls are OK)
-                # df_temp = actuals.loc[actuals[column].notnull()]
-                try:
-                    pd.to_numeric(actuals[column], errors='raise').notnull()  # .all()
-                except:
-                    raise AssertionError(
-                        "actuals['" + column + "'] column contains non-numeric values (null values are accepted).")
+        EstimationData.__check_measurement_columns(actuals)
 
         # Check that each site_id value is present in the sites dataframe index.
         # ... So site_id values must be a subset of allowed sites
-        error_sites = set(actuals['site_id'].unique()) - set(sites.index.values)
+        site_ids = pd.Index(pd.unique(actuals['site_id']))
+        error_sites = set(site_ids[~site_ids.isin(sites.index)])
         assert len(error_sites) == 0, \
             "Each site ID must match a site_id in sites. Error site IDs: " + str(error_sites)
 
-        # Convert to geo dataframe
-        sites.index = sites.index.map(str)
-        try:
-            gdf_sites = gpd.GeoDataFrame(data=sites,
-                                         geometry=gpd.points_from_xy(sites.longitude, sites.latitude))
-        except Exception as err:
-            raise ValueError('Error converting sites DataFrame to a GeoDataFrame: ' + str(err))
-
-        gdf_sites = gdf_sites.drop(columns=['longitude', 'latitude'])
-
-        try:
-            gdf_regions = gpd.GeoDataFrame(data=regions, geometry='geometry')
-        except Exception as err:
-            raise ValueError('Error converting regions DataFrame to a GeoDataFrame: ' + str(err))
-
-        # actuals: Make sure value columns at the end of column list
-        cols = actuals.columns.tolist()
-        cols.insert(0, cols.pop(cols.index('site_id')))
-        cols.insert(0, cols.pop(cols.index('timestamp')))
-        actuals = actuals[cols]
-        # Convert site_id to string
-        actuals['site_id'] = actuals['site_id'].astype(str)
-
-        # Set data properties
-        self._sites = gdf_sites
-        self._regions = gdf_regions
-        self._actuals = actuals
-
-        # Set extra useful data for estimation calculations
-        self.__set_site_region()
-        self.__set_region_sites()
+    @classmethod
+    def from_files(cls, sites_filespec, regions_filespec, actuals_filespec, measurements=None, verbose=0,
+                   cache_dir=None, simplify_tolerance=None, compact=False):
+        '''
+            Create estimation data from sites, regions and actuals files: csv, parquet or feather (regions as
+            GeoParquet/feather written by geopandas, or csv with wkt geometries). Parquet and feather files are
+            memory-mapped, and only the actuals columns of the given measurements are read.
+
+            :param sites_filespec: (str) filespec of the sites file (see data_io.read_sites)
+            :param regions_filespec: (str) filespec of the regions file (see data_io.read_regions)
+            :param actuals_filespec: (str) filespec of the actuals file (see data_io.read_actuals)
+            :param measurements: (str or list of str) measurement(s) to read, or None for all of the measurements
+            :param verbose: (int) level of debug output (0 = no verbose output)
+            :param cache_dir: (str) directory in which to cache the region/site topology, or None for no cache
+            :param simplify_tolerance: (float) tolerance to simplify the region geometries to, or None not to
+                                       simplify them (see data_io.get_regions_geodataframe)
+            :param compact: (bool) store the actuals compactly (see the constructor)
+
+            :return: EstimationData instance
+        '''
+        return cls(data_io.read_sites(sites_filespec), data_io.read_regions(regions_filespec, simplify_tolerance),
+                   data_io.read_actuals(actuals_filespec, measurements), verbose=verbose, cache_dir=cache_dir,
+                   compact=compact)
 
     @property
     def verbose(self):
@@ -139,6 +244,185 @@ class EstimationData(object):
     def actuals(self):
         return self._actuals
 
+    @property
+    def compact(self):
+        return self._compact
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @property
+    def version(self):
+        '''
+            The version of the actuals, incremented every time actuals are appended (see append_actuals), so that
+            users of the data (e.g. estimator worker processes) can tell when it has changed
+
+            :return: (int) version number (0 for the actuals given to the constructor)
+        '''
+        return self._version
+
+    @property
+    def site_ids(self):
+        '''
+            The site IDs, in sites order: the ID of the site at position i (as used by the integer arrays of site
+            positions, e.g. region_sites) is site_ids[i]
+
+            :return: numpy array of site IDs (str)
+        '''
+        return self._sites.index.values
+
+    @property
+    def region_ids(self):
+        '''
+            The region IDs, in regions order: the ID of the region at position i (as used by the integer arrays of
+            region positions, e.g. region_neighbours) is region_ids[i]
+
+            :return: numpy array of region IDs
+        '''
+        return self._regions.index.values
+
+    def get_site_positions(self, site_ids):
+        '''
+            Translate site IDs to site positions (positions in self.sites)
+
+            :param site_ids: (list of str) site IDs
+
+            :return: numpy int array of site positions (-1 for IDs that are not in self.sites)
+        '''
+        return self._sites.index.get_indexer(list(site_ids))
+
+    def get_region_positions(self, region_ids):
+        '''
+            Translate region IDs to region positions (positions in self.regions)
+
+            :param region_ids: (list of str) region IDs
+
+            :return: numpy int array of region positions (-1 for IDs that are not in self.regions)
+        '''
+        return self._regions.index.get_indexer(list(region_ids))
+
+    @property
+    def region_sites(self):
+        '''
+            The sites within each region, as compressed sparse row (CSR) arrays of site positions
+            (positions in self.sites). The sites of the region at position i are indices[indptr[i]:indptr[i + 1]].
+
+            :return: tuple of numpy int arrays (indptr, indices)
+        '''
+        return self._region_sites
+
+    @property
+    def site_regions(self):
+        '''
+            The regions containing each site (the inverse of region_sites), as compressed sparse row (CSR) arrays of
+            region positions, computed on first use. The regions of the site at position i are
+            indices[indptr[i]:indptr[i + 1]] (in regions order).
+
+            :return: tuple of numpy int arrays (indptr, indices)
+        '''
+        if self._site_regions is None:
+            indptr, indices = self._region_sites
+            region_positions = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+            order = np.lexsort((region_positions, indices))
+            self._site_regions = _pairs_to_csr(indices[order], region_positions[order], len(self._sites.index))
+        return self._site_regions
+
+    @property
+    def site_region(self):
+        '''
+            The region of each site (in sites order): where regions overlap, the last region (in regions order)
+            containing the site
+
+            :return: numpy int array of region positions (-1 for sites that are not in any region)
+        '''
+        return self._site_region
+
+    @property
+    def site_groups(self):
+        '''
+            The sites grouped by the set of regions that they are within (with non-overlapping regions: one group
+            per region containing sites, plus one group of the sites that are not within any region), computed on
+            first use. Aggregating site readings by group (rather than by region) means that a site within
+            overlapping regions is only counted once for any set of regions.
+
+            :return: tuple of numpy int arrays (group_indptr, group_regions, site_groups): the regions (positions)
+                     of group i are group_regions[group_indptr[i]:group_indptr[i + 1]] and site_groups holds the
+                     group of each site (in sites order)
+        '''
+        if self._site_groups is None:
+            self._site_groups = self.__get_site_groups()
+        return self._site_groups
+
+    @property
+    def timestamps(self):
+        '''
+            The unique timestamps in the actuals (as given), sorted chronologically if they can all be parsed as
+            dates/times, otherwise alphabetically
+
+            :return: pandas.Index of timestamps
+        '''
+        return self._timestamps
+
+    @property
+    def timestamp_values(self):
+        '''
+            The date/time of each timestamp in self.timestamps
+
+            :return: pandas.DatetimeIndex, or None if the timestamps cannot all be parsed as dates/times
+        '''
+        return self._timestamp_values
+
+    @property
+    def timestamp_sites(self):
+        '''
+            The readings of each timestamp, as compressed sparse row (CSR) arrays of site positions
+            (positions in self.sites). The actuals are stored in timestamp order, so the readings of the timestamp at
+            position i are rows indptr[i]:indptr[i + 1] of self.actuals, taken at sites indices[indptr[i]:indptr[i + 1]].
+
+            :return: tuple of numpy int arrays (indptr, indices)
+        '''
+        return self._timestamp_sites
+
+    @property
+    def region_site_distances(self):
+        '''
+            The distance from each region to each site, and the sites of each region ordered by distance,
+            computed on first use.
+
+            :return: tuple of numpy arrays (distances, orders), each of shape (regions, sites).
+                     distances[i, j] is the distance from the region at position i to the site at position j and
+                     orders[i] holds the site positions sorted by (ascending) distance from the region at position i
+        '''
+        if self._region_site_distances is None:
+            self._region_site_distances = self.__load_topology('region_site_distances',
+                                                               self.__get_region_site_distances)
+        return self._region_site_distances
+
+    @property
+    def site_ranks(self):
+        '''
+            The rank of each site (in sites order) by first appearance in the actuals (sites with no actuals are last),
+            used to list sites in the order of their actual readings.
+
+            :return: numpy int array
+        '''
+        return self._site_ranks
+
+    @property
+    def region_neighbours(self):
+        '''
+            The regions that touch each region, as compressed sparse row (CSR) arrays of region positions
+            (positions in self.regions), computed on first use.
+            The neighbours of the region at position i are indices[indptr[i]:indptr[i + 1]] (in regions order).
+
+            :return: tuple of numpy int arrays (indptr, indices)
+        '''
+        if self._region_neighbours is None:
+            self._region_neighbours = self.__load_topology('region_neighbours', self.__get_region_neighbours,
+                                                           with_sites=False)
+        return self._region_neighbours
+
     @staticmethod
     def is_valid_site_id(site_id):
         '''
@@ -153,7 +437,7 @@ class EstimationData(object):
 
     def get_adjacent_regions(self, region_ids, ignore_regions=[]):
         """  Find all adjacent regions for list a of region ids
-             Uses the neighbouring regions found in set-up, using __get_all_region_neighbours
+             Uses the neighbouring regions held in self.region_neighbours
 
             :param region_ids: list of region identifier (list of strings)
             :param ignore_regions:  list of region identifier (list of strings): list to be ignored
@@ -164,16 +448,17 @@ class EstimationData(object):
         if self.verbose > 0:
             print('\ngetting adjacent regions...')
 
+        indptr, indices = self.region_neighbours
+        all_region_ids = self.region_ids
+
         # Create an empty list for adjacent regions
         adjacent_regions = []
         # Get all adjacent regions for each region
-        df_reset = self.regions.reset_index()
-        for region_id in region_ids:
+        for region_id, position in zip(region_ids, self.get_region_positions(region_ids)):
             if self.verbose > 1:
                 print('getting adjacent regions for {}'.format(region_id))
-            regions_temp = df_reset.loc[df_reset['region_id'] == region_id]
-            if len(regions_temp.index) > 0:
-                adjacent_regions.extend(regions_temp['neighbours'].iloc[0].split(','))
+            if position >= 0:
+                adjacent_regions.extend(all_region_ids[indices[indptr[position]:indptr[position + 1]]])
 
         # Return all adjacent regions as a querySet and remove any that are in the completed/ignore list.
         return [x for x in adjacent_regions if x not in ignore_regions and x.strip() != '']
@@ -181,15 +466,16 @@ class EstimationData(object):
     def get_region_sites(self, region_id):
         '''
             Find all sites within the region identified by region_id
-            as comma-delimited string of site ids.
+            (from the region's block of self.region_sites).
 
             :param region_id:  (str) a region id (must be (an index) in self.regions)
 
-            :return: A list of site IDs (list of str)
+            :return: A list of site IDs (list of str), in sites order
         '''
-        assert region_id in self.regions.index.tolist(), 'region_id is not in list of regions'
-        result = self.regions.loc[[region_id]]['sites'][0].strip().split(',')
-        return list(filter(self.is_valid_site_id, result))
+        assert region_id in self.regions.index, 'region_id is not in list of regions'
+        position = self._regions.index.get_loc(region_id)
+        indptr, indices = self.region_sites
+        return self.site_ids[indices[indptr[position]:indptr[position + 1]]].tolist()
 
     def get_regions_sites(self, region_ids, ignore_site_ids=[]):
         '''
@@ -198,20 +484,19 @@ class EstimationData(object):
         :param region_ids: (list of str) list of region IDs
         :param ignore_site_ids: (list of str) list of site_ids to be ignored
 
-        :return: list of site IDs
+        :return: list of site IDs, in sites order
         '''
-        # Create an empty queryset for sites found in regions
-        sites = []
-
         if self.verbose > 0:
             print('Finding sites in region_ids: {}'.format(region_ids))
 
+        region_positions = self.get_region_positions(region_ids)
+        assert (region_positions >= 0).all(), 'region_id is not in list of regions'
+
         # Find sites in region_ids
-        for region_id in region_ids:
-            if self.verbose > 1:
-                print('Finding sites in region {}'.format(region_id))
-            sites.extend(self.get_region_sites(region_id))
-        return list(set(sites) - set(ignore_site_ids))
+        indptr, indices = self.region_sites
+        site_positions = np.unique(_csr_gather(indptr, indices, region_positions))
+        site_positions = site_positions[~np.isin(site_positions, self.__get_site_positions(ignore_site_ids))]
+        return self.site_ids[site_positions].tolist()
 
     def get_region_id(self, site_id):
         '''
@@ -219,56 +504,695 @@ class EstimationData(object):
 
             :param site_id: (str) site ID
 
-            :return: (str) the region ID held in the 'region_id' column for the site object
+            :return: (str) the region ID (see site_region), empty string if the site is not in any region
         '''
         assert self.is_valid_site_id(site_id), 'Invalid site ID'
-        assert site_id in self._sites.index.tolist(), 'site_id not in list of available sites'
+        assert site_id in self._sites.index, 'site_id not in list of available sites'
+
+        region_position = self.site_region[self._sites.index.get_loc(site_id)]
+        return self.region_ids[region_position] if region_position >= 0 else ''
+
+
+    def with_actuals(self, actuals, trusted=False):
+        '''
+            Make estimation data for other actuals (e.g. the next time window of a long series of readings) with the
+            same sites and regions, sharing the topology (sites within regions, neighbours and distances) instead of
+            recalculating it. Only the new actuals are checked.
 
-        return self._sites.loc[[site_id]]['region_id'][0]
+            :param actuals: pandas.DataFrame of readings, with 'timestamp', 'site_id' and measurement columns (as the
+                            actuals given to the constructor, and like them possibly used without copying, so not to
+                            be changed afterwards)
+            :param trusted: (bool) the actuals have already been checked, so skip checking them (see the constructor)
 
+            :return: new instance of EstimationData
+        '''
+        if not trusted:
+            self.__check_new_actuals(actuals)
+            assert len(list(actuals.columns)) > 2, "There are no measurement value columns in the actuals dataframe."
 
-    def __get_region_sites(self, region):
-        return self._sites[self._sites.geometry.within(region['geometry'])].index.tolist()
+        estimation_data = copy.copy(self)
+        estimation_data.__set_actuals(actuals)
+        return estimation_data
 
-    def __set_region_sites(self):
+    def append_actuals(self, actuals, replace=False):
         '''
-            Find all of the sites within each region and add to a 'sites' column in self.regions -
-            as comma-delimited string of site ids.
+            Add new readings to the actuals, checking only the new readings. The topology (sites within regions,
+            neighbours and distances) is left untouched, the timestamps are extended with any new timestamps and
+            cached aggregates are updated from the new readings only. Appended readings follow the existing
+            readings of the same timestamp.
+
+            :param actuals: pandas.DataFrame of new readings, with the columns of the actuals given to the
+                            constructor: 'timestamp', 'site_id' and measurement columns (measurement columns that are
+                            left out are null)
+            :param replace: (bool) the new readings are corrections: existing readings of the same site and timestamp
+                            as a new reading are removed (whole rows, so measurement columns left out of the new
+                            readings become null). Otherwise (default) the existing readings are kept.
 
             :return: No return value
         '''
+        self.__check_new_actuals(actuals)
+        new_columns = set(actuals.columns) - set(self._actuals.columns)
+        assert len(new_columns) == 0, "The actuals dataframe has columns that are not in the existing actuals: " + \
+                                      str(new_columns)
+
+        # Columns in the same order as the existing actuals, with site_id strings and measurement values numbers
+        actuals = actuals.reindex(columns=self._actuals.columns)
+        actuals['site_id'] = actuals['site_id'].astype(str)
+        for column in actuals.columns[2:]:
+            actuals[column] = pd.to_numeric(actuals[column])
+        site_codes = self._sites.index.get_indexer(actuals['site_id'])
+
         if self.verbose > 0:
-            print('\ngetting all sites for each region...')
+            print('\nappending {} actuals'.format(len(actuals.index)))
+
+        # Extend the timestamps, re-sorting them only if new timestamps come before existing timestamps
+        timestamps, timestamp_values, old_positions = self.__get_appended_timestamps(actuals['timestamp'])
+        timestamp_codes = timestamps.get_indexer(actuals['timestamp'])
+        existing_actuals = self._actuals
+        if self._compact:
+            # The timestamp categories of the existing and new actuals are the (extended) timestamps
+            actuals = self.__get_compact_actuals(actuals, list(actuals.columns))
+            actuals['timestamp'] = pd.Categorical.from_codes(timestamp_codes, categories=timestamps, ordered=True)
+            existing_codes = old_positions[existing_actuals['timestamp'].cat.codes.to_numpy()]
+            existing_actuals = existing_actuals.assign(
+                timestamp=pd.Categorical.from_codes(existing_codes, categories=timestamps, ordered=True))
+
+        # Rank the sites that first appear in the new actuals after the other sites
+        site_ranks = self._site_ranks.copy()
+        first_sites = pd.unique(site_codes)
+        first_sites = first_sites[site_ranks[first_sites] == len(site_ranks)]
+        site_ranks[first_sites] = np.arange(len(first_sites)) + (site_ranks < len(site_ranks)).sum()
+
+        # Find the existing readings replaced by the new readings (of the same site and timestamp)
+        indptr, indices = self._timestamp_sites
+        existing_timestamp_codes = np.repeat(old_positions, np.diff(indptr))
+        site_count = len(self._sites.index)
+        if replace:
+            replaced = np.isin(existing_timestamp_codes * site_count + indices,
+                               timestamp_codes * site_count + site_codes)
+        else:
+            replaced = np.zeros(len(indices), dtype=bool)
+
+        # Update the cached aggregate cubes (moving their rows to the new timestamp positions, and taking away the
+        # replaced readings)
+        aggregates = {}
+        for (measurement, by_site), (sums, counts) in self._aggregates.items():
+            new_sums, new_counts = self.__get_reading_aggregates(
+                timestamp_codes, site_codes, actuals[measurement].to_numpy(dtype=float), len(timestamps), by_site)
+            new_sums[old_positions] += sums
+            new_counts[old_positions] += counts
+            if replaced.any():
+                replaced_sums, replaced_counts = self.__get_reading_aggregates(
+                    existing_timestamp_codes[replaced], indices[replaced],
+                    existing_actuals[measurement].to_numpy(dtype=float)[replaced], len(timestamps), by_site)
+                new_sums -= replaced_sums
+                new_counts -= replaced_counts
+                # (No rounding error left in cells without readings)
+                new_sums[new_counts == 0] = 0
+            aggregates[(measurement, by_site)] = new_sums, new_counts
+
+        if replaced.any():
+            if self.verbose > 0:
+                print('replacing {} actuals'.format(replaced.sum()))
+            existing_actuals = existing_actuals.iloc[~replaced]
+            existing_timestamp_codes, indices = existing_timestamp_codes[~replaced], indices[~replaced]
+
+        # Append the readings, keeping the actuals in timestamp order
+        all_timestamp_codes = np.concatenate([existing_timestamp_codes, timestamp_codes])
+        all_site_codes = np.concatenate([indices, site_codes])
+        all_actuals = pd.concat([existing_actuals, actuals])
+        if (np.diff(all_timestamp_codes) < 0).any():
+            order = np.argsort(all_timestamp_codes, kind='stable')
+            all_actuals = all_actuals.iloc[order]
+            all_timestamp_codes, all_site_codes = all_timestamp_codes[order], all_site_codes[order]
+
+        self._actuals = all_actuals
+        self._timestamps = timestamps
+        self._timestamp_values = timestamp_values
+        self._timestamp_sites = _pairs_to_csr(all_timestamp_codes, all_site_codes, len(timestamps))
+        self._site_ranks = site_ranks
+        self._aggregates = aggregates
+        self._ignore_aggregates = None
+        self._version += 1
+
+    def __set_actuals(self, actuals):
+        '''
+            Set the actuals, indexed by timestamp: integer codes of the timestamp and site of each reading, with the
+            readings stored in timestamp order (keeping their order within each timestamp). Cached aggregates are
+            cleared.
 
-        for index, region in self.regions.iterrows():
-            sites = self.__get_region_sites(region)
-            sites_str = ",".join(str(x) for x in sites)
-            self.regions.at[index, "sites"] = sites_str
+            :param actuals: pandas.DataFrame of (checked) actuals
 
-            if self.verbose > 1:
-                print('set sites for region {}: {}'.format(index, sites_str))
+            :return: No return value
+        '''
+        # actuals: Make sure value columns at the end of column list, with site_id strings and measurement values
+        # numbers (only converting the columns that need it, and copying the actuals once at most)
+        cols = actuals.columns.tolist()
+        cols.insert(0, cols.pop(cols.index('site_id')))
+        cols.insert(0, cols.pop(cols.index('timestamp')))
+        if self._compact:
+            actuals = self.__get_compact_actuals(actuals, cols)
+        else:
+            converted = {}
+            if pd.api.types.infer_dtype(actuals['site_id'], skipna=False) != 'string':
+                converted['site_id'] = actuals['site_id'].astype(str)
+            for column in cols[2:]:
+                if not pd.api.types.is_numeric_dtype(actuals[column]):
+                    converted[column] = pd.to_numeric(actuals[column])
+            if converted or cols != actuals.columns.tolist():
+                actuals = pd.DataFrame({column: converted.get(column, actuals[column]) for column in cols})
+
+        timestamps, timestamp_values = self.__get_timestamp_index(actuals['timestamp'])
+        timestamp_codes = timestamps.get_indexer(actuals['timestamp'])
+        if self._compact:
+            # Site categories are the sites, so the codes are the site positions
+            site_codes = actuals['site_id'].cat.codes.to_numpy(dtype=np.int64)
+            actuals['timestamp'] = pd.Categorical.from_codes(timestamp_codes, categories=timestamps, ordered=True)
+        else:
+            site_codes = self._sites.index.get_indexer(actuals['site_id'])
+        # Rank the sites by first appearance in the actuals, as given
+        site_ranks = np.full(len(self._sites.index), len(self._sites.index), dtype=np.int64)
+        first_sites = pd.unique(site_codes)
+        site_ranks[first_sites] = np.arange(len(first_sites))
+        if (np.diff(timestamp_codes) < 0).any():
+            order = np.argsort(timestamp_codes, kind='stable')
+            actuals = actuals.iloc[order]
+            timestamp_codes, site_codes = timestamp_codes[order], site_codes[order]
+
+        self._actuals = actuals
+        self._timestamps = timestamps
+        self._timestamp_values = timestamp_values
+        self._timestamp_sites = _pairs_to_csr(timestamp_codes, site_codes, len(timestamps))
+        self._site_ranks = site_ranks
+        self._aggregates = {}
+        self._ignore_aggregates = None
+
+    def __get_compact_actuals(self, actuals, cols):
+        '''
+            Make a compact copy of actuals (see the compact parameter of the constructor): site_id as categorical
+            (categories: the sites) and float32 measurement values. Timestamps are left to the caller.
+
+            :param actuals: pandas.DataFrame of (checked) actuals
+            :param cols: (list of str) the actuals columns: 'timestamp', 'site_id' then the measurements
+
+            :return: new pandas.DataFrame
+        '''
+        site_ids = actuals['site_id']
+        if pd.api.types.infer_dtype(site_ids, skipna=False) == 'string':
+            site_codes = self._sites.index.get_indexer(site_ids)
+        elif isinstance(site_ids.dtype, pd.CategoricalDtype):
+            site_codes = np.where(site_ids.cat.codes.to_numpy() < 0, -1,
+                                  self._sites.index.get_indexer(site_ids.cat.categories.astype(str))[
+                                      site_ids.cat.codes.to_numpy()])
+        else:
+            site_codes = self._sites.index.get_indexer(site_ids.astype(str))
+
+        compact = {'timestamp': actuals['timestamp'],
+                   'site_id': pd.Categorical.from_codes(site_codes, categories=self._sites.index)}
+        for column in cols[2:]:
+            compact[column] = pd.to_numeric(actuals[column]).to_numpy(dtype=np.float32)
+        return pd.DataFrame(compact, index=actuals.index)
+
+    def __check_new_actuals(self, actuals):
+        '''
+            Check actuals given after construction (see with_actuals and append_actuals): the timestamp and site_id
+            columns, numeric measurement columns and that each site_id is in the sites
+
+            :param actuals: pandas.DataFrame of actuals
+
+            :return: No return value (raises AssertionError for invalid actuals)
+        '''
+        assert 'timestamp' in list(actuals.columns), "There is no timestamp column in actuals dataframe"
+        assert 'site_id' in list(actuals.columns), "There is no site_id column in actuals dataframe"
+        self.__check_measurement_columns(actuals)
+
+        # Check that each site_id value is present in the sites dataframe index.
+        site_ids = actuals['site_id'].astype(str)
+        error_sites = set(site_ids.values[self._sites.index.get_indexer(site_ids) < 0])
+        assert len(error_sites) == 0, \
+            "Each site ID must match a site_id in sites. Error site IDs: " + str(error_sites)
+
+    @staticmethod
+    def __check_measurement_columns(actuals):
+        '''
+            Check that the measurement columns of actuals have either numeric or null data
+
+            :param actuals: pandas.DataFrame of actuals
+
+            :return: No return value (raises AssertionError for non-numeric values)
+        '''
+        for column in list(actuals.columns):
+            if column not in ['timestamp', 'site_id']:
+                # Check measurement does not contain numeric (nulls are OK)
+                if not _is_numeric(actuals[column]):
+                    raise AssertionError(
+                        "actuals['" + column + "'] column contains non-numeric values (null values are accepted).")
+
+    def __get_appended_timestamps(self, timestamps):
+        '''
+            Extend the timestamps (see timestamps) with the timestamps of new actuals. The new timestamps are sorted
+            on their own and appended when they all come after the existing timestamps, otherwise all of the
+            timestamps are sorted again.
+
+            :param timestamps: (pandas.Series) the timestamp of each new actual reading
+
+            :return: tuple (pandas.Index of timestamps, pandas.DatetimeIndex of their dates/times or None, numpy int
+                     array of the new positions of the existing timestamps)
+        '''
+        added = pd.Index(pd.unique(timestamps))
+        added = added[~added.isin(self._timestamps)]
+        if len(added) == 0:
+            return self._timestamps, self._timestamp_values, np.arange(len(self._timestamps))
+
+        added, added_values = self.__get_timestamp_index(added)
+        try:
+            if self._timestamp_values is not None and added_values is not None:
+                appended = len(self._timestamps) == 0 or added_values[0] > self._timestamp_values[-1]
+            else:
+                appended = self._timestamp_values is None and added_values is None and \
+                    (len(self._timestamps) == 0 or added[0] > self._timestamps[-1])
+        except TypeError:
+            appended = False
+
+        if appended:
+            return self._timestamps.append(added), \
+                None if added_values is None else self._timestamp_values.append(added_values), \
+                np.arange(len(self._timestamps))
+
+        all_timestamps, timestamp_values = self.__get_timestamp_index(self._timestamps.append(added))
+        return all_timestamps, timestamp_values, all_timestamps.get_indexer(self._timestamps)
+
+    @staticmethod
+    def __get_timestamp_index(timestamps):
+        '''
+            Find the unique timestamps of the actuals, in chronological order if they can all be parsed as
+            dates/times (with identical dates/times in alphabetical order), otherwise in alphabetical order
+
+            :param timestamps: (pandas.Series) the timestamp of each actual reading
+
+            :return: tuple (pandas.Index of timestamps, pandas.DatetimeIndex of their dates/times or None)
+        '''
+        timestamps = pd.Index(sorted(pd.unique(timestamps)))
+        try:
+            timestamp_values = pd.DatetimeIndex(pd.to_datetime(timestamps))
+        except (ValueError, TypeError, OverflowError):
+            return timestamps, None
+
+        order = np.argsort(timestamp_values.values, kind='stable')
+        return timestamps[order], timestamp_values[order]
+
+    def __get_site_positions(self, site_ids):
+        '''
+            Find the positions in self.sites of a list of site IDs
+
+            :param site_ids: (list of str) site IDs
+
+            :return: numpy int array of the positions of the site IDs that are in self.sites
+        '''
+        site_positions = self.get_site_positions(site_ids)
+        return site_positions[site_positions >= 0]
+
+    def __get_timestamp_bound(self, timestamp, side):
+        '''
+            Find the position of a timestamp in self.timestamps (which need not be one of them), by date/time if the
+            timestamps are dates/times
+
+            :param timestamp: (str) a timestamp
+            :param side: 'left' for the position of the first timestamp at or after it, 'right' for the position
+                         after the last timestamp at or before it
+
+            :return: (int) position in self.timestamps
+        '''
+        if self._timestamp_values is not None:
+            try:
+                return self._timestamp_values.searchsorted(pd.Timestamp(timestamp), side=side)
+            except (ValueError, TypeError):
+                pass
+        return self._timestamps.searchsorted(timestamp, side=side)
+
+    def __get_topology_key(self, with_sites=True):
+        '''
+            Hash the region geometries and IDs (and the site coordinates and IDs), to identify cached topology
+
+            :param with_sites: (bool) whether the topology depends on the sites as well as the regions
+
+            :return: (str) hex digest
+        '''
+        if with_sites not in self._topology_keys:
+            digest = hashlib.sha256()
+            digest.update('\0'.join(str(region_id) for region_id in self._regions.index).encode())
+            for wkb in shapely.to_wkb(self._regions.geometry.values):
+                digest.update(len(wkb).to_bytes(8, 'little'))
+                digest.update(wkb)
+            if with_sites:
+                digest.update(b'\1' + '\0'.join(self._sites.index).encode())
+                digest.update(np.ascontiguousarray(self._sites.geometry.x.values, dtype=np.float64).tobytes())
+                digest.update(np.ascontiguousarray(self._sites.geometry.y.values, dtype=np.float64).tobytes())
+            self._topology_keys[with_sites] = digest.hexdigest()
+        return self._topology_keys[with_sites]
+
+    def __load_topology(self, name, calculate, with_sites=True):
+        '''
+            Load topology arrays from the cache directory (if there is one), or calculate them and save them to the
+            cache directory
+
+            :param name: (str) name of the topology
+            :param calculate: function (with no parameters) that calculates the topology, returning a tuple of
+                              numpy arrays
+            :param with_sites: (bool) whether the topology depends on the sites as well as the regions
+
+            :return: tuple of numpy arrays
+        '''
+        if self._cache_dir is None:
+            return calculate()
+
+        filespec = os.path.join(self._cache_dir, '{}_{}.npz'.format(name, self.__get_topology_key(with_sites)))
+        if os.path.exists(filespec):
+            try:
+                with np.load(filespec) as arrays:
+                    result = tuple(arrays['arr_{}'.format(index)] for index in range(len(arrays.files)))
+                if self.verbose > 0:
+                    print('\nloaded {} from {}'.format(name, filespec))
+                return result
+            except (OSError, ValueError, KeyError) as err:
+                print('Warning: could not load {} from cache ({}), so recalculating'.format(name, err))
+
+        result = calculate()
+        file = None
+        try:
+            # Write to a temporary file first, so that other processes never load a partly written file
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self._cache_dir, suffix='.npz', delete=False) as file:
+                np.savez(file, *result)
+            os.replace(file.name, filespec)
+        except OSError as err:
+            print('Warning: could not save {} to cache: {}'.format(name, err))
+            if file is not None and os.path.exists(file.name):
+                os.remove(file.name)
+        return result
+
+    def __get_site_region_pairs(self):
+        '''
+            Find every (site, region) pair where the site lies within the region, using a spatial join
+            (bounding box spatial index query followed by the exact 'within' predicate).
 
-    def __set_site_region(self):
+            :return: tuple of two integer numpy arrays (site positions, region positions),
+                     sorted by region position and then site position
         '''
-            Find all of the region ids for each site and add to a 'region_id' column in self._sites
-            Adds None if not found.
+        gdf_sites = gpd.GeoDataFrame(geometry=self._sites.geometry.values)
+        gdf_regions = gpd.GeoDataFrame(geometry=self._regions.geometry.values)
+        df_pairs = gpd.sjoin(gdf_sites, gdf_regions, how='inner', predicate='within')
+
+        site_positions = df_pairs.index.values.astype(np.int64)
+        region_positions = df_pairs['index_right'].values.astype(np.int64)
+        order = np.lexsort((site_positions, region_positions))
+        return site_positions[order], region_positions[order]
+
+    def __set_site_region_relationships(self):
+        '''
+            Find the region of each site and all of the sites within each region, in a single spatial join.
+            Adds a 'region_id' column to self._sites (empty string if the site is not in any region) and a
+            'sites' column to self._regions (comma-delimited string of site ids).
+            Where regions overlap, a site is given the region_id of the last region (in regions order)
+            that contains it.
 
             :return: No return value
         '''
         if self.verbose > 0:
-            print('\ngetting region for each site...')
+            print('\ngetting region for each site and all sites for each region...')
 
-        # Create new column with empty string as values
-        self._sites["region_id"] = ""
+        site_positions, region_positions = self.__load_topology('site_region_pairs', self.__get_site_region_pairs)
+        site_ids = self._sites.index.values
+        region_ids = self._regions.index.values
 
-        for index, region in self.regions.iterrows():
-            self._sites = self._sites.assign(
-                **{'region_id': np.where(self._sites.within(region.geometry), index, self._sites['region_id'])}
-            )
+        # Site -> region: the last region containing each site
+        site_region = np.full(len(site_ids), -1, dtype=np.int64)
+        np.maximum.at(site_region, site_positions, region_positions)
+        self._site_region = site_region
+        self._sites['region_id'] = np.where(site_region >= 0, region_ids[site_region], '')
 
         if self.verbose > 0:
             print('regions: \n {}'.format(self._sites['region_id']))
 
+        # Region -> sites: pairs are sorted by region, so split them into one block per region
+        self._region_sites = _pairs_to_csr(region_positions, site_positions, len(region_ids))
+        indptr, indices = self._region_sites
+        region_sites = []
+        for index, region_id in enumerate(region_ids):
+            sites_str = ",".join(str(x) for x in site_ids[indices[indptr[index]:indptr[index + 1]]])
+            region_sites.append(sites_str)
+
+            if self.verbose > 1:
+                print('set sites for region {}: {}'.format(region_id, sites_str))
+
+        self._regions['sites'] = region_sites
+
+    def __get_region_neighbours(self):
+        '''
+            Find all of the neighbours (touching regions) of each region, using a spatial index query
+            (bounding box candidates) followed by the exact 'touches' predicate on prepared geometries.
+
+            :return: tuple of numpy int arrays (indptr, indices): CSR adjacency of region positions
+        '''
+        if self.verbose > 0:
+            print('\ngetting all region neighbours')
+
+        gdf_regions = gpd.GeoDataFrame(geometry=self._regions.geometry.values)
+        df_pairs = gpd.sjoin(gdf_regions, gdf_regions, how='inner', predicate='touches')
+
+        region_positions = df_pairs.index.values.astype(np.int64)
+        neighbour_positions = df_pairs['index_right'].values.astype(np.int64)
+        not_self = region_positions != neighbour_positions
+        region_positions, neighbour_positions = region_positions[not_self], neighbour_positions[not_self]
+        order = np.lexsort((neighbour_positions, region_positions))
+
+        return _pairs_to_csr(region_positions[order], neighbour_positions[order], len(self._regions.index))
+
+    def __get_region_site_distances(self):
+        '''
+            Calculate the distance from each region to each site (see region_site_distances)
+
+            :return: tuple of numpy arrays (distances, orders), each of shape (regions, sites)
+        '''
+        if self.verbose > 0:
+            print('\ncalculating distances from each region to each site')
+
+        distances = np.empty((len(self._regions.index), len(self._sites.index)))
+        for position, geometry in enumerate(self._regions.geometry.values):
+            distances[position] = self._sites.geometry.distance(geometry).values
+
+        return distances, np.argsort(distances, axis=1, kind='stable')
+
+    def __get_site_groups(self):
+        '''
+            Group the sites by the set of regions that they are within (see site_groups)
+
+            :return: tuple of numpy int arrays (group_indptr, group_regions, site_groups)
+        '''
+        indptr, indices = self.region_sites
+        region_positions = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+        site_regions = [[] for _ in range(len(self._sites.index))]
+        for site_position, region_position in zip(indices, region_positions):
+            site_regions[site_position].append(region_position)
+
+        groups = {}
+        site_groups = np.array([groups.setdefault(tuple(regions), len(groups)) for regions in site_regions],
+                               dtype=np.int64)
+        group_indptr = np.zeros(len(groups) + 1, dtype=np.int64)
+        group_indptr[1:] = np.cumsum([len(regions) for regions in groups])
+        group_regions = np.array([region for regions in groups for region in regions], dtype=np.int64)
+
+        return group_indptr, group_regions, site_groups
+
+    def __get_aggregates(self, measurement, ignore_site_ids=[], by_site=False):
+        '''
+            Get the aggregate cube of a measurement: the sum and count of the (non-null) site readings for each
+            timestamp (in self.timestamps) and site group (see site_groups), or each site.
+            Cubes are built on first use and cached (for each measurement with no ignored sites, and for the most
+            recently used set of ignored sites).
+
+            :param measurement: (str) the measurement to be aggregated
+            :param ignore_site_ids: (list of str) site_ids to be left out of the aggregates
+            :param by_site: (bool) aggregate by site (True) or by site group (False)
+
+            :return: tuple of numpy arrays (sums, counts), each of shape (timestamps, site groups or sites)
+        '''
+        ignore_site_ids = frozenset(ignore_site_ids)
+        if len(ignore_site_ids) == 0 and (measurement, by_site) in self._aggregates:
+            return self._aggregates[(measurement, by_site)]
+        if self._ignore_aggregates is not None and \
+                self._ignore_aggregates[0] == (measurement, by_site, ignore_site_ids):
+            return self._ignore_aggregates[1]
+
+        if self.verbose > 0:
+            print('\nbuilding aggregates for measurement {} (ignoring sites: {})'.format(measurement,
+                                                                                       set(ignore_site_ids)))
+
+        indptr, site_positions = self._timestamp_sites
+        timestamp_positions = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        values = self._actuals[measurement].to_numpy(dtype=float)
+        if len(ignore_site_ids) > 0:
+            values = np.where(np.isin(site_positions, self.__get_site_positions(ignore_site_ids)), np.nan, values)
+        sums, counts = self.__get_reading_aggregates(timestamp_positions, site_positions, values,
+                                                     len(self.timestamps), by_site)
+
+        if len(ignore_site_ids) == 0:
+            self._aggregates[(measurement, by_site)] = sums, counts
+        else:
+            self._ignore_aggregates = (measurement, by_site, ignore_site_ids), (sums, counts)
+        return sums, counts
+
+    def __get_reading_aggregates(self, timestamp_positions, site_positions, values, timestamp_count, by_site=False):
+        '''
+            Sum and count (non-null) readings by timestamp and site group (see site_groups), or by timestamp and site
+
+            :param timestamp_positions: (numpy int array) the timestamp (position in self.timestamps) of each reading
+            :param site_positions: (numpy int array) the site (position in self.sites) of each reading
+            :param values: (numpy float array) the value of each reading (nan for null)
+            :param timestamp_count: (int) number of timestamps
+            :param by_site: (bool) aggregate by site (True) or by site group (False)
+
+            :return: tuple of numpy arrays (sums, counts), each of shape (timestamps, site groups or sites)
+        '''
+        if by_site:
+            columns = site_positions
+            column_count = len(self._sites.index)
+        else:
+            _, _, site_groups = self.site_groups
+            columns = site_groups[site_positions]
+            column_count = site_groups.max() + 1 if len(site_groups) > 0 else 0
+
+        keep = ~np.isnan(values)
+        cells = timestamp_positions[keep] * column_count + columns[keep]
+        shape = (timestamp_count, column_count)
+        # (bincount gives integer sums if there are no readings)
+        sums = np.bincount(cells, weights=values[keep], minlength=shape[0] * shape[1]).astype(float, copy=False)
+        counts = np.bincount(cells, minlength=shape[0] * shape[1])
+        return sums.reshape(shape), counts.reshape(shape)
+
+    def __get_timestamp_aggregates(self, aggregates, timestamps=None):
+        '''
+            Select the rows of an aggregate cube for a list of timestamps
+
+            :param aggregates: tuple of numpy arrays (sums, counts), each of shape (self.timestamps, columns)
+            :param timestamps: (list of str) timestamps required (None for all timestamps in self.timestamps).
+                               Timestamps that are not in the actuals have zero counts.
+
+            :return: tuple of numpy arrays (sums, counts), each of shape (timestamps, columns)
+        '''
+        sums, counts = aggregates
+        if timestamps is None:
+            return sums, counts
+
+        rows = self.timestamps.get_indexer(timestamps)
+        found = rows >= 0
+        if found.all():
+            return sums[rows], counts[rows]
+        timestamp_sums = np.zeros((len(rows), sums.shape[1]))
+        timestamp_counts = np.zeros((len(rows), counts.shape[1]), dtype=counts.dtype)
+        timestamp_sums[found] = sums[rows[found]]
+        timestamp_counts[found] = counts[rows[found]]
+        return timestamp_sums, timestamp_counts
+
+    def get_group_aggregates(self, measurement, timestamps=None, ignore_site_ids=[]):
+        '''
+            Get the sum and count of the (non-null) site readings of a measurement for each timestamp and
+            site group (see site_groups), from the cached aggregate cube of the measurement.
+
+            :param measurement: (str) the measurement being recorded in the site data-points
+            :param timestamps: (list of str) timestamps required (None for all timestamps in self.timestamps).
+                               Timestamps that are not in the actuals have zero counts.
+            :param ignore_site_ids: (list of str) site_ids to be left out of the aggregates
+
+            :return: tuple of numpy arrays (sums, counts), each of shape (timestamps, site groups)
+        '''
+        return self.__get_timestamp_aggregates(
+            self.__get_aggregates(measurement, [] if ignore_site_ids is None else ignore_site_ids), timestamps)
+
+    def get_site_aggregates(self, measurement, timestamps=None, ignore_site_ids=[]):
+        '''
+            Get the sum and count of the (non-null) readings of a measurement for each timestamp and site
+            (in sites order), from the cached (by site) aggregate cube of the measurement.
+
+            :param measurement: (str) the measurement being recorded in the site data-points
+            :param timestamps: (list of str) timestamps required (None for all timestamps in self.timestamps).
+                               Timestamps that are not in the actuals have zero counts.
+            :param ignore_site_ids: (list of str) site_ids to be left out of the aggregates
+
+            :return: tuple of numpy arrays (sums, counts), each of shape (timestamps, sites)
+        '''
+        return self.__get_timestamp_aggregates(
+            self.__get_aggregates(measurement, [] if ignore_site_ids is None else ignore_site_ids, by_site=True),
+            timestamps)
+
+    def get_timestamp_site_readings(self, measurement, timestamp, ignore_site_ids=[]):
+        '''
+            Get the sum and count of the (non-null) readings of a measurement at a single timestamp, for the sites
+            that have readings only (so memory is proportional to the readings, not to the number of sites).
+
+            :param measurement: (str) the measurement being recorded in the site data-points
+            :param timestamp: (str) the timestamp of the readings
+            :param ignore_site_ids: (list of str) site_ids to be left out
+
+            :return: tuple of numpy arrays (site_positions, sums, counts), site_positions being the (sorted) positions
+                     in self.sites of the sites with readings
+        '''
+        # The readings of the timestamp are a single block of rows of the (timestamp ordered) actuals
+        indptr, indices = self._timestamp_sites
+        if timestamp in self._timestamps:
+            position = self._timestamps.get_loc(timestamp)
+            rows = slice(indptr[position], indptr[position + 1])
+        else:
+            rows = slice(0, 0)
+
+        values = self._actuals[measurement].iloc[rows].to_numpy(dtype=float)
+        keep = ~np.isnan(values)
+        if ignore_site_ids is not None and len(ignore_site_ids) > 0:
+            keep &= ~np.isin(indices[rows], self.__get_site_positions(ignore_site_ids))
+
+        site_positions, site_codes = np.unique(indices[rows][keep], return_inverse=True)
+        values = values[keep]
+        sums = np.bincount(site_codes, weights=values, minlength=len(site_positions))
+        counts = np.bincount(site_codes, minlength=len(site_positions))
+        return site_positions, sums, counts
+
+    def get_region_aggregates(self, measurement, region_ids=None, start_timestamp=None, end_timestamp=None,
+                              ignore_site_ids=[]):
+        '''
+            Get the sum and count of the (non-null) site readings of a measurement for the sites within a set of
+            regions, for each timestamp in a range. Each site is counted once, even if it is within more than one
+            of the regions.
+
+            :param measurement: (str) the measurement being recorded in the site data-points
+            :param region_ids: (list of str) region IDs (None for all sites, including those not in any region)
+            :param start_timestamp: (str) first timestamp of the range (None for the first timestamp)
+            :param end_timestamp: (str) last timestamp of the range, inclusive (None for the last timestamp)
+            :param ignore_site_ids: (list of str) site_ids to be left out of the aggregates
+
+            :return: pandas.DataFrame indexed by 'timestamp', with columns 'sum' and 'count'
+        '''
+        sums, counts = self.get_group_aggregates(measurement, ignore_site_ids=ignore_site_ids)
+
+        start = 0 if start_timestamp is None else self.__get_timestamp_bound(start_timestamp, side='left')
+        end = len(self.timestamps) if end_timestamp is None else \
+            self.__get_timestamp_bound(end_timestamp, side='right')
+
+        if region_ids is None:
+            columns = slice(None)
+        else:
+            # Groups with any of their regions in the region set
+            group_indptr, group_regions, _ = self.site_groups
+            region_positions = self.get_region_positions(region_ids)
+            group_ids = np.repeat(np.arange(len(group_indptr) - 1), np.diff(group_indptr))
+            columns = np.unique(group_ids[np.isin(group_regions, region_positions[region_positions >= 0])])
+
+        df_result = pd.DataFrame({'sum': sums[start:end][:, columns].sum(axis=1),
+                                  'count': counts[start:end][:, columns].sum(axis=1)},
+                                 index=self.timestamps[start:end])
+        df_result.index.name = 'timestamp'
+        return df_result
+
     def site_datapoint_count(self, measurement, timestamp, region_ids=[], ignore_site_ids=[]):
         '''
         Find the number of site datapoints for this measurement, timestamp and (optional) regions combination
@@ -284,20 +1208,15 @@ class EstimationData(object):
         if ignore_site_ids is None:
             ignore_site_ids = []
 
-        sites = self.actuals.loc[(self.actuals['timestamp'] == timestamp) &
-                                 (self.actuals[measurement].notna()) &
-                                 (~self.actuals['site_id'].isin(ignore_site_ids))]
-
-        if sites is None or len(sites.index) == 0:
+        if timestamp not in self.timestamps:
             return 0
 
-        sites = sites['site_id'].tolist()
-
-        region_sites = []
-        for region_id in region_ids:
-            region_sites.extend(self.regions.loc[region_id]['sites'])
+        # Distinct sites with (non-null) readings, however many readings each site has
+        site_positions, _, _ = self.get_timestamp_site_readings(measurement, timestamp, ignore_site_ids)
+        if len(region_ids) == 0:
+            return len(site_positions)
 
-        if len(region_ids) > 0:
-            return len(set(sites) & set(region_sites))
-        else:
-            return len(set(sites))
+        region_positions = self.get_region_positions(region_ids)
+        assert (region_positions >= 0).all(), 'region_id is not in list of regions'
+        indptr, indices = self.region_sites
+        return int(np.isin(site_positions, _csr_gather(indptr, indices, region_positions)).sum())
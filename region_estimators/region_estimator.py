@@ -1,5 +1,7 @@
 from abc import ABCMeta, abstractmethod
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
 import json
 import time
@@ -19,6 +21,41 @@ def log_time(func):
 
     return wrapper
 
+
+def _get_index_columns(measurements, region_ids, timestamps):
+    """  Make the index columns of results for every measurement, region and timestamp
+
+        :param measurements: measurements (list of str)
+        :param region_ids: region identifiers (list of str)
+        :param timestamps: timestamp identifiers (sorted list of str)
+
+        :return: dict of numpy (object) arrays 'measurement', 'region_id' and 'timestamp', in measurement, region then
+                 timestamp order
+    """
+    return {'measurement': np.repeat(np.asarray(measurements, dtype=object), len(region_ids) * len(timestamps)),
+            'region_id': np.tile(np.repeat(np.asarray(region_ids, dtype=object), len(timestamps)), len(measurements)),
+            'timestamp': np.tile(np.asarray(timestamps, dtype=object), len(measurements) * len(region_ids))}
+
+
+# The estimator of a pool worker process, set once by the pool initializer so that tasks only carry ids
+_worker_estimator = None
+
+
+def _init_worker(estimator):
+    """  Pool initializer: keep the estimator (with its EstimationData) in the worker process, for all its tasks
+
+        :param estimator: (RegionEstimator) the estimator making the estimations
+    """
+    global _worker_estimator
+    _worker_estimator = estimator
+
+
+def _get_worker_estimates(task):
+    """  Pool task: find the estimations of a task with the worker's estimator. See RegionEstimator._get_task_estimates
+    """
+    return _worker_estimator._get_task_estimates(task)
+
+
 class RegionEstimator(object):
     """
         Abstract class, parent of region estimators (each implementing a different estimation method).
@@ -29,10 +66,14 @@ class RegionEstimator(object):
     VERBOSE_DEFAULT = 0
     VERBOSE_MAX = 2
     MAX_NUM_PROCESSORS = 1
+    CHUNK_SIZE_DEFAULT = None
+    BACKENDS = ('serial', 'thread', 'process', 'vectorized')
+    # The items of the extra_data of estimates (see get_estimate), as result column names and their dtypes
+    EXTRA_DATA_COLUMNS = {}
 
     #@log_time
     def __init__(self, estimation_data=None, verbose=VERBOSE_DEFAULT, max_processors=MAX_NUM_PROCESSORS,
-                 progress_callback=None):
+                 progress_callback=None, backend=None):
         """
         Initialise instance of the RegionEstimator class.
 
@@ -45,6 +86,11 @@ class RegionEstimator(object):
 
             progress_callback: (callable) Handler function for delegating progress updates
 
+            backend: (str) How estimations are calculated (see BACKENDS): 'serial' (in this process), 'thread'
+                (pool of max_processors threads), 'process' (pool of max_processors worker processes) or
+                'vectorized' (all regions and timestamps at once with array operations, where the estimator supports
+                it). None (default) for 'serial' if max_processors is 1, otherwise 'process'
+
         Returns:
             Initialised instance of subclass of RegionEstimator
 
@@ -52,6 +98,11 @@ class RegionEstimator(object):
 
         assert type(self) != RegionEstimator, 'RegionEstimator Cannot be instantiated directly'
 
+        # Persistent pool of worker processes (see start), restarted when outdated by changes to the estimator
+        self._pool = None
+        self._pool_outdated = False
+        self._pool_data_version = None
+
         # Check and set verbose
         self.verbose = verbose
 
@@ -61,15 +112,151 @@ class RegionEstimator(object):
         # Set EstimationData
         self._estimation_data = estimation_data
 
+        # Set estimation backend
+        self.backend = backend
+
+        # Set number of timestamps per pool task
+        self.chunk_size = RegionEstimator.CHUNK_SIZE_DEFAULT
+
         # Set progress callback function, for publishing progress
         assert progress_callback is None or callable(progress_callback) is True, \
             "The progress_callback must be a callable function. {} is not callable".format(str(progress_callback))
         self._progress_callback = progress_callback
 
+    def __getstate__(self):
+        # The worker pool cannot be pickled (and is not needed by the workers themselves)
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self, backend=None):
+        """  Start a persistent pool of (max_processors) worker processes, each initialized with the estimator and its
+             data, to be re-used by every get_estimations call until close() is called.
+             The estimator can also be used as a context manager:  with estimator: ...
+             Only used by the 'process' backend (see backend); does nothing for other backends.
+
+            :param backend: (str) the backend the pool is for (e.g. a backend given to get_estimations).
+                            Default: None (self.backend)
+
+            :return: the estimator
+        """
+        if backend is None:
+            backend = self.backend
+        if self._pool is None and backend == 'process':
+            if self.verbose > 0:
+                print('Starting pool of {} worker processes'.format(self.max_processors))
+            self._prepare_workers()
+            self._pool = multiprocessing.Pool(self.max_processors, initializer=_init_worker, initargs=(self,))
+            self._pool_outdated = False
+            self._pool_data_version = self.__get_data_version()
+        return self
+
+    def close(self):
+        """  Stop the persistent pool of worker processes (if started)
+
+            :return: No return value
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __get_data_version(self):
+        """  The version of the estimation data (see EstimationData.version), None if there is no estimation data """
+        return getattr(self._estimation_data, 'version', None)
+
+    def _invalidate_workers(self):
+        """  Mark the persistent pool's workers (if started) as outdated after a change to the estimator, so the pool
+             is restarted (with the current estimator) before the next estimations
+
+            :return: No return value
+        """
+        if getattr(self, '_pool', None) is not None:
+            self._pool_outdated = True
+
+    def _prepare_workers(self):
+        """  Calculate the data that all estimation tasks share, before the estimator is given to worker processes, so
+             that it is calculated once rather than by every worker. Estimators with such data (calculated on first
+             use) override this; by default there is none.
+
+            :return: No return value
+        """
+        pass
+
     @abstractmethod
     def get_estimate(self, measurement, timestamp, region_id, ignore_site_ids=[]):
         raise NotImplementedError("Must override get_estimate")
 
+    def _get_vectorized_estimations(self, measurements, region_ids, timestamps, ignore_site_ids=[]):
+        """  Find estimations for all of the measurements, regions and timestamps at once, using array operations.
+             Subclasses that support vectorized estimation override this method.
+
+            :param measurements: measurements to be estimated (list of str)
+            :param region_ids: region identifiers (list of str)
+            :param timestamps: timestamp identifiers (sorted list of str)
+            :param ignore_site_ids: site id(s) to be ignored during the estimations. Default=[]
+
+            :return: dict of result columns (one item per measurement, region and timestamp, in measurement, region
+                        then timestamp order): 'measurement', 'region_id', 'timestamp', (estimated) 'value'
+                        (nan where there is no estimate) and the extra data columns (see EXTRA_DATA_COLUMNS)
+        """
+        raise NotImplementedError("{} does not support vectorized estimations".format(type(self).__name__))
+
+    def _get_held_out_estimates(self, measurement, timestamps, site_position, region_positions, rows):
+        """  Find the estimations of the regions containing a site, with the site held out (ignored), at the timestamps
+             at which the site has readings. For leave-one-out cross-validation (see get_leave_one_out_estimates).
+             This default makes each estimate with get_estimate; subclasses can override it with a faster method.
+
+            :param measurement: measurement to be estimated (string, required)
+            :param timestamps: timestamp identifiers (sorted list of str, or None for all timestamps in the actuals)
+            :param site_position: (int) position of the held out site in self.sites
+            :param region_positions: (numpy int array) positions of the regions containing the site in self.regions
+            :param rows: (numpy int array) positions in timestamps of the timestamps at which the site has readings
+
+            :return: numpy array of estimated values of shape (regions, rows) (nan where there is no estimate)
+        """
+        if timestamps is None:
+            timestamps = self.estimation_data.timestamps
+        ignore_site_ids = [self.sites.index[site_position]]
+
+        estimates = np.full((len(region_positions), len(rows)), np.nan)
+        for region_index, region_id in enumerate(self.regions.index[region_positions]):
+            for row_index, row in enumerate(rows):
+                value = self.get_estimate(measurement, timestamps[row], region_id, ignore_site_ids)[0]
+                if value is not None:
+                    estimates[region_index, row_index] = value
+        return estimates
+
+    def _get_affected_regions(self, measurement, timestamp, site_positions, ignore_site_ids=[]):
+        """  Find the regions whose estimate at a timestamp can change when the readings of some sites change (see
+                update_estimations). Estimators override this to rule out regions that cannot be affected; by
+                default every region can be affected.
+
+            :param measurement: (str) the measurement
+            :param timestamp: (str) the timestamp
+            :param site_positions: (numpy int array) positions (in self.sites) of the sites with changed readings
+            :param ignore_site_ids: site id(s) ignored during the estimations
+
+            :return: numpy bool array (one item per region, in regions order): True where the estimate can change
+        """
+        return np.ones(len(self.regions.index), dtype=bool)
+
+    def _get_extra_data_json(self, extra_data):
+        """  Convert extra data columns to the (json string) extra_data of each estimate, as returned by get_estimate
+
+            :param extra_data: pandas dataframe of the extra data columns (see EXTRA_DATA_COLUMNS)
+
+            :return: list of json strings, one per estimate
+        """
+        records = extra_data.astype(object).where(extra_data.notna(), None).to_dict('records')
+        return [json.dumps(record) for record in records]
+
     @property
     def estimation_data(self):
         return self._estimation_data
@@ -79,6 +266,7 @@ class RegionEstimator(object):
         assert estimation_data is None or isinstance(estimation_data, EstimationData), \
             "estimation_data must be an instance of type EstimationData"
         self._estimation_data = estimation_data
+        self._invalidate_workers()
 
     @property
     def sites(self):
@@ -108,6 +296,7 @@ class RegionEstimator(object):
                 RegionEstimator.VERBOSE_MAX, RegionEstimator.VERBOSE_MAX))
             verbose = RegionEstimator.VERBOSE_MAX
         self._verbose = verbose
+        self._invalidate_workers()
 
     @property
     def max_processors(self):
@@ -118,18 +307,46 @@ class RegionEstimator(object):
         assert isinstance(max_processors, int), "max_processors must be an integer."
         assert max_processors > 0, "max_processors must be greater than zero"
         self.__max_processors = max_processors
+        self._invalidate_workers()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            return 'serial' if self.max_processors == 1 else 'process'
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend=None):
+        assert backend is None or backend in RegionEstimator.BACKENDS, \
+            "backend must be one of {} (or None), not {}".format(RegionEstimator.BACKENDS, backend)
+        self._backend = backend
 
-    def _get_estimate_process(self, region_result, measurement, region_id, timestamp, ignore_site_ids=[]):
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    @chunk_size.setter
+    def chunk_size(self, chunk_size=CHUNK_SIZE_DEFAULT):
+        """  Set the number of timestamps of a region calculated by each worker process task
+
+                   :param chunk_size:
+                    the number of timestamps per task (integer, or None for all the timestamps of a region in one task,
+                    default=CHUNK_SIZE_DEFAULT)
+        """
+        assert chunk_size is None or isinstance(chunk_size, int), "chunk_size must be an integer or None."
+        assert chunk_size is None or chunk_size > 0, "chunk_size must be greater than zero"
+        self._chunk_size = chunk_size
+
+    def _get_estimate_process(self, measurement, region_id, timestamp, ignore_site_ids=[]):
         """  Find estimation for a single region and single timestamp. Worker function for multi-processing.
 
-            :region_result: estimation result. as multiprocessing is used must return result as parameter
             :param measurement: measurement to be estimated (string, required)
             :param region_id: region identifier (string, required)
             :param timestamp:  timestamp identifier (string, required)
             :param ignore_site_ids: site id(s) to be ignored during the estimations. Default=[]
 
-            :return: a dict with items 'region_id' and 'estimates (list). Estimates contains
-                        'timestamp', (estimated) 'value' and 'extra_data'
+            :return: a dict with items 'measurement', 'region_id', (estimated) 'value', 'extra_data' (dict)
+                        and 'timestamp', or None if the estimation failed
         """
         if self._progress_callback is not None:
             self._progress_callback(**{'status': 'Calculating estimate for region: {} and timestamp: {}'
@@ -137,104 +354,478 @@ class RegionEstimator(object):
                                        'percent_complete': None})
         try:
             region_result_estimate = self.get_estimate(measurement, timestamp, region_id, ignore_site_ids)
-            region_result.append({'measurement': measurement,
-                                  'region_id': region_id,
-                                  'value': region_result_estimate[0],
-                                  'extra_data': json.dumps(region_result_estimate[1]),
-                                  'timestamp': timestamp})
+            return {'measurement': measurement,
+                    'region_id': region_id,
+                    'value': region_result_estimate[0],
+                    'extra_data': region_result_estimate[1],
+                    'timestamp': timestamp}
         except Exception as err:
             print('Error estimating for measurement: {}; region: {}; timestamp: {} and ignore_sites: {}.\nError: {}'
                   .format(measurement, region_id, timestamp, ignore_site_ids, err))
+            return None
 
-    def _get_region_estimation(self, pool, region_result, measurement, region_id, timestamp=None, ignore_site_ids=[]):
-        """  Find estimations for a region and timestamp (or all timestamps (or all timestamps if timestamp==None)
+    def _get_task_estimates(self, task):
+        """  Find the estimations for a region at a block of timestamps. Worker function for thread/process pools.
 
-            :param pool: the multiprocessing pool object within which to run this task
-            :region_result: estimation result. as multiprocessing is used must return result as parameter
-            :param measurement: measurement to be estimated (string, required)
-            :param region_id: region identifier (string, required)
-            :param timestamp:  timestamp identifier (string or None)
-            :param ignore_site_ids: site id(s) to be ignored during the estimations
+            :param task: tuple (task_index, measurement, region_id, timestamps, ignore_site_ids)
 
-            :return: a dict with items 'region_id' and 'estimates (list). Estimates contains
-                        'timestamp', (estimated) 'value' and 'extra_data'
+            :return: tuple (task_index, values, extra_data): the estimated values and extra_data (dicts) with one
+                     item per timestamp (extra_data is None where the estimation failed)
         """
+        task_index, measurement, region_id, timestamps, ignore_site_ids = task
+        values = []
+        extra_data = []
+        for timestamp in timestamps:
+            estimate = self._get_estimate_process(measurement, region_id, timestamp, ignore_site_ids)
+            values.append(None if estimate is None else estimate['value'])
+            extra_data.append(None if estimate is None else estimate['extra_data'])
+        return task_index, values, extra_data
+
+    def _get_region_tasks(self, measurements, region_ids, timestamps, ignore_site_ids=[]):
+        """  Split the estimations of measurements, regions and timestamps into worker process tasks, each of a
+                measurement, a region and a block of (up to chunk_size) timestamps
+
+            :param measurements: measurements to be estimated (list of str)
+            :param region_ids: region identifiers (list of str)
+            :param timestamps: timestamp identifiers (sorted list of str)
+            :param ignore_site_ids: site id(s) to be ignored during the estimations
 
-        if timestamp is not None:
-            if self.verbose > 0:
-                print('\n##### Calculating for region_id: {} and timestamp: {} #####'.format(region_id, timestamp))
-
-            pool.apply_async(self._get_estimate_process,
-                                 args=(region_result, measurement, region_id, timestamp, ignore_site_ids))
-        else:
-            timestamps = sorted(self.actuals['timestamp'].unique())
-            for _, timestamp in enumerate(timestamps):
+            :return: list of tasks: tuples (task_index, measurement, region_id, timestamps, ignore_site_ids)
+        """
+        chunk_size = self.chunk_size if self.chunk_size is not None else max(len(timestamps), 1)
+        tasks = []
+        for measurement in measurements:
+            for region_id in region_ids:
                 if self.verbose > 1:
-                    print(region_id, '    Calculating for timestamp:', timestamp)
-                pool.apply_async(self._get_estimate_process,
-                                     args=(region_result, measurement, region_id, timestamp, ignore_site_ids))
-        return region_result
+                    print('Calculating {} for region: {}'.format(measurement, region_id))
+                for start in range(0, len(timestamps), chunk_size):
+                    tasks.append((len(tasks), measurement, region_id, timestamps[start:start + chunk_size],
+                                  ignore_site_ids))
+        return tasks
 
     #@log_time
-    def get_estimations(self, measurement, region_id=None, timestamp=None, ignore_site_ids=[]):
+    def get_estimations(self, measurement, region_id=None, timestamp=None, ignore_site_ids=[], backend=None,
+                        json_extra_data=True):
         """  Find estimations for a region (or all regions if region_id==None) and
                 timestamp (or all timestamps (or all timestamps if timestamp==None)
 
-            :param measurement: measurement to be estimated (string - required)
+            :param measurement: measurement to be estimated (string - required), or a list of measurements to be
+                estimated in one call. Only the 'vectorized' backend shares the ring/closest site work of the
+                estimations across the measurements; the other backends estimate each measurement in its own tasks
             :param region_id: region identifier (string or None)
             :param timestamp:  timestamp identifier (string or None)
             :param ignore_site_ids: site id(s) to be ignored during the estimations (default: empty list [])
-
-            :return: pandas dataframe with columns:
+            :param backend: (str) how to calculate the estimations, overriding the estimator's backend for this call:
+                'serial', 'thread', 'process' (tasks of regions and timestamp blocks, see chunk_size) or 'vectorized'
+                (all regions and timestamps at once, for estimators that support it). Default: None (self.backend)
+            :param json_extra_data: (bool) return the extra data of each estimate as a json string in an 'extra_data'
+                column (default: True), or (False) as a column per extra data item (see EXTRA_DATA_COLUMNS,
+                e.g. 'rings')
+
+            :return: pandas dataframe (in measurement, region then timestamp order) with columns:
                 'measurement'
                 'region_id'
                 'timestamp'
                 'value' (calculated 'estimate)
-                'extra_data' (json string)
+                'extra_data' (json string) (or the extra data columns, if not json_extra_data)
         """
+        measurements, region_ids, timestamps, ignore_site_ids, backend = self.__check_estimation_inputs(
+            measurement, region_id, timestamp, ignore_site_ids, backend)
 
-        # Check inputs
+        # Calculate estimates
+        result_columns = self.__get_result_columns(measurements, region_ids, timestamps, ignore_site_ids, backend)
+
+        df_result = self.__get_result_dataframe(result_columns, json_extra_data)
+        return df_result
+
+    def iter_estimations(self, measurement, region_id=None, timestamp=None, ignore_site_ids=[], backend=None,
+                         json_extra_data=True):
+        """  Generate the estimations of get_estimations in chunks, as they are calculated, so that results can be
+                stored (or otherwise processed) without holding all of them in memory.
+                Chunks are the results of each task (a measurement, a region and a block of chunk_size timestamps, see
+                chunk_size), or of each measurement and region for the 'vectorized' backend, and are generated in
+                measurement, region then timestamp order.
+
+            :param measurement: measurement to be estimated (string - required), or a list of measurements
+            :param region_id: region identifier (string or None)
+            :param timestamp:  timestamp identifier (string or None)
+            :param ignore_site_ids: site id(s) to be ignored during the estimations (default: empty list [])
+            :param backend: (str) how to calculate the estimations (see get_estimations). Default: None (self.backend)
+            :param json_extra_data: (bool) extra data as a json string column (see get_estimations). Default: True
+
+            :return: generator of pandas dataframes, each as returned by get_estimations
+                (chunks without any estimations are skipped)
+        """
+        measurements, region_ids, timestamps, ignore_site_ids, backend = self.__check_estimation_inputs(
+            measurement, region_id, timestamp, ignore_site_ids, backend)
+
+        if backend == 'vectorized':
+            chunks = (self._get_vectorized_estimations([task_measurement], [task_region_id], timestamps,
+                                                       ignore_site_ids)
+                      for task_measurement in measurements for task_region_id in region_ids)
+        else:
+            task_results = self.__iter_task_results(measurements, region_ids, timestamps, ignore_site_ids, backend)
+            chunks = (self.__get_task_result_columns([task[1]], [task[2]], task[3], [(task, values, extra_data)])
+                      for task, values, extra_data in task_results)
+
+        for result_columns in chunks:
+            if len(result_columns['value']) > 0:
+                yield self.__get_result_dataframe(result_columns, json_extra_data)
+
+    def update_estimations(self, estimations, changed_actuals, ignore_site_ids=[], backend=None):
+        """  Update the estimations of get_estimations after some readings have changed (late readings, already added
+                to the estimation data with EstimationData.append_actuals, or corrected readings, already replaced with
+                EstimationData.append_actuals(..., replace=True)), re-estimating only the regions and timestamps that
+                the changed readings can affect.
+                Only the timestamps of the changed readings are re-estimated, and at each of them only the regions
+                whose estimate can depend on the changed sites (see _get_affected_regions: for concentric-regions,
+                regions with a ring containing a changed site no further out than their nearest ring with other
+                readings; for distance-simple, regions at least as close to a changed site as to the closest other
+                site with readings). Timestamps that are not in the estimations are estimated for all of their regions.
+
+            :param estimations: pandas dataframe of estimations returned by get_estimations (with any measurements,
+                regions and timestamps, and with or without json extra data)
+            :param changed_actuals: pandas dataframe of the changed readings, with 'site_id' and 'timestamp' columns
+                (e.g. the dataframe given to EstimationData.append_actuals)
+            :param ignore_site_ids: site id(s) ignored during the estimations (as given to get_estimations)
+            :param backend: (str) how to calculate the estimations (see get_estimations). Default: None (self.backend)
+
+            :return: pandas dataframe of the updated estimations (as returned by get_estimations, in measurement,
+                region then timestamp order)
+        """
+        assert 'site_id' in list(changed_actuals.columns), "There is no site_id column in changed_actuals dataframe"
+        assert 'timestamp' in list(changed_actuals.columns), \
+            "There is no timestamp column in changed_actuals dataframe"
+        if ignore_site_ids is None:
+            ignore_site_ids = []
+        if backend is None:
+            backend = self.backend
+        assert backend in RegionEstimator.BACKENDS, \
+            "backend must be one of {}, not {}".format(RegionEstimator.BACKENDS, backend)
+
+        changed = changed_actuals[['site_id', 'timestamp']].astype({'site_id': str})
+        changed = changed.loc[~changed['site_id'].isin(ignore_site_ids)].drop_duplicates()
+        site_positions = self.estimation_data.get_site_positions(changed['site_id'])
+        assert (site_positions >= 0).all(), "The changed site_ids do not all exist in the sites dataframe"
+        assert changed['timestamp'].isin(self.estimation_data.timestamps).all(), \
+            "The changed timestamps do not all exist in the actuals (append the changed readings first)"
+
+        measurements = estimations.index.unique('measurement').tolist()
+        region_ids = estimations.index.unique('region_id')
+        estimated_timestamps = estimations.index.unique('timestamp')
+        region_positions = self.estimation_data.get_region_positions(region_ids)
+        json_extra_data = 'extra_data' in list(estimations.columns)
+
+        updates = []
+        recalculated = []
+        # Re-use a pool of worker processes for all of the timestamps
+        close_pool = backend == 'process' and self._pool is None
+        if close_pool:
+            self.start(backend)
+        try:
+            for timestamp, timestamp_site_positions in pd.Series(site_positions).groupby(changed['timestamp'].values):
+                timestamp_site_positions = np.unique(timestamp_site_positions.values)
+                if timestamp in estimated_timestamps:
+                    affected = np.zeros(len(self.regions.index), dtype=bool)
+                    for measurement in measurements:
+                        affected |= self._get_affected_regions(measurement, timestamp, timestamp_site_positions,
+                                                               ignore_site_ids)
+                    timestamp_region_ids = region_ids[affected[region_positions]].tolist()
+                else:
+                    timestamp_region_ids = region_ids.tolist()
+
+                if self.verbose > 0:
+                    print('Re-estimating {} regions at {}'.format(len(timestamp_region_ids), timestamp))
+                if len(timestamp_region_ids) == 0:
+                    continue
+
+                recalculated.append(pd.MultiIndex.from_arrays(
+                    list(_get_index_columns(measurements, timestamp_region_ids, [timestamp]).values()),
+                    names=['measurement', 'region_id', 'timestamp']))
+                result_columns = self.__get_result_columns(measurements, timestamp_region_ids, [timestamp],
+                                                           ignore_site_ids, backend)
+                if len(result_columns['value']) > 0:
+                    updates.append(self.__get_result_dataframe(result_columns, json_extra_data))
+        finally:
+            if close_pool:
+                self.close()
+
+        if len(recalculated) == 0:
+            return estimations.copy()
+
+        # Replace the re-estimated estimations, keeping measurement, region then timestamp order
+        df_result = estimations.loc[~estimations.index.isin(recalculated[0].append(recalculated[1:]))]
+        df_result = pd.concat([df_result] + updates)
+        index = df_result.index
+        order = np.lexsort((self.estimation_data.timestamps.get_indexer(index.get_level_values('timestamp')),
+                            self.estimation_data.get_region_positions(index.get_level_values('region_id')),
+                            pd.Index(measurements).get_indexer(index.get_level_values('measurement'))))
+        return df_result.iloc[order]
+
+    def get_leave_one_out_estimates(self, measurement, site_ids=None, timestamp=None):
+        """  Leave-one-out cross-validation estimates: for each site, estimate each region containing the site at each
+                timestamp at which the site has readings, with the site held out (as with ignore_site_ids=[site_id]),
+                to compare with the site's actual reading (the mean of its readings at the timestamp).
+
+            :param measurement: measurement to be estimated (string - required)
+            :param site_ids: site identifiers (list of str, or None for all sites)
+            :param timestamp:  timestamp identifier (string or None for all timestamps)
+
+            :return: pandas dataframe indexed by 'site_id', 'region_id' and 'timestamp', with columns:
+                'actual' (the site's reading)
+                'estimate' (the estimated value without the site, nan if no estimate)
+                'error' (estimate - actual)
+        """
         assert measurement is not None, "measurement parameter cannot be None"
         assert measurement in list(self.actuals.columns), "The measurement: '" + measurement \
                                                           + "' does not exist in the actuals dataframe"
+        if site_ids is None:
+            site_ids = self.sites.index.tolist()
+        site_positions = self.estimation_data.get_site_positions(site_ids)
+        assert (site_positions >= 0).all(), "The site_ids do not all exist in the sites dataframe"
+
+        timestamps = [timestamp] if timestamp is not None else None
+        timestamp_index = pd.Index(timestamps) if timestamps is not None else self.estimation_data.timestamps
+        site_sums, site_counts = self.estimation_data.get_site_aggregates(measurement, timestamps)
+        site_regions_indptr, site_regions = self.estimation_data.site_regions
+
+        results = {'site_id': [], 'region_id': [], 'timestamp': [], 'actual': [], 'estimate': []}
+        for site_id, site_position in zip(site_ids, site_positions):
+            rows = np.flatnonzero(site_counts[:, site_position] > 0)
+            region_positions = site_regions[site_regions_indptr[site_position]:site_regions_indptr[site_position + 1]]
+            if len(rows) == 0 or len(region_positions) == 0:
+                continue
+            if self.verbose > 1:
+                print('Leave-one-out estimates for site:', site_id)
+
+            estimates = self._get_held_out_estimates(measurement, timestamps, site_position, region_positions, rows)
+            actuals = site_sums[rows, site_position] / site_counts[rows, site_position]
+            results['site_id'].extend([site_id] * estimates.size)
+            results['region_id'].extend(np.repeat(self.regions.index[region_positions], len(rows)))
+            results['timestamp'].extend(np.tile(timestamp_index[rows], len(region_positions)))
+            results['actual'].extend(np.tile(actuals, len(region_positions)))
+            results['estimate'].extend(estimates.ravel())
+
+        df_result = pd.DataFrame(results).set_index(['site_id', 'region_id', 'timestamp'])
+        df_result['error'] = df_result['estimate'] - df_result['actual']
+        return df_result
+
+    def get_leave_one_out_errors(self, measurement, site_ids=None, timestamp=None):
+        """  Leave-one-out cross-validation error metrics, per site and overall (see get_leave_one_out_estimates).
+                Metrics are of the errors (estimate - actual) of the estimates that could be made.
+
+            :param measurement: measurement to be estimated (string - required)
+            :param site_ids: site identifiers (list of str, or None for all sites)
+            :param timestamp:  timestamp identifier (string or None for all timestamps)
+
+            :return: tuple containing
+                i) pandas dataframe indexed by 'site_id', with columns 'count' (number of estimates), 'mean_error',
+                    'mean_absolute_error' and 'root_mean_squared_error'
+                ii) pandas series of the same metrics, over all of the sites' estimates
+        """
+        errors = self.get_leave_one_out_estimates(measurement, site_ids, timestamp)['error']
+        site_errors = pd.DataFrame({'count': errors.groupby(level='site_id', sort=False).count(),
+                                    'mean_error': errors.groupby(level='site_id', sort=False).mean(),
+                                    'mean_absolute_error': errors.abs().groupby(level='site_id', sort=False).mean(),
+                                    'root_mean_squared_error':
+                                        np.sqrt((errors ** 2).groupby(level='site_id', sort=False).mean())})
+        overall_errors = pd.Series({'count': errors.count(),
+                                    'mean_error': errors.mean(),
+                                    'mean_absolute_error': errors.abs().mean(),
+                                    'root_mean_squared_error': np.sqrt((errors ** 2).mean())})
+        return site_errors, overall_errors
+
+    def __check_estimation_inputs(self, measurement, region_id, timestamp, ignore_site_ids, backend):
+        """  Check the inputs of get_estimations / iter_estimations
+
+            :return: tuple of (measurements (list), region_ids (list), timestamps (sorted list),
+                        ignore_site_ids (list), backend (str))
+        """
+        # Check inputs
+        assert measurement is not None, "measurement parameter cannot be None"
+        measurements = list(measurement) if isinstance(measurement, (list, tuple)) else [measurement]
+        assert len(measurements) > 0, "measurement parameter cannot be an empty list"
+        for measurement in measurements:
+            assert measurement in list(self.actuals.columns), "The measurement: '" + str(measurement) \
+                                                              + "' does not exist in the actuals dataframe"
         if region_id is not None:
-            df_reset = pd.DataFrame(self.regions.reset_index())
-            regions_temp = df_reset.loc[df_reset['region_id'] == region_id]
-            assert len(regions_temp.index) > 0, "The region_id does not exist in the regions dataframe"
+            assert region_id in self.regions.index, "The region_id does not exist in the regions dataframe"
         if timestamp is not None:
-            df_actuals_reset = pd.DataFrame(self.actuals.reset_index())
-            actuals_temp = df_actuals_reset.loc[df_actuals_reset['timestamp'] == timestamp]
-            assert len(actuals_temp.index) > 0, "The timestamp does not exist in the actuals dataframe"
+            assert timestamp in self.estimation_data.timestamps, \
+                "The timestamp does not exist in the actuals dataframe"
 
         if ignore_site_ids is None:
             ignore_site_ids = []
 
-        # Calculate estimates
+        if backend is None:
+            backend = self.backend
+        assert backend in RegionEstimator.BACKENDS, \
+            "backend must be one of {}, not {}".format(RegionEstimator.BACKENDS, backend)
 
-        with multiprocessing.Manager() as manager, multiprocessing.Pool(self.max_processors) as pool:
-            # Set up pool and result dict
-            region_result = manager.list()
+        region_ids = [region_id] if region_id else self.regions.index.tolist()
+        timestamps = [timestamp] if timestamp is not None else self.estimation_data.timestamps.tolist()
+        return measurements, region_ids, timestamps, ignore_site_ids, backend
 
-            if region_id:
-                if self.verbose > 0:
-                    print('\n##### Calculating for region:', region_id, '#####')
-                self._get_region_estimation(pool, region_result, measurement, region_id, timestamp, ignore_site_ids)
-            else:
-                if self.verbose > 0:
-                    print('No region_id submitted so calculating for all region ids...')
-                for index, _ in self.regions.iterrows():
-                    if self.verbose > 1:
-                        print('Calculating for region:', index)
-                    self._get_region_estimation(pool, region_result, measurement, index, timestamp, ignore_site_ids)
-
-            pool.close()
-            pool.join()
-
-            # Put results into the results dataframe
-            df_result = pd.DataFrame.from_records(region_result)
-            if len(df_result.index) > 0:
-                df_result.set_index(['measurement', 'region_id', 'timestamp'], inplace=True)
+    def __get_result_columns(self, measurements, region_ids, timestamps, ignore_site_ids, backend):
+        """  Calculate the estimations of measurements, regions and timestamps with a backend
+
+            :return: dict of result columns 'measurement', 'region_id', 'timestamp', 'value' and the extra data
+                columns (see EXTRA_DATA_COLUMNS)
+        """
+        if backend == 'vectorized':
+            return self._get_vectorized_estimations(measurements, region_ids, timestamps, ignore_site_ids)
+        return self.__get_task_result_columns(
+            measurements, region_ids, timestamps,
+            self.__iter_task_results(measurements, region_ids, timestamps, ignore_site_ids, backend))
+
+    def __iter_task_results(self, measurements, region_ids, timestamps, ignore_site_ids, backend):
+        """  Calculate estimations in tasks of a region and a block of timestamps (see _get_region_tasks), with the
+                'serial', 'thread' or 'process' backend
+
+            :param measurements: measurements to be estimated (list of str)
+            :param region_ids: region identifiers (list of str)
+            :param timestamps: timestamp identifiers (sorted list of str)
+            :param ignore_site_ids: site id(s) to be ignored during the estimations
+            :param backend: (str) 'serial', 'thread' or 'process'
+
+            :return: generator, in task (region then timestamp) order, of tuples (task, values, extra_data)
+                        (see _get_region_tasks and _get_task_estimates)
+        """
+        if self.verbose > 0:
+            if len(region_ids) == 1:
+                print('\n##### Calculating for region:', region_ids[0], '#####')
             else:
-                raise ValueError("Estimation process returned no results.")
+                print('No region_id submitted so calculating for all region ids...')
+
+        tasks = self._get_region_tasks(measurements, region_ids, timestamps, ignore_site_ids)
+        # Thread/process pool created for these estimations only
+        executor = None
+        futures = []
+
+        if backend == 'serial':
+            task_results = (self._get_task_estimates(task) for task in tasks)
+        elif backend == 'thread':
+            executor = ThreadPoolExecutor(self.max_processors)
+            futures = [executor.submit(self._get_task_estimates, task) for task in tasks]
+            task_results = (future.result() for future in futures)
+        # Workers are given the estimator (and its data) once, by the pool initializer
+        elif self._pool is not None:
+            # Restart the workers if the estimator, or the estimation data (e.g. appended actuals), has changed
+            if self._pool_outdated or self._pool_data_version != self.__get_data_version():
+                self.close()
+                self.start(backend)
+            task_results = self.__iter_pool_results(self._pool, tasks)
+        else:
+            self._prepare_workers()
+            executor = multiprocessing.Pool(self.max_processors, initializer=_init_worker, initargs=(self,))
+            task_results = self.__iter_pool_results(executor, tasks)
 
+        try:
+            for task_index, values, extra_data in task_results:
+                yield tasks[task_index], values, extra_data
+        finally:
+            if isinstance(executor, ThreadPoolExecutor):
+                # Cancel the tasks that have not started (if the generator is closed early)
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=True)
+            elif executor is not None:
+                executor.terminate()
+
+    @staticmethod
+    def __iter_pool_results(pool, tasks):
+        """  Run estimation tasks in a pool of worker processes. Tasks are run in any order (imap_unordered),
+                but their results are generated in tasks order, as soon as all earlier tasks are complete.
+
+            :param pool: the multiprocessing pool in which to run the tasks
+            :param tasks: list of tasks (see _get_region_tasks)
+
+            :return: generator of tuples (task_index, values, extra_data) (see _get_task_estimates), in tasks order
+        """
+        pending_results = {}
+        next_index = 0
+        for task_index, values, extra_data in pool.imap_unordered(_get_worker_estimates, tasks):
+            pending_results[task_index] = (values, extra_data)
+            while next_index in pending_results:
+                yield (next_index,) + pending_results.pop(next_index)
+                next_index += 1
+
+    def __get_task_result_columns(self, measurements, region_ids, timestamps, task_results):
+        """  Collect the results of tasks into result columns, using arrays preallocated for every measurement, region
+                and timestamp
+
+            :param measurements: measurements (list of str)
+            :param region_ids: region identifiers (list of str)
+            :param timestamps: timestamp identifiers (sorted list of str)
+            :param task_results: iterable, in task (measurement, region then timestamp) order, of tuples
+                (task, values, extra_data) for all of the measurements, regions and timestamps
+                (see __iter_task_results)
+
+            :return: dict of result columns 'measurement', 'region_id', 'timestamp', 'value' and the extra data
+                columns (see EXTRA_DATA_COLUMNS), for the estimates that did not fail
+        """
+        count = len(measurements) * len(region_ids) * len(timestamps)
+        values = np.full(count, np.nan)
+        estimated = np.zeros(count, dtype=bool)
+        extra_data = {column: [None] * count for column in self.EXTRA_DATA_COLUMNS}
+
+        offset = 0
+        for task, task_values, task_extra_data in task_results:
+            for index, (value, estimate_extra_data) in enumerate(zip(task_values, task_extra_data), offset):
+                if estimate_extra_data is not None:
+                    values[index] = np.nan if value is None else value
+                    estimated[index] = True
+                    for column, column_values in extra_data.items():
+                        column_values[index] = estimate_extra_data.get(column)
+            offset += len(task_values)
+
+        result_columns = _get_index_columns(measurements, region_ids, timestamps)
+        result_columns = {column: column_values[estimated] for column, column_values in result_columns.items()}
+        result_columns['value'] = values[estimated]
+        for column, column_values in extra_data.items():
+            result_columns[column] = [value for value, is_estimated in zip(column_values, estimated) if is_estimated]
+        return result_columns
+
+    def __get_result_dataframe(self, result_columns, json_extra_data=True):
+        """  Put estimation results into the results dataframe
+
+            :param result_columns: dict of result columns 'measurement', 'region_id', 'timestamp', 'value' (float) and
+                the extra data columns (see EXTRA_DATA_COLUMNS)
+            :param json_extra_data: (bool) put the extra data columns in a single 'extra_data' json string column
+
+            :return: pandas dataframe indexed by 'measurement', 'region_id' and 'timestamp'
+        """
+        count = len(result_columns['value'])
+        if count == 0:
+            raise ValueError("Estimation process returned no results.")
+
+        index = pd.MultiIndex.from_arrays([result_columns['measurement'], result_columns['region_id'],
+                                           result_columns['timestamp']],
+                                          names=['measurement', 'region_id', 'timestamp'])
+        extra_data = pd.DataFrame({column: self.__get_column_array(result_columns[column], dtype)
+                                   for column, dtype in self.EXTRA_DATA_COLUMNS.items()}, index=index)
+
+        df_result = pd.DataFrame({'value': np.asarray(result_columns['value'], dtype=float)}, index=index)
+        if json_extra_data:
+            df_result['extra_data'] = self._get_extra_data_json(extra_data)
+        else:
+            df_result = pd.concat([df_result, extra_data], axis=1)
         return df_result
+
+    @staticmethod
+    def __get_column_array(values, dtype):
+        """  Make a typed array of column values
+
+            :param values: list or array of values
+            :param dtype: the dtype of the column (a numpy/pandas dtype, or 'object', e.g. for lists of site ids)
+
+            :return: numpy or pandas array
+        """
+        if dtype == 'object':
+            if isinstance(values, np.ndarray):
+                return values
+            array = np.empty(len(values), dtype=object)
+            for index, value in enumerate(values):
+                array[index] = value
+            return array
+        return pd.array(values, dtype=dtype)
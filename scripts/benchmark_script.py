@@ -0,0 +1,171 @@
+from shapely.geometry import box
+import numpy as np
+import pandas as pd
+from region_estimators import EstimationData
+import argparse
+import time
+import tracemalloc
+
+DEFAULT_SIZES = ['100x500', '1000x5000', '10000x50000']
+DEFAULT_SEED = 0
+DEFAULT_TIMESTAMP_COUNT = 100
+DEFAULT_MEASUREMENT_COUNT = 4
+
+
+def make_regions(region_count):
+    '''
+        Create a square grid of (touching) square regions
+
+        :param region_count: (int) approximate number of regions required (rounded down to a square number)
+
+        :return: regions as pandas.DataFrame with index 'region_id' and column 'geometry'
+    '''
+    side = max(int(np.sqrt(region_count)), 1)
+    geometries = [box(x, y, x + 1, y + 1) for y in range(side) for x in range(side)]
+    return pd.DataFrame({'region_id': ['R{}'.format(i) for i in range(len(geometries))],
+                         'geometry': geometries}).set_index('region_id'), side
+
+
+def make_sites(site_count, side, rng):
+    '''
+        Create randomly located sites covering a square grid of regions
+
+        :param site_count: (int) number of sites
+        :param side: (int) side length of the regions grid
+        :param rng: numpy random generator
+
+        :return: sites as pandas.DataFrame with index 'site_id' and columns 'latitude', 'longitude'
+    '''
+    return pd.DataFrame({'site_id': ['S{}'.format(i) for i in range(site_count)],
+                         'longitude': rng.uniform(0, side, site_count),
+                         'latitude': rng.uniform(0, side, site_count)}).set_index('site_id')
+
+
+def make_actuals(sites, rng):
+    '''
+        Create a single timestamp of actual readings for every site
+
+        :param sites: sites as pandas.DataFrame (index 'site_id')
+        :param rng: numpy random generator
+
+        :return: actuals as pandas.DataFrame with columns 'timestamp', 'site_id', 'value'
+    '''
+    return pd.DataFrame({'timestamp': '2020-01-01',
+                         'site_id': sites.index.values,
+                         'value': rng.uniform(0, 100, len(sites.index))})
+
+
+def make_timestamp_actuals(sites, timestamp_count, measurement_count, rng):
+    '''
+        Create hourly actual readings of several measurements for every site
+
+        :param sites: sites as pandas.DataFrame (index 'site_id')
+        :param timestamp_count: (int) number of (hourly) timestamps
+        :param measurement_count: (int) number of measurement columns
+        :param rng: numpy random generator
+
+        :return: actuals as pandas.DataFrame with columns 'timestamp', 'site_id', 'value0', 'value1', ...
+    '''
+    timestamps = pd.date_range('2020-01-01', periods=timestamp_count, freq='H').strftime('%Y-%m-%d %H:%M:%S')
+    actuals = pd.DataFrame({'timestamp': np.repeat(timestamps, len(sites.index)),
+                            'site_id': np.tile(sites.index.values, timestamp_count)})
+    for index in range(measurement_count):
+        actuals['value{}'.format(index)] = rng.uniform(0, 100, len(actuals.index))
+    return actuals
+
+
+def benchmark_memory(region_count, site_count, timestamp_count=DEFAULT_TIMESTAMP_COUNT,
+                     measurement_count=DEFAULT_MEASUREMENT_COUNT, seed=DEFAULT_SEED):
+    '''
+        Measure the memory allocated (with tracemalloc) while constructing EstimationData for synthetic actuals:
+        checking the data, with trusted (already checked) data and with compact actuals
+
+        :param region_count: (int) number of regions
+        :param site_count: (int) number of sites
+        :param timestamp_count: (int) number of timestamps (each with a reading from every site)
+        :param measurement_count: (int) number of measurement columns
+        :param seed: (int) random seed
+
+        :return: tuple (size of the given actuals, list of tuples (mode, peak, retained, size of the stored actuals))
+                 with sizes in bytes
+    '''
+    rng = np.random.default_rng(seed)
+    regions, side = make_regions(region_count)
+    sites = make_sites(site_count, side, rng)
+    actuals = make_timestamp_actuals(sites, timestamp_count, measurement_count, rng)
+
+    results = []
+    for mode, options in [('checked', {}), ('trusted', {'trusted': True}), ('compact', {'compact': True})]:
+        tracemalloc.start()
+        estimation_data = EstimationData(sites, regions, actuals, **options)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append((mode, peak, retained, estimation_data.actuals.memory_usage(deep=True).sum()))
+        del estimation_data
+    return actuals.memory_usage(deep=True).sum(), results
+
+
+def benchmark_topology(region_count, site_count, seed=DEFAULT_SEED):
+    '''
+        Time the construction of EstimationData (site/region assignment) and the calculation of
+        region neighbours for synthetic data
+
+        :param region_count: (int) number of regions
+        :param site_count: (int) number of sites
+        :param seed: (int) random seed
+
+        :return: tuple (construction time, neighbours time) in seconds
+    '''
+    rng = np.random.default_rng(seed)
+    regions, side = make_regions(region_count)
+    sites = make_sites(site_count, side, rng)
+    actuals = make_actuals(sites, rng)
+
+    start = time.time()
+    estimation_data = EstimationData(sites, regions, actuals)
+    construction_time = time.time() - start
+
+    start = time.time()
+    estimation_data.region_neighbours
+    return construction_time, time.time() - start
+
+
+if __name__ == '__main__':
+    # read arguments from the command line
+    parser = argparse.ArgumentParser(
+        description="*** Benchmark the construction of EstimationData and region neighbours on synthetic regions and sites. ***")
+
+    parser.add_argument("--sizes", "-z", type=str, nargs='+',
+                        help="Benchmark sizes as REGIONSxSITES. Default: {}".format(' '.join(DEFAULT_SIZES)))
+    parser.add_argument("--seed", type=int,
+                        help="Random seed. Default: {}".format(DEFAULT_SEED))
+    parser.add_argument("--memory", action='store_true',
+                        help="Measure the memory allocated constructing EstimationData (checked, trusted and compact, "
+                             "with actuals of --timestamps timestamps) instead of timing the topology")
+    parser.add_argument("--timestamps", "-t", type=int,
+                        help="Number of timestamps of actuals for --memory. Default: {}".format(
+                            DEFAULT_TIMESTAMP_COUNT))
+
+    args = parser.parse_args()
+
+    sizes = args.sizes if args.sizes else DEFAULT_SIZES
+    seed = args.seed if args.seed is not None else DEFAULT_SEED
+    timestamp_count = args.timestamps if args.timestamps is not None else DEFAULT_TIMESTAMP_COUNT
+
+    if args.memory:
+        print('{:>10} {:>10} {:>12} {:>8} {:>10} {:>14} {:>14}'.format(
+            'regions', 'sites', 'actuals (MB)', 'mode', 'peak (MB)', 'retained (MB)', 'stored (MB)'))
+        for size in sizes:
+            region_count, site_count = [int(x) for x in size.lower().split('x')]
+            actuals_size, results = benchmark_memory(region_count, site_count, timestamp_count, seed=seed)
+            for mode, peak, retained, stored_size in results:
+                print('{:>10} {:>10} {:>12.1f} {:>8} {:>10.1f} {:>14.1f} {:>14.1f}'.format(
+                    region_count, site_count, actuals_size / 1e6, mode, peak / 1e6, retained / 1e6,
+                    stored_size / 1e6))
+    else:
+        print('{:>10} {:>10} {:>14} {:>14}'.format('regions', 'sites', 'sites (s)', 'neighbours (s)'))
+        for size in sizes:
+            region_count, site_count = [int(x) for x in size.lower().split('x')]
+            construction_time, neighbours_time = benchmark_topology(region_count, site_count, seed)
+            print('{:>10} {:>10} {:>14.3f} {:>14.3f}'.format(region_count, site_count, construction_time,
+                                                            neighbours_time))
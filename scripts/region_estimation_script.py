@@ -1,7 +1,8 @@
-from shapely import wkt
-import pandas as pd
 from region_estimators import RegionEstimatorFactory, EstimationData
+from region_estimators.data_io import read_sites, read_regions, read_actuals_windows, iter_window_estimations, \
+    write_estimations
 import argparse
+import itertools
 import os
 
 DEFAULT_REGIONS_FILESPEC = '../sample_input_files/df_regions.csv'
@@ -16,6 +17,11 @@ DEFAULT_MEASUREMENT = 'urtica'
 DEFAULT_METHOD = 'concentric-regions'
 DEFAULT_TIMESTAMP = None
 DEFAULT_REGION_ID = None
+DEFAULT_BACKEND = None
+DEFAULT_CACHE_DIR = None
+DEFAULT_WINDOW_SIZE = None
+DEFAULT_OUTPUT_FORMAT = 'csv'
+DEFAULT_SIMPLIFY_TOLERANCE = None
 
 if __name__ == '__main__':
     # read arguments from the command line
@@ -24,26 +30,33 @@ if __name__ == '__main__':
             known scalar quantities at specific locations. ***")
 
     parser.add_argument("--regions_filespec", "-r", type=str,
-                        help="filespec of the regions metadata file (csv). Default: {}".format(DEFAULT_REGIONS_FILESPEC))
+                        help="filespec of the regions metadata file (csv with wkt geometries, or GeoParquet "
+                             "(.parquet) / feather (.feather)). Default: {}".format(DEFAULT_REGIONS_FILESPEC))
     parser.add_argument("--sites_filespec", "-s", type=str,
-                        help="filespec of the sites metadata file (csv). Default: {}".format(DEFAULT_SITES_FILESPEC))
+                        help="filespec of the sites metadata file (csv, parquet or feather). Default: {}".format(
+                            DEFAULT_SITES_FILESPEC))
     parser.add_argument("--actuals_filespec", "-a", type=str,
-                        help="filespec of the actuals data file (csv). Default: {}".format(DEFAULT_ACTUALS_FILESPEC))
+                        help="filespec of the actuals data file (csv, parquet or feather; only the columns of the "
+                             "measurement(s) are read). Default: {}".format(
+                            DEFAULT_ACTUALS_FILESPEC))
 
     parser.add_argument("--method", "-m", dest="method", type=str,
                         help="Estimation method to use. Default: {}".format(DEFAULT_METHOD))
-    parser.add_argument("--measurement", "-e", dest="measurement", type=str,
-                        help="Which measurement to estimate. Default: {}".format(DEFAULT_MEASUREMENT))
+    parser.add_argument("--measurement", "-e", dest="measurement", type=str, nargs='+',
+                        help="Which measurement(s) to estimate. Default: {}".format(DEFAULT_MEASUREMENT))
     parser.add_argument("--timestamp", "-t", dest="timestamp", type=str,
                         help="Which timestamp to estimate. Default: {}".format(DEFAULT_TIMESTAMP))
     parser.add_argument("--region_id", "-g", dest="region_id", type=str,
                         help="ID of the region to estimate. Default: {}".format(DEFAULT_REGION_ID))
 
     parser.add_argument("--save_to_csv", dest="save_to_csv", action='store_true',
-                        help="save output into CSV format (default).")
+                        help="save output to file (default).")
     parser.add_argument("--no_save_to_csv", dest="save_to_csv", action='store_false',
-                        help="don't save output to CSV format")
+                        help="don't save output to file")
     parser.set_defaults(save_to_csv=True)
+    parser.add_argument("--output_format", "-f", type=str, choices=['csv', 'parquet'],
+                        help="Format of the output: csv file, or parquet dataset directory partitioned by measurement. "
+                             "Default: {}".format(DEFAULT_OUTPUT_FORMAT))
 
     # output directory/file names
     parser.add_argument("--outdir_name", "-o", dest="outdir_name", type=str,
@@ -55,6 +68,28 @@ if __name__ == '__main__':
     parser.add_argument("--max_processors", "-p", type=int,
                         help="Maximum number of processors. Default: {}".format(
                             DEFAULT_MAX_PROCESSORS))
+    # Estimation backend
+    parser.add_argument("--backend", "-b", type=str, choices=['serial', 'thread', 'process', 'vectorized'],
+                        help="How estimations are calculated. Default: {} (serial if max_processors is 1, "
+                             "otherwise process)".format(DEFAULT_BACKEND))
+    # Topology cache directory
+    parser.add_argument("--cache_dir", "-c", type=str,
+                        help="Directory in which to cache the region/site topology between runs. Default: {} "
+                             "(no cache)".format(DEFAULT_CACHE_DIR))
+    # Simplification of region geometries
+    parser.add_argument("--simplify_tolerance", "-l", type=float,
+                        help="Simplify the region geometries to this tolerance (in the units of the coordinates), "
+                             "which is faster for detailed regions but can move sites near boundaries between regions. "
+                             "Default: {} (no simplification)".format(DEFAULT_SIMPLIFY_TOLERANCE))
+    # Compact storage of the actuals
+    parser.add_argument("--compact", action='store_true',
+                        help="Store the actuals compactly (float32 measurement values, categorical site IDs and "
+                             "timestamps), rounding the values to about 7 significant digits")
+    # Streaming of actuals in time windows
+    parser.add_argument("--window_size", "-w", type=int,
+                        help="Stream the actuals file in time windows of (about) this number of rows, estimating and "
+                             "saving each window in turn (the readings of each timestamp must be together in the "
+                             "file). Default: {} (read the whole file)".format(DEFAULT_WINDOW_SIZE))
     # Log verbose-ness
     parser.add_argument("--verbose", "-v", type=int,
                         help="Level of output for debugging (Default: {} (0 = no verbose output))".format(
@@ -97,7 +132,7 @@ if __name__ == '__main__':
         method = DEFAULT_METHOD
 
     if args.measurement:
-        measurement = args.measurement
+        measurement = args.measurement[0] if len(args.measurement) == 1 else args.measurement
         print('Measurement: {}'.format(measurement))
     else:
         print('No measurement given, so will use {}.'.format(DEFAULT_MEASUREMENT))
@@ -133,6 +168,13 @@ if __name__ == '__main__':
         print('No outfile_suffix provided, so using default: {}'.format(str(DEFAULT_OUT_FILE_SUFFIX)))
         outfile_suffix = DEFAULT_OUT_FILE_SUFFIX
 
+    if args.output_format is not None:
+        output_format = args.output_format
+        print('output_format: ', output_format)
+    else:
+        print('No output_format provided, so using default: {}'.format(str(DEFAULT_OUTPUT_FORMAT)))
+        output_format = DEFAULT_OUTPUT_FORMAT
+
     if args.max_processors is not None:
         max_processors = max(args.max_processors, 0)
         print('max_processors: ', max_processors)
@@ -140,6 +182,38 @@ if __name__ == '__main__':
         print('No max_processors number provided, so using default: {}'.format(str(DEFAULT_MAX_PROCESSORS)))
         max_processors = DEFAULT_MAX_PROCESSORS
 
+    if args.backend is not None:
+        backend = args.backend
+        print('backend: ', backend)
+    else:
+        print('No backend provided, so using default: {}'.format(str(DEFAULT_BACKEND)))
+        backend = DEFAULT_BACKEND
+
+    if args.cache_dir is not None:
+        cache_dir = args.cache_dir
+        print('cache_dir: ', cache_dir)
+    else:
+        print('No cache_dir provided, so using default: {}'.format(str(DEFAULT_CACHE_DIR)))
+        cache_dir = DEFAULT_CACHE_DIR
+
+    print('compact: {}'.format(args.compact))
+
+    if args.simplify_tolerance is not None:
+        simplify_tolerance = max(args.simplify_tolerance, 0)
+        print('simplify_tolerance: ', simplify_tolerance)
+    else:
+        print('No simplify_tolerance provided, so using default: {}'.format(str(DEFAULT_SIMPLIFY_TOLERANCE)))
+        simplify_tolerance = DEFAULT_SIMPLIFY_TOLERANCE
+
+    if args.window_size is not None:
+        window_size = max(args.window_size, 1)
+        print('window_size: ', window_size)
+        if timestamp is not None:
+            parser.error('A timestamp cannot be given when streaming the actuals in time windows')
+    else:
+        print('No window_size provided, so using default: {}'.format(str(DEFAULT_WINDOW_SIZE)))
+        window_size = DEFAULT_WINDOW_SIZE
+
     if args.verbose is not None:
         verbose = max(args.verbose, 0)
         print('verbose: ', verbose)
@@ -155,26 +229,43 @@ if __name__ == '__main__':
         max_rings = DEFAULT_MAX_RINGS
 
     # Prepare input files  (For sample input files, see the 'sample_input_files' folder)
-    df_regions = pd.read_csv(regions_filespec, index_col='region_id')
-    df_sites = pd.read_csv(sites_filespec, index_col='site_id')
-    df_actuals = pd.read_csv(actuals_filespec)
-
-    # Convert the regions geometry column from string to wkt format using wkt
-    df_regions['geometry'] = df_regions.apply(lambda row: wkt.loads(row.geometry), axis=1)
+    # Only the actuals columns of the measurement(s) are read
+    if window_size is None:
+        estimation_data = EstimationData.from_files(sites_filespec, regions_filespec, actuals_filespec, measurement,
+                                                    cache_dir=cache_dir, simplify_tolerance=simplify_tolerance,
+                                                    compact=args.compact)
+    else:
+        actuals_windows = read_actuals_windows(actuals_filespec, window_size, measurement)
+        df_actuals = next(actuals_windows)
+        estimation_data = EstimationData(read_sites(sites_filespec),
+                                         read_regions(regions_filespec, simplify_tolerance), df_actuals,
+                                         cache_dir=cache_dir, compact=args.compact)
 
     # Create estimator, the first parameter is the estimation method.
 
-    estimation_data = EstimationData(df_sites, df_regions, df_actuals)
-
-    estimator = RegionEstimatorFactory.region_estimator(method, estimation_data, verbose, max_processors)
+    estimator = RegionEstimatorFactory.region_estimator(method, estimation_data, verbose, max_processors,
+                                                        backend=backend)
 
     # Make estimations
     if method == 'concentric-regions':
         estimator.max_ring_count = max_rings
-    df_estimates = estimator.get_estimations(measurement, region_id, timestamp)
+    outfile = os.path.join(outdir_name, 'estimates_{}.{}'.format(outfile_suffix, output_format))
 
-    print(df_estimates)
+    if window_size is None:
+        df_estimates = estimator.get_estimations(measurement, region_id, timestamp)
 
-    # Convert dataframe result to (for example) a csv file:
-    if args.save_to_csv:
-        df_estimates.to_csv(os.path.join(outdir_name, 'estimates_{}.csv'.format(outfile_suffix)))
+        print(df_estimates)
+
+        # Convert dataframe result to (for example) a csv file:
+        if args.save_to_csv:
+            write_estimations(df_estimates, outfile)
+    else:
+        # Estimate and save one window of actuals at a time (the first window has already been read)
+        with estimator:
+            for index, df_estimates in enumerate(iter_window_estimations(
+                    estimator, itertools.chain([df_actuals], actuals_windows), measurement, region_id)):
+                timestamps = df_estimates.index.get_level_values('timestamp')
+                print('Window {}: {} estimates ({} to {})'.format(index, len(df_estimates.index), timestamps.min(),
+                                                                 timestamps.max()))
+                if args.save_to_csv:
+                    write_estimations(df_estimates, outfile, append=index > 0)
@@ -1,7 +1,13 @@
 import unittest
+from unittest import mock
+import multiprocessing
+import time
 from os import path
 from shapely import wkt
 import pandas as pd
+import numpy as np
+import pickle
+import json
 
 from region_estimators.estimation_data import EstimationData
 from region_estimators.concentric_regions_estimator import ConcentricRegionsEstimator
@@ -91,3 +97,324 @@ class TestConcentricRegionsEstimator(unittest.TestCase):
     estimation_data = EstimationData(self.sites, self.regions, self.actuals)
     estimator = ConcentricRegionsEstimator(estimation_data, verbose=0)
     self.assertTrue(estimator.estimation_data.site_datapoint_count('NO2_mean', '2019-10-15') > 0)
+
+  def test_ring_table(self):
+    """
+    Test that the ring table holds each region's concentric rings (ring 1 being the adjacent regions), limited by
+    max_ring_count
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0)
+    region_ids = estimator.regions.index.tolist()
+    position = region_ids.index('SW')
+
+    indptr, ring_regions, ring_hops = estimator.ring_table
+    rings = ring_regions[indptr[position]:indptr[position + 1]]
+    hops = ring_hops[indptr[position]:indptr[position + 1]]
+    self.assertEqual([region_ids[i] for i in rings[hops == 0]], ['SW'])
+    self.assertEqual([region_ids[i] for i in rings[hops == 1]], ['CR', 'KT', 'SE', 'SM', 'TW', 'W', 'WC'])
+    self.assertEqual(len(set(rings)), len(rings))
+
+    estimator.max_ring_count = 1
+    indptr, ring_regions, ring_hops = estimator.ring_table
+    self.assertEqual(ring_hops[indptr[position]:indptr[position + 1]].max(), 1)
+
+  def test_ring_table_before_pool(self):
+    """
+    Test that the ring table is calculated before the worker processes are started (persistent or per-call), so
+    that the workers are given it rather than each calculating it
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, max_processors=2)
+    ring_tables = []
+    pool_class = multiprocessing.Pool
+
+    def pool(*args, **kwargs):
+      ring_tables.append(estimator._ring_table)
+      return pool_class(*args, **kwargs)
+
+    with mock.patch.object(multiprocessing, 'Pool', side_effect=pool):
+      estimator.get_estimations('NO2_mean', None, '2019-10-15', backend='process')
+      estimator.max_ring_count = 1
+      estimator.start('process')
+      estimator.close()
+    self.assertEqual(len(ring_tables), 2)
+    self.assertTrue(all(ring_table is not None for ring_table in ring_tables))
+
+  def test_vectorized(self):
+    """
+    Test that the vectorized ConcentricRegionsEstimator engine gives the same results as the per-timestamp estimates
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0)
+
+    result = estimator.get_estimations('NO2_mean', None, '2019-10-15', backend='vectorized')
+    self.assertTrue(result.equals(self.results))
+
+    result = estimator.get_estimations('NO2_mean', None, '2019-10-15', ignore_site_ids=['Camden Kerbside [AQ]'],
+                                       backend='vectorized')
+    self.assertTrue(result.equals(self.results_ignore_sites))
+
+    result = estimator.get_estimations('NO2_mean', 'SW', None, backend='vectorized')
+    expected = estimator.get_estimations('NO2_mean', 'SW', None)
+    self.assertTrue(result.equals(expected))
+
+  def test_multiprocessing(self):
+    """
+    Test that estimations made by more than one worker process, in chunked tasks, give the expected results
+    (in region then timestamp order)
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, max_processors=2,
+                                           progress_callback=process_progress, backend='process')
+
+    result = estimator.get_estimations('NO2_mean', None, '2019-10-15')
+    self.assertTrue(result.equals(self.results))
+
+    estimator.chunk_size = 1
+    expected = estimator.get_estimations('NO2_mean', 'SW', None, backend='vectorized')
+    result = estimator.get_estimations('NO2_mean', 'SW', None)
+    self.assertTrue(result.equals(expected))
+
+    with self.assertRaises(AssertionError):
+      estimator.chunk_size = 0
+
+  def test_persistent_pool(self):
+    """
+    Test that a started pool of worker processes is re-used across estimations, and restarted when the estimator
+    changes
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, max_processors=2, backend='process')
+
+    with estimator:
+      pool = estimator._pool
+      self.assertIsNotNone(pool)
+      result = estimator.get_estimations('NO2_mean', None, '2019-10-15')
+      self.assertTrue(result.equals(self.results))
+      result = estimator.get_estimations('NO2_mean', None, '2019-10-15')
+      self.assertTrue(result.equals(self.results))
+      self.assertIs(estimator._pool, pool)
+
+      # Workers must use the new maximum ring count
+      estimator.max_ring_count = 1
+      result = estimator.get_estimations('NO2_mean', None, '2019-10-15')
+      self.assertIsNot(estimator._pool, pool)
+      self.assertTrue(result.equals(estimator.get_estimations('NO2_mean', None, '2019-10-15', backend='vectorized')))
+
+      # Workers must use appended actuals
+      pool = estimator._pool
+      appended = self.actuals.loc[self.actuals['timestamp'] == '2019-10-15'].copy()
+      appended['timestamp'] = '2020-01-01'
+      estimation_data.append_actuals(appended)
+      result = estimator.get_estimations('NO2_mean', None, '2020-01-01')
+      self.assertIsNot(estimator._pool, pool)
+      self.assertTrue(result.equals(estimator.get_estimations('NO2_mean', None, '2020-01-01', backend='vectorized')))
+      self.assertTrue(np.array_equal(result['value'].values,
+                                     estimator.get_estimations('NO2_mean', None, '2019-10-15')['value'].values,
+                                     equal_nan=True))
+
+      # The estimator can be pickled while its pool is running
+      self.assertIsNone(pickle.loads(pickle.dumps(estimator))._pool)
+
+    self.assertIsNone(estimator._pool)
+
+  def test_backends(self):
+    """
+    Test that all of the estimation backends give the same results
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0)
+    self.assertEqual(estimator.backend, 'serial')
+
+    for backend in ConcentricRegionsEstimator.BACKENDS:
+      with self.subTest(backend=backend):
+        result = estimator.get_estimations('NO2_mean', None, '2019-10-15', backend=backend)
+        self.assertTrue(result.equals(self.results))
+
+    estimator.backend = 'thread'
+    result = estimator.get_estimations('NO2_mean', None, '2019-10-15', ignore_site_ids=['Camden Kerbside [AQ]'])
+    self.assertTrue(result.equals(self.results_ignore_sites))
+
+    with self.assertRaises(AssertionError):
+      estimator.backend = 'gpu'
+
+  def test_iter_estimations(self):
+    """
+    Test that the estimations generated in chunks give the same results as get_estimations
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0)
+    estimator.chunk_size = 1
+
+    for backend in ConcentricRegionsEstimator.BACKENDS:
+      with self.subTest(backend=backend):
+        chunks = list(estimator.iter_estimations('NO2_mean', None, '2019-10-15', backend=backend))
+        self.assertEqual(len(chunks), len(self.regions.index))
+        self.assertTrue(pd.concat(chunks).equals(self.results))
+
+        # Stop part way through
+        for chunk in estimator.iter_estimations('NO2_mean', None, None, backend=backend):
+          self.assertIsInstance(chunk, pd.DataFrame)
+          break
+
+  def test_thread_generator_closed(self):
+    """
+    Test that closing the estimations generator of the thread backend early cancels the tasks not yet started
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, max_processors=1, backend='thread')
+    estimator.chunk_size = 1
+    task_count = len(estimator._get_region_tasks(['NO2_mean'], self.regions.index.tolist(),
+                                                 estimation_data.timestamps.tolist(), []))
+    calls = []
+    get_task_estimates = estimator._get_task_estimates
+    estimator._get_task_estimates = lambda task: calls.append(task) or get_task_estimates(task)
+
+    chunks = estimator.iter_estimations('NO2_mean', None, None)
+    self.assertIsInstance(next(chunks), pd.DataFrame)
+    chunks.close()
+    call_count = len(calls)
+    self.assertLess(call_count, task_count)
+    time.sleep(0.1)
+    self.assertEqual(len(calls), call_count)
+
+  def test_extra_data_columns(self):
+    """
+    Test that the extra data can be returned as typed columns instead of json strings
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0)
+    expected_rings = [json.loads(extra_data)['rings'] for extra_data in self.results['extra_data']]
+
+    for backend in ['serial', 'vectorized']:
+      with self.subTest(backend=backend):
+        result = estimator.get_estimations('NO2_mean', None, '2019-10-15', backend=backend, json_extra_data=False)
+        self.assertEqual(list(result.columns), ['value', 'rings'])
+        self.assertEqual(str(result['rings'].dtype), 'Int64')
+        self.assertTrue(result['value'].equals(self.results['value']))
+        self.assertEqual([None if pd.isna(rings) else rings for rings in result['rings']], expected_rings)
+
+  def test_leave_one_out(self):
+    """
+    Test that leave-one-out estimates are those of the site's regions with the site ignored
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0)
+
+    result = estimator.get_leave_one_out_estimates('NO2_mean', timestamp='2019-10-15')
+    self.assertGreater(len(result.index), 0)
+    for (site_id, region_id, timestamp), row in result.iterrows():
+      expected = estimator.get_estimations('NO2_mean', region_id, timestamp, ignore_site_ids=[site_id])
+      self.assertAlmostEqual(row['estimate'], expected['value'].iloc[0])
+      self.assertAlmostEqual(row['error'], row['estimate'] - row['actual'])
+
+    site_errors, overall_errors = estimator.get_leave_one_out_errors('NO2_mean', timestamp='2019-10-15')
+    self.assertEqual(list(site_errors.index), list(result.index.unique(level='site_id')))
+    self.assertEqual(overall_errors['count'], result['error'].count())
+    self.assertAlmostEqual(overall_errors['mean_absolute_error'], result['error'].abs().mean())
+
+  def test_multiple_measurements(self):
+    """
+    Test that estimating a list of measurements together gives the results of each measurement, in measurement order
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0)
+    measurements = ['NO2_mean', 'Made_up_mean', 'Made_up_max']
+    expected = pd.concat([estimator.get_estimations(measurement, None, None) for measurement in measurements])
+
+    for backend in ['serial', 'vectorized']:
+      with self.subTest(backend=backend):
+        result = estimator.get_estimations(measurements, None, None, backend=backend)
+        self.assertTrue(result.equals(expected))
+
+  def test_update_estimations(self):
+    """
+    Test that updating estimations with late readings (at existing and new timestamps) gives the estimations of all
+    of the readings, re-estimating only the regions that the readings can affect
+    """
+    late = self.actuals.loc[((self.actuals['timestamp'] == '2019-10-15') &
+                             (self.actuals['site_id'] == 'Camden Kerbside [AQ]')) |
+                            (self.actuals['timestamp'] == '2019-12-31')]
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals.drop(late.index))
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, backend='vectorized')
+    measurements = ['NO2_mean', 'Made_up_max']
+
+    previous = {json_extra_data: estimator.get_estimations(measurements, None, None, json_extra_data=json_extra_data)
+                for json_extra_data in [True, False]}
+    estimation_data.append_actuals(late)
+
+    for json_extra_data in [True, False]:
+      with self.subTest(json_extra_data=json_extra_data):
+        result = estimator.update_estimations(previous[json_extra_data], late)
+        self.assertTrue(result.equals(estimator.get_estimations(measurements, None, None,
+                                                                json_extra_data=json_extra_data)))
+
+    site_positions = estimation_data.get_site_positions(['Camden Kerbside [AQ]'])
+    affected = estimator._get_affected_regions('NO2_mean', '2019-10-15', site_positions)
+    self.assertTrue(0 < affected.sum() < len(self.regions.index))
+
+  def test_update_estimations_ignore_sites(self):
+    """
+    Test that updating estimations with ignored sites gives the estimations of a full recalculation, aggregating
+    the readings of all of the timestamps without the ignored sites only once
+    """
+    late = self.actuals.loc[((self.actuals['timestamp'] == '2019-10-15') &
+                             (self.actuals['site_id'] == 'Camden Kerbside [AQ]')) |
+                            (self.actuals['timestamp'] == '2019-12-31')]
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals.drop(late.index))
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, backend='vectorized')
+    ignore_site_ids = ['Haringey Roadside [AQ]']
+    previous = estimator.get_estimations('NO2_mean', None, None, ignore_site_ids=ignore_site_ids)
+    estimation_data.append_actuals(late)
+
+    with mock.patch.object(EstimationData, '_EstimationData__get_reading_aggregates', autospec=True,
+                           side_effect=EstimationData._EstimationData__get_reading_aggregates) as aggregates:
+      result = estimator.update_estimations(previous, late, ignore_site_ids=ignore_site_ids)
+    self.assertEqual(aggregates.call_count, 1)
+    self.assertTrue(result.equals(estimator.get_estimations('NO2_mean', None, None,
+                                                            ignore_site_ids=ignore_site_ids)))
+
+  def test_update_estimations_process(self):
+    """
+    Test that updating estimations with a per-call process backend (of a serial estimator) uses one pool of worker
+    processes for all of the timestamps, and closes it afterwards
+    """
+    late = self.actuals.loc[((self.actuals['timestamp'] == '2019-10-15') &
+                             (self.actuals['site_id'] == 'Camden Kerbside [AQ]')) |
+                            (self.actuals['timestamp'] == '2019-12-31')]
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals.drop(late.index))
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, max_processors=2)
+    self.assertEqual(estimator.backend, 'serial')
+    previous = estimator.get_estimations('NO2_mean', None, None)
+    estimation_data.append_actuals(late)
+
+    with mock.patch.object(multiprocessing, 'Pool', wraps=multiprocessing.Pool) as pool:
+      result = estimator.update_estimations(previous, late, backend='process')
+    self.assertEqual(pool.call_count, 1)
+    self.assertIsNone(estimator._pool)
+    self.assertTrue(result.equals(estimator.get_estimations('NO2_mean', None, None)))
+
+  def test_update_estimations_replace(self):
+    """
+    Test that updating estimations with corrected readings (replacing the existing readings) gives the estimations of
+    a full recalculation with the corrected readings
+    """
+    corrected_rows = (self.actuals['timestamp'] == '2019-10-15') & \
+                     (self.actuals['site_id'].isin(['Camden Kerbside [AQ]', 'Haringey Roadside [AQ]']))
+    corrected = self.actuals.loc[corrected_rows].assign(NO2_mean=lambda df: df['NO2_mean'] + 1000)
+    expected_actuals = self.actuals.copy()
+    expected_actuals.loc[corrected_rows, 'NO2_mean'] += 1000
+    measurements = ['NO2_mean', 'Made_up_max']
+    expected = ConcentricRegionsEstimator(EstimationData(self.sites, self.regions, expected_actuals),
+                                          verbose=0).get_estimations(measurements, None, None)
+
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, backend='vectorized')
+    previous = estimator.get_estimations(measurements, None, None)
+    estimation_data.append_actuals(corrected, replace=True)
+    self.assertEqual(len(estimation_data.actuals.index), len(self.actuals.index))
+
+    result = estimator.update_estimations(previous, corrected)
+    self.assertTrue(result.equals(expected))
+    self.assertFalse(result.equals(previous))
@@ -0,0 +1,186 @@
+import unittest
+import tempfile
+from os import path
+import shapely
+from shapely import wkt
+import pandas as pd
+import geopandas as gpd
+
+from region_estimators.estimation_data import EstimationData
+from region_estimators.concentric_regions_estimator import ConcentricRegionsEstimator
+from region_estimators.data_io import read_actuals_windows, iter_window_estimations, read_actuals, read_sites, \
+  read_regions, write_estimations, get_file_format, get_regions_geodataframe
+
+try:
+  import pyarrow
+except ImportError:
+  pyarrow = None
+
+
+class TestDataIO(unittest.TestCase):
+  """
+  Tests for reading and estimating actuals in time windows
+  """
+
+  def setUp(self):
+    dir, _ = path.split(__file__)
+    self.load_data_path = path.join(dir, 'data', 'OK')
+
+    self.sites = pd.read_csv(path.join(self.load_data_path, 'sites.csv'), index_col='site_id')
+    self.actuals = pd.read_csv(path.join(self.load_data_path, 'actuals.csv'))
+    self.regions = pd.read_csv(path.join(self.load_data_path, 'regions.csv'), index_col='region_id')
+    self.regions['geometry'] = self.regions.apply(lambda row: wkt.loads(row.geometry), axis=1)
+
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.actuals_filespec = path.join(self.temp_dir.name, 'actuals.csv')
+    self.actuals.to_csv(self.actuals_filespec, index=False)
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def test_read_actuals_windows(self):
+    """
+    Test that actuals are read in windows of whole timestamps, and that split timestamps raise an assertion error
+    """
+    for window_size in [1, 20, 1000]:
+      with self.subTest(window_size=window_size):
+        windows = list(read_actuals_windows(self.actuals_filespec, window_size))
+        self.assertTrue(pd.concat(windows, ignore_index=True).equals(self.actuals))
+        if window_size < len(self.actuals.index):
+          self.assertGreater(len(windows), 1)
+        timestamps = [set(window['timestamp']) for window in windows]
+        self.assertEqual(sum(len(window_timestamps) for window_timestamps in timestamps),
+                         self.actuals['timestamp'].nunique())
+
+    self.actuals.sort_values('site_id').to_csv(self.actuals_filespec, index=False)
+    with self.assertRaises(AssertionError):
+      list(read_actuals_windows(self.actuals_filespec, 20))
+
+  def test_iter_window_estimations(self):
+    """
+    Test that estimating windows of actuals gives the estimations of all of the actuals, sharing the topology
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, backend='vectorized')
+    expected = estimator.get_estimations('NO2_mean', None, None)
+
+    windows = read_actuals_windows(self.actuals_filespec, 50)
+    result = pd.concat(list(iter_window_estimations(estimator, windows, 'NO2_mean')))
+    # Each window's estimations are in region then timestamp order
+    self.assertEqual(len(result.index), len(expected.index))
+    self.assertTrue(result.loc[expected.index].equals(expected))
+    self.assertIs(estimator.estimation_data, estimation_data)
+
+    window_data = estimation_data.with_actuals(self.actuals.iloc[:10])
+    self.assertIs(window_data.region_sites, estimation_data.region_sites)
+    self.assertEqual(len(window_data.actuals.index), 10)
+    self.assertEqual(len(estimation_data.actuals.index), len(self.actuals.index))
+    with self.assertRaises(AssertionError):
+      estimation_data.with_actuals(pd.DataFrame({'timestamp': ['2020-01-01'], 'site_id': ['xxx'], 'NO2_mean': [1]}))
+
+  def test_read_files(self):
+    """
+    Test reading csv files, with only the columns of the required measurements
+    """
+    self.assertEqual(get_file_format('actuals.csv'), 'csv')
+    self.assertEqual(get_file_format('actuals.PARQUET'), 'parquet')
+    self.assertEqual(get_file_format(self.temp_dir.name), 'parquet')
+    self.assertEqual(get_file_format('regions.feather'), 'feather')
+
+    actuals = read_actuals(self.actuals_filespec, 'NO2_mean')
+    self.assertEqual(list(actuals.columns), ['timestamp', 'site_id', 'NO2_mean'])
+    self.assertTrue(actuals.equals(self.actuals[['timestamp', 'site_id', 'NO2_mean']]))
+    self.assertTrue(read_actuals(self.actuals_filespec).equals(self.actuals))
+    window = next(read_actuals_windows(self.actuals_filespec, 20, ['NO2_mean']))
+    self.assertEqual(list(window.columns), ['timestamp', 'site_id', 'NO2_mean'])
+
+    regions = read_regions(path.join(self.load_data_path, 'regions.csv'))
+    self.assertTrue(regions.index.equals(self.regions.index))
+    self.assertTrue(all(geometry.equals(expected) for geometry, expected in zip(regions['geometry'],
+                                                                                self.regions['geometry'])))
+    self.assertTrue(read_sites(path.join(self.load_data_path, 'sites.csv')).equals(self.sites))
+
+    estimation_data = EstimationData.from_files(path.join(self.load_data_path, 'sites.csv'),
+                                                path.join(self.load_data_path, 'regions.csv'),
+                                                self.actuals_filespec, 'NO2_mean')
+    self.assertEqual(list(estimation_data.actuals.columns), ['timestamp', 'site_id', 'NO2_mean'])
+
+  def test_get_regions_geodataframe(self):
+    """
+    Test parsing region geometries from wkt, wkb and hex wkb, and simplifying them, without changing the input
+    """
+    df_regions = pd.read_csv(path.join(self.load_data_path, 'regions.csv'), index_col='region_id')
+    wkt_geometry = df_regions['geometry'].copy()
+    geometry = get_regions_geodataframe(df_regions)['geometry']
+    self.assertTrue(df_regions['geometry'].equals(wkt_geometry))
+    self.assertTrue(all(geometry.geom_equals(gpd.GeoSeries(self.regions['geometry']))))
+
+    for name, values in [('wkb', geometry.to_wkb()), ('hex wkb', geometry.to_wkb(hex=True)),
+                         ('geometries', self.regions['geometry'])]:
+      with self.subTest(format=name):
+        df_regions['geometry'] = values.values
+        result = get_regions_geodataframe(df_regions)
+        self.assertTrue(result.index.equals(self.regions.index))
+        self.assertTrue(all(result['geometry'].geom_equals(geometry)))
+
+    simplified = get_regions_geodataframe(df_regions, simplify_tolerance=0.01)['geometry']
+    self.assertTrue(all(simplified.is_valid))
+    self.assertLessEqual(shapely.get_num_coordinates(simplified.values.data).sum(),
+                         shapely.get_num_coordinates(geometry.values.data).sum())
+    # Topology preserving simplification keeps boundaries close to (but not strictly within) the tolerance
+    self.assertLess(simplified.hausdorff_distance(geometry).max(), 2 * 0.01)
+    with self.assertRaises(AssertionError):
+      get_regions_geodataframe(df_regions, simplify_tolerance=-1)
+
+    # An empty string is not hex wkb (so is reported as a wkt parsing error)
+    df_regions['geometry'] = [''] + wkt_geometry.tolist()[1:]
+    with self.assertRaisesRegex(shapely.errors.GEOSException, 'Expected word'):
+      get_regions_geodataframe(df_regions)
+
+  def test_write_estimations(self):
+    """
+    Test writing estimations to a csv file, appending windows
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, backend='vectorized')
+    expected = estimator.get_estimations('NO2_mean', None, None)
+    filespec = path.join(self.temp_dir.name, 'estimates.csv')
+    write_estimations(expected.iloc[:10], filespec)
+    write_estimations(expected.iloc[10:], filespec, append=True)
+    result = pd.read_csv(filespec, index_col=['measurement', 'region_id', 'timestamp'])
+    self.assertEqual(len(result.index), len(expected.index))
+    self.assertTrue(result['extra_data'].equals(expected['extra_data']))
+
+  @unittest.skipUnless(pyarrow, 'pyarrow is not installed')
+  def test_parquet_files(self):
+    """
+    Test reading parquet and feather files (GeoParquet regions), and writing partitioned parquet estimations
+    """
+    actuals_filespec = path.join(self.temp_dir.name, 'actuals.parquet')
+    self.actuals.to_parquet(actuals_filespec, index=False)
+    feather_filespec = path.join(self.temp_dir.name, 'actuals.feather')
+    self.actuals.to_feather(feather_filespec)
+    sites_filespec = path.join(self.temp_dir.name, 'sites.parquet')
+    self.sites.reset_index().to_parquet(sites_filespec, index=False)
+    regions_filespec = path.join(self.temp_dir.name, 'regions.parquet')
+    gpd.GeoDataFrame(self.regions, geometry='geometry').reset_index().to_parquet(regions_filespec)
+
+    expected = self.actuals[['timestamp', 'site_id', 'NO2_mean']]
+    for filespec in [actuals_filespec, feather_filespec]:
+      with self.subTest(filespec=filespec):
+        self.assertTrue(read_actuals(filespec, 'NO2_mean').equals(expected))
+        windows = list(read_actuals_windows(filespec, 20, 'NO2_mean'))
+        self.assertTrue(pd.concat(windows, ignore_index=True).equals(expected))
+
+    estimation_data = EstimationData.from_files(sites_filespec, regions_filespec, actuals_filespec, 'NO2_mean')
+    self.assertTrue(estimation_data.regions.index.equals(self.regions.index))
+    self.assertTrue(estimation_data.sites.index.equals(self.sites.index))
+
+    estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, backend='vectorized')
+    estimates = estimator.get_estimations('NO2_mean', None, None)
+    estimates_filespec = path.join(self.temp_dir.name, 'estimates.parquet')
+    write_estimations(estimates.iloc[:10], estimates_filespec)
+    write_estimations(estimates.iloc[10:], estimates_filespec, append=True)
+    self.assertTrue(path.isdir(path.join(estimates_filespec, 'measurement=NO2_mean')))
+    result = pd.read_parquet(estimates_filespec)
+    self.assertEqual(len(result.index), len(estimates.index))
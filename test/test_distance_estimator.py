@@ -2,6 +2,7 @@ import unittest
 from os import path
 from shapely import wkt
 import pandas as pd
+import json
 from region_estimators.estimation_data import EstimationData
 
 from region_estimators.distance_simple_estimator import DistanceSimpleEstimator
@@ -79,4 +80,177 @@ class TestRegionEdgeCases(unittest.TestCase):
     self.assertIsNotNone(estimator)
     self.assertIsNotNone(result)
     self.assertIsInstance(result, pd.DataFrame)
-    self.assertTrue(result.equals(self.results_ignore_sites))
\ No newline at end of file
+    self.assertTrue(result.equals(self.results_ignore_sites))
+
+  def test_vectorized(self):
+    """
+    Test that the vectorized DistanceSimpleEstimator engine gives the same results as the per-timestamp estimates
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = DistanceSimpleEstimator(estimation_data, verbose=0)
+
+    result = estimator.get_estimations('NO2_mean', None, '2019-10-15', backend='vectorized')
+    self.assertTrue(result.equals(self.results))
+
+    result = estimator.get_estimations('NO2_mean', None, '2019-10-15', ignore_site_ids=['Camden Kerbside [AQ]'],
+                                       backend='vectorized')
+    self.assertTrue(result.equals(self.results_ignore_sites))
+
+    result = estimator.get_estimations('NO2_mean', 'SW', None, backend='vectorized')
+    expected = estimator.get_estimations('NO2_mean', 'SW', None)
+    self.assertTrue(result.equals(expected))
+
+  def test_region_site_distances(self):
+    """
+    Test that the region to site distances are precomputed, with each region's sites ordered by distance
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    distances, orders = estimation_data.region_site_distances
+
+    self.assertEqual(distances.shape, (len(self.regions.index), len(self.sites.index)))
+    for position in range(len(self.regions.index)):
+      self.assertTrue((distances[position][orders[position]][1:] >= distances[position][orders[position]][:-1]).all())
+
+  def test_spatial_index(self):
+    """
+    Test that finding the closest sites with a spatial index (for large site networks) gives the same results
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = DistanceSimpleEstimator(estimation_data, verbose=0)
+    self.assertFalse(estimator.uses_spatial_index)
+    # More timestamps x sites readings than regions x sites distances
+    estimator.max_distance_matrix_size = len(self.regions.index) * len(self.sites.index)
+    self.assertTrue(estimator.uses_spatial_index)
+    estimator.max_distance_matrix_size = len(estimation_data.timestamps) * len(self.sites.index)
+    self.assertFalse(estimator.uses_spatial_index)
+    estimator.max_distance_matrix_size = 0
+    self.assertTrue(estimator.uses_spatial_index)
+
+    result = estimator.get_estimations('NO2_mean', None, '2019-10-15')
+    self.assertTrue(result.equals(self.results))
+
+    result = estimator.get_estimations('NO2_mean', None, '2019-10-15', ignore_site_ids=['Camden Kerbside [AQ]'],
+                                       backend='vectorized')
+    self.assertTrue(result.equals(self.results_ignore_sites))
+
+    with self.assertRaises(AssertionError):
+      estimator.max_distance_matrix_size = -1
+
+  def test_extra_data_columns(self):
+    """
+    Test that the closest sites can be returned as a column instead of json strings
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = DistanceSimpleEstimator(estimation_data, verbose=0)
+    expected_sites = [json.loads(extra_data).get('closest_sites') for extra_data in self.results['extra_data']]
+
+    for backend in ['serial', 'vectorized']:
+      with self.subTest(backend=backend):
+        result = estimator.get_estimations('NO2_mean', None, '2019-10-15', backend=backend, json_extra_data=False)
+        self.assertEqual(list(result.columns), ['value', 'closest_sites'])
+        self.assertTrue(result['value'].equals(self.results['value']))
+        self.assertEqual(list(result['closest_sites']), expected_sites)
+
+  def test_numeric_site_names(self):
+    """
+    Test that numeric site names are returned as (json serializable) python numbers
+    """
+    sites = self.sites.assign(name=range(len(self.sites.index)))
+    names = dict(zip(self.sites.index, sites['name']))
+    estimation_data = EstimationData(sites, self.regions, self.actuals)
+    estimator = DistanceSimpleEstimator(estimation_data, verbose=0)
+
+    for max_size in [DistanceSimpleEstimator.MAX_DISTANCE_MATRIX_SIZE_DEFAULT, 0]:
+      for backend in ['serial', 'vectorized']:
+        with self.subTest(max_distance_matrix_size=max_size, backend=backend):
+          estimator.max_distance_matrix_size = max_size
+          result = estimator.get_estimations('NO2_mean', None, '2019-10-15', backend=backend)
+          self.assertTrue(result['value'].equals(self.results['value']))
+          for extra_data, expected_extra_data in zip(result['extra_data'], self.results['extra_data']):
+            expected_sites = json.loads(expected_extra_data).get('closest_sites')
+            self.assertEqual(json.loads(extra_data).get('closest_sites'),
+                             None if expected_sites is None else [names[site_id] for site_id in expected_sites])
+
+  def test_leave_one_out(self):
+    """
+    Test that leave-one-out estimates are those of the site's regions with the site ignored
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = DistanceSimpleEstimator(estimation_data, verbose=0)
+
+    for max_size in [DistanceSimpleEstimator.MAX_DISTANCE_MATRIX_SIZE_DEFAULT, 0]:
+      with self.subTest(max_distance_matrix_size=max_size):
+        estimator.max_distance_matrix_size = max_size
+        result = estimator.get_leave_one_out_estimates('NO2_mean', timestamp='2019-10-15')
+        self.assertGreater(len(result.index), 0)
+        for (site_id, region_id, timestamp), row in result.iterrows():
+          expected = estimator.get_estimations('NO2_mean', region_id, timestamp, ignore_site_ids=[site_id])
+          self.assertAlmostEqual(row['estimate'], expected['value'].iloc[0])
+
+  def test_multiple_measurements(self):
+    """
+    Test that estimating a list of measurements together gives the results of each measurement, in measurement order
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    estimator = DistanceSimpleEstimator(estimation_data, verbose=0)
+    measurements = ['NO2_mean', 'Made_up_mean', 'Made_up_max']
+    expected = pd.concat([estimator.get_estimations(measurement, None, None) for measurement in measurements])
+
+    for backend in ['serial', 'vectorized']:
+      with self.subTest(backend=backend):
+        result = estimator.get_estimations(measurements, None, None, backend=backend)
+        self.assertTrue(result.equals(expected))
+
+    with self.subTest(backend='vectorized', max_distance_matrix_size=0):
+      estimator.max_distance_matrix_size = 0
+      result = estimator.get_estimations(measurements, None, None, backend='vectorized')
+      self.assertTrue(result.equals(expected))
+
+  def test_update_estimations(self):
+    """
+    Test that updating estimations with late readings (at existing and new timestamps) gives the estimations of all
+    of the readings, re-estimating only the regions that the readings can affect
+    """
+    late = self.actuals.loc[((self.actuals['timestamp'] == '2019-10-15') &
+                             (self.actuals['site_id'] == 'Camden Kerbside [AQ]')) |
+                            (self.actuals['timestamp'] == '2019-12-31')]
+
+    for max_size in [DistanceSimpleEstimator.MAX_DISTANCE_MATRIX_SIZE_DEFAULT, 0]:
+      with self.subTest(max_distance_matrix_size=max_size):
+        estimation_data = EstimationData(self.sites.copy(), self.regions.copy(), self.actuals.drop(late.index))
+        estimator = DistanceSimpleEstimator(estimation_data, verbose=0, backend='vectorized')
+        estimator.max_distance_matrix_size = max_size
+        previous = estimator.get_estimations('NO2_mean', None, None)
+        estimation_data.append_actuals(late)
+
+        result = estimator.update_estimations(previous, late)
+        self.assertTrue(result.equals(estimator.get_estimations('NO2_mean', None, None)))
+
+        site_positions = estimation_data.get_site_positions(['Camden Kerbside [AQ]'])
+        affected = estimator._get_affected_regions('NO2_mean', '2019-10-15', site_positions)
+        self.assertTrue(0 < affected.sum() < len(self.regions.index))
+
+  def test_update_estimations_replace(self):
+    """
+    Test that updating estimations with corrected readings (replacing the existing readings) gives the estimations of
+    a full recalculation with the corrected readings
+    """
+    corrected_rows = (self.actuals['timestamp'] == '2019-10-15') & \
+                     (self.actuals['site_id'] == 'Camden Kerbside [AQ]')
+    corrected = self.actuals.loc[corrected_rows].assign(NO2_mean=lambda df: df['NO2_mean'] + 1000)
+    expected_actuals = self.actuals.copy()
+    expected_actuals.loc[corrected_rows, 'NO2_mean'] += 1000
+
+    for max_size in [DistanceSimpleEstimator.MAX_DISTANCE_MATRIX_SIZE_DEFAULT, 0]:
+      with self.subTest(max_distance_matrix_size=max_size):
+        expected = DistanceSimpleEstimator(EstimationData(self.sites.copy(), self.regions.copy(), expected_actuals),
+                                           verbose=0).get_estimations('NO2_mean', None, None)
+        estimation_data = EstimationData(self.sites.copy(), self.regions.copy(), self.actuals)
+        estimator = DistanceSimpleEstimator(estimation_data, verbose=0, backend='vectorized')
+        estimator.max_distance_matrix_size = max_size
+        previous = estimator.get_estimations('NO2_mean', None, None)
+        estimation_data.append_actuals(corrected, replace=True)
+
+        result = estimator.update_estimations(previous, corrected)
+        self.assertTrue(result.equals(expected))
+        self.assertFalse(result.equals(previous))
@@ -1,7 +1,10 @@
 import unittest
+import tempfile
+import os
 from os import path
 from shapely import wkt
 import pandas as pd
+import numpy as np
 
 from region_estimators.region_estimator import RegionEstimator
 from region_estimators.concentric_regions_estimator import ConcentricRegionsEstimator
@@ -41,3 +44,281 @@ class TestEstimationData(unittest.TestCase):
 
     self.assertEqual(estimation_data.site_datapoint_count('urtica', '2018-03-14', ignore_site_ids=None), 2)
     self.assertEqual(estimation_data.site_datapoint_count('urtica', '3318-03-14', ignore_site_ids=None), 0)
+
+    # Sites are counted once, however many readings they have
+    readings = self.actuals.loc[(self.actuals['timestamp'] == '2017-06-17') & self.actuals['urtica'].notna()]
+    region_count = estimation_data.site_datapoint_count('urtica', '2017-06-17', region_ids=['DG'])
+    estimation_data.append_actuals(readings)
+    self.assertEqual(estimation_data.site_datapoint_count('urtica', '2017-06-17'), readings['site_id'].nunique())
+    self.assertEqual(estimation_data.site_datapoint_count('urtica', '2017-06-17', region_ids=['DG']), region_count)
+    with self.assertRaises(AssertionError):
+      estimation_data.site_datapoint_count('urtica', '2017-06-17', region_ids=['not a region'])
+
+  def test_region_neighbours(self):
+    """
+    Test that region neighbours are held as CSR arrays of region positions, consistent with get_adjacent_regions.
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    indptr, indices = estimation_data.region_neighbours
+    region_ids = estimation_data.regions.index.tolist()
+
+    self.assertEqual(len(indptr), len(region_ids) + 1)
+    for position, region_id in enumerate(region_ids):
+      self.assertEqual([region_ids[i] for i in indices[indptr[position]:indptr[position + 1]]],
+                       estimation_data.get_adjacent_regions([region_id]))
+
+  def test_region_aggregates(self):
+    """
+    Test that the aggregate cube gives the same sums and counts as filtering the actuals, for region sets and
+    timestamp ranges
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    actuals = estimation_data.actuals
+
+    result = estimation_data.get_region_aggregates('urtica', start_timestamp='2017-06-12', end_timestamp='2017-06-17')
+    expected = actuals.loc[(actuals['timestamp'] >= '2017-06-12') & (actuals['timestamp'] <= '2017-06-17')] \
+      .groupby('timestamp')['urtica'].agg(['sum', 'count'])
+    self.assertEqual(result.index.tolist(), expected.index.tolist())
+    self.assertEqual(result['sum'].tolist(), expected['sum'].tolist())
+    self.assertEqual(result['count'].tolist(), expected['count'].tolist())
+
+    region_sites = estimation_data.get_regions_sites(['DG', 'AB'])
+    result = estimation_data.get_region_aggregates('urtica', ['DG', 'AB'], ignore_site_ids=['1023 [WEATHER]'])
+    expected = actuals.loc[actuals['site_id'].isin(region_sites) & (actuals['site_id'] != '1023 [WEATHER]')] \
+      .groupby('timestamp')['urtica'].agg(['sum', 'count'])
+    self.assertEqual(result.loc[expected.index, 'sum'].tolist(), expected['sum'].tolist())
+    self.assertEqual(result.loc[expected.index, 'count'].tolist(), expected['count'].tolist())
+    self.assertEqual(result['count'].sum(), expected['count'].sum())
+
+    self.assertEqual(estimation_data.site_datapoint_count('urtica', '2017-06-17', region_ids=['DG']), 1)
+
+  def test_timestamp_index(self):
+    """
+    Test that the actuals are stored in timestamp order (with timestamps in chronological order), with each
+    timestamp's readings a block of rows, whatever the order of the given actuals
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    shuffled_data = EstimationData(self.sites, self.regions, self.actuals.sample(frac=1, random_state=1))
+
+    for data in [estimation_data, shuffled_data]:
+      self.assertEqual(data.timestamps.tolist(), sorted(self.actuals['timestamp'].unique()))
+      self.assertEqual(data.timestamp_values.tolist(), pd.to_datetime(data.timestamps).tolist())
+      indptr, indices = data.timestamp_sites
+      for position, timestamp in enumerate(data.timestamps):
+        rows = data.actuals.iloc[indptr[position]:indptr[position + 1]]
+        self.assertTrue((rows['timestamp'] == timestamp).all())
+        self.assertEqual(data.sites.index[indices[indptr[position]:indptr[position + 1]]].tolist(),
+                         rows['site_id'].tolist())
+
+        site_positions, sums, counts = data.get_timestamp_site_readings('urtica', timestamp, ['1023 [WEATHER]'])
+        expected = rows.loc[rows['urtica'].notna() & (rows['site_id'] != '1023 [WEATHER]')]
+        self.assertEqual(sorted(data.sites.index[site_positions]), sorted(expected['site_id']))
+        self.assertEqual(sums.sum(), expected['urtica'].sum())
+        self.assertEqual(counts.sum(), len(expected.index))
+
+    for measurement in ['urtica', 'made_up_1']:
+      for data in [estimation_data, shuffled_data]:
+        sums, counts = data.get_group_aggregates(measurement)
+        expected_sums, expected_counts = estimation_data.get_group_aggregates(measurement)
+        self.assertTrue(np.allclose(sums, expected_sums))
+        self.assertTrue((counts == expected_counts).all())
+
+    # Timestamps that are not dates are sorted alphabetically
+    actuals = self.actuals.copy()
+    actuals['timestamp'] = 'day ' + actuals['timestamp']
+    estimation_data = EstimationData(self.sites, self.regions, actuals)
+    self.assertEqual(estimation_data.timestamps.tolist(), sorted(actuals['timestamp'].unique()))
+    self.assertIsNone(estimation_data.timestamp_values)
+
+  def test_id_table(self):
+    """
+    Test that site and region IDs translate to and from positions, and that the site/region lookups (from the
+    integer arrays) agree with the 'sites' and 'region_id' columns
+    """
+    estimation_data = EstimationData(self.sites, self.regions, self.actuals)
+    site_ids = estimation_data.site_ids.tolist()
+    region_ids = estimation_data.region_ids.tolist()
+
+    self.assertEqual(estimation_data.get_site_positions(site_ids).tolist(), list(range(len(site_ids))))
+    self.assertEqual(estimation_data.get_region_positions(region_ids + ['XX']).tolist(),
+                     list(range(len(region_ids))) + [-1])
+
+    for region_id in region_ids:
+      self.assertEqual(estimation_data.get_region_sites(region_id),
+                       [site for site in estimation_data.regions.loc[region_id, 'sites'].split(',') if site])
+    for site_id in site_ids:
+      self.assertEqual(estimation_data.get_region_id(site_id), estimation_data.sites.loc[site_id, 'region_id'])
+
+    expected = set(estimation_data.get_region_sites('DG')) | set(estimation_data.get_region_sites('AB'))
+    self.assertEqual(set(estimation_data.get_regions_sites(['DG', 'AB'])), expected)
+    self.assertEqual(set(estimation_data.get_regions_sites(['DG', 'AB'], ['1023 [WEATHER]'])),
+                     expected - {'1023 [WEATHER]'})
+    with self.assertRaises(AssertionError):
+      estimation_data.get_regions_sites(['DG', 'WC'])
+
+  def test_topology_cache(self):
+    """
+    Test that topology is saved to and reloaded from the cache directory, and recalculated when the geometries change
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+      estimation_data = EstimationData(self.sites.copy(), self.regions.copy(), self.actuals, cache_dir=cache_dir)
+      estimation_data.region_neighbours
+      estimation_data.region_site_distances
+      cache_files = sorted(os.listdir(cache_dir))
+      self.assertEqual([name.split('_')[0] for name in cache_files], ['region', 'region', 'site'])
+
+      cached_data = EstimationData(self.sites.copy(), self.regions.copy(), self.actuals, cache_dir=cache_dir)
+      for name in ['region_sites', 'region_neighbours', 'region_site_distances']:
+        for cached, calculated in zip(getattr(cached_data, name), getattr(estimation_data, name)):
+          self.assertTrue(np.array_equal(cached, calculated))
+      self.assertEqual(cached_data.get_region_sites('DG'), estimation_data.get_region_sites('DG'))
+      self.assertTrue(cached_data.sites['region_id'].equals(estimation_data.sites['region_id']))
+      self.assertEqual(sorted(os.listdir(cache_dir)), cache_files)
+
+      # Moving a site changes the site topology, but not the region neighbours
+      sites = self.sites.copy()
+      sites.iloc[0, sites.columns.get_loc('latitude')] += 1
+      moved_data = EstimationData(sites, self.regions.copy(), self.actuals, cache_dir=cache_dir)
+      moved_data.region_neighbours
+      self.assertEqual(len(os.listdir(cache_dir)), len(cache_files) + 1)
+
+  def test_append_actuals(self):
+    """
+    Test that appending actuals (to cached aggregates, with new and back-filled timestamps) gives the same data as
+    constructing EstimationData with all of the actuals
+    """
+    actuals = self.actuals.sample(frac=1, random_state=2)
+    first, second, third = actuals.iloc[:100], actuals.iloc[100:200], actuals.iloc[200:]
+    expected = EstimationData(self.sites.copy(), self.regions.copy(), actuals)
+
+    estimation_data = EstimationData(self.sites.copy(), self.regions.copy(), first)
+    estimation_data.get_group_aggregates('urtica')
+    estimation_data.get_site_aggregates('made_up_1')
+    estimation_data.append_actuals(second)
+    estimation_data.append_actuals(third.drop(columns=['made_up_2']))
+    self.assertEqual(estimation_data.version, 2)
+
+    self.assertEqual(estimation_data.timestamps.tolist(), expected.timestamps.tolist())
+    self.assertTrue(estimation_data.timestamp_values.equals(expected.timestamp_values))
+    self.assertEqual(len(estimation_data.actuals.index), len(actuals.index))
+    self.assertEqual(estimation_data.actuals['made_up_2'].notna().sum(), second['made_up_2'].notna().sum() +
+                     first['made_up_2'].notna().sum())
+    self.assertEqual(estimation_data.site_ranks.tolist(), expected.site_ranks.tolist())
+    for measurement, get_aggregates in [('urtica', 'get_group_aggregates'), ('made_up_1', 'get_site_aggregates'),
+                                        ('made_up_1', 'get_group_aggregates')]:
+      sums, counts = getattr(estimation_data, get_aggregates)(measurement)
+      expected_sums, expected_counts = getattr(expected, get_aggregates)(measurement)
+      self.assertTrue(np.allclose(sums, expected_sums))
+      self.assertTrue((counts == expected_counts).all())
+    for timestamp in expected.timestamps[::10]:
+      for readings, expected_readings in zip(estimation_data.get_timestamp_site_readings('urtica', timestamp),
+                                             expected.get_timestamp_site_readings('urtica', timestamp)):
+        self.assertTrue(np.allclose(readings, expected_readings))
+
+    with self.assertRaises(AssertionError):
+      estimation_data.append_actuals(pd.DataFrame({'timestamp': ['2020-01-01'], 'site_id': ['xxx'], 'urtica': [1]}))
+    with self.assertRaises(AssertionError):
+      estimation_data.append_actuals(pd.DataFrame({'timestamp': ['2020-01-01'], 'site_id': ['1023 [POLLEN]'],
+                                                   'urtica': ['abc']}))
+    with self.assertRaises(AssertionError):
+      estimation_data.append_actuals(pd.DataFrame({'timestamp': ['2020-01-01'], 'site_id': ['1023 [POLLEN]'],
+                                                   'new_measurement': [1]}))
+    self.assertEqual(estimation_data.version, 2)
+
+  def test_append_actuals_replace(self):
+    """
+    Test that appending corrected actuals with replace gives the same data as constructing EstimationData with the
+    corrected actuals in place of the existing ones
+    """
+    corrected = self.actuals.iloc[::7].assign(urtica=lambda df: df['urtica'] + 100)
+    expected_actuals = self.actuals.copy()
+    expected_actuals.loc[corrected.index, 'urtica'] = corrected['urtica']
+    expected = EstimationData(self.sites.copy(), self.regions.copy(), expected_actuals)
+
+    estimation_data = EstimationData(self.sites.copy(), self.regions.copy(), self.actuals)
+    estimation_data.get_group_aggregates('urtica')
+    estimation_data.get_site_aggregates('made_up_1')
+    estimation_data.append_actuals(corrected, replace=True)
+    self.assertEqual(len(estimation_data.actuals.index), len(self.actuals.index))
+    for measurement, get_aggregates in [('urtica', 'get_group_aggregates'), ('made_up_1', 'get_site_aggregates'),
+                                        ('urtica', 'get_site_aggregates')]:
+      sums, counts = getattr(estimation_data, get_aggregates)(measurement)
+      expected_sums, expected_counts = getattr(expected, get_aggregates)(measurement)
+      self.assertTrue(np.allclose(sums, expected_sums))
+      self.assertTrue((counts == expected_counts).all())
+
+  def test_inputs_unchanged(self):
+    """
+    Test that construction leaves the given dataframes unchanged, uses checked actuals without copying them, and
+    that trusted data gives the same estimation data
+    """
+    sites, regions = self.sites.copy(), self.regions.copy()
+    sites.index = pd.Index(range(len(sites.index)), name='site_id')
+    actuals = self.actuals[['urtica', 'site_id', 'made_up_1', 'timestamp']].copy()
+    actuals['site_id'] = sites.index.get_indexer(actuals['site_id'].map(dict(zip(self.sites.index, sites.index))))
+    actuals['urtica'] = actuals['urtica'].astype(object)
+    expected_sites, expected_actuals = sites.copy(), actuals.copy()
+
+    estimation_data = EstimationData(sites, regions, actuals)
+    self.assertTrue(sites.equals(expected_sites))
+    self.assertTrue(sites.index.equals(expected_sites.index))
+    self.assertTrue(actuals.equals(expected_actuals))
+    self.assertEqual(estimation_data.site_ids.tolist(), [str(i) for i in range(len(sites.index))])
+    self.assertEqual(list(estimation_data.actuals.columns), ['timestamp', 'site_id', 'urtica', 'made_up_1'])
+    self.assertTrue(pd.api.types.is_float_dtype(estimation_data.actuals['urtica']))
+
+    # Checked actuals, already sorted by timestamp, are used as they are
+    sorted_actuals = estimation_data.actuals
+    trusted_data = EstimationData(sites, regions, sorted_actuals, trusted=True)
+    self.assertIs(trusted_data.actuals, sorted_actuals)
+    self.assertIs(estimation_data.with_actuals(sorted_actuals, trusted=True).actuals, sorted_actuals)
+    for measurement in ['urtica', 'made_up_1']:
+      sums, counts = trusted_data.get_group_aggregates(measurement)
+      expected_sums, expected_counts = estimation_data.get_group_aggregates(measurement)
+      self.assertTrue(np.array_equal(sums, expected_sums, equal_nan=True))
+      self.assertTrue((counts == expected_counts).all())
+
+    with self.assertRaises(AssertionError):
+      EstimationData(self.sites, self.regions, self.actuals.assign(urtica='abc'))
+    with self.assertRaises(AssertionError):
+      EstimationData(self.sites.assign(latitude='abc'), self.regions, self.actuals)
+
+  def test_compact(self):
+    """
+    Test that compact actuals (float32 values, categorical site IDs and timestamps) give the same aggregates and
+    estimations as uncompacted actuals, to float32 precision, also after appending actuals
+    """
+    actuals = self.actuals.sample(frac=1, random_state=3)
+    expected = EstimationData(self.sites.copy(), self.regions.copy(), actuals)
+    estimation_data = EstimationData(self.sites.copy(), self.regions.copy(), actuals, compact=True)
+    self.assertTrue(estimation_data.compact)
+    self.assertEqual(estimation_data.actuals['urtica'].dtype, np.float32)
+    self.assertEqual(estimation_data.actuals['site_id'].cat.categories.tolist(), expected.site_ids.tolist())
+    self.assertEqual(estimation_data.actuals['timestamp'].cat.categories.tolist(), expected.timestamps.tolist())
+    self.assertEqual(estimation_data.actuals['timestamp'].astype(str).tolist(),
+                     expected.actuals['timestamp'].tolist())
+    self.assertEqual(estimation_data.site_ranks.tolist(), expected.site_ranks.tolist())
+
+    appended = EstimationData(self.sites.copy(), self.regions.copy(), actuals.iloc[:150], compact=True)
+    appended.get_group_aggregates('made_up_1')
+    appended.append_actuals(actuals.iloc[150:])
+    self.assertEqual(appended.timestamps.tolist(), expected.timestamps.tolist())
+    self.assertEqual(appended.actuals['timestamp'].cat.categories.tolist(), expected.timestamps.tolist())
+    for data in [estimation_data, appended]:
+      for measurement in ['urtica', 'made_up_1']:
+        sums, counts = data.get_group_aggregates(measurement)
+        expected_sums, expected_counts = expected.get_group_aggregates(measurement)
+        self.assertTrue(np.allclose(sums, expected_sums, rtol=1e-6))
+        self.assertTrue((counts == expected_counts).all())
+
+    for estimator_class in [ConcentricRegionsEstimator, DistanceSimpleEstimator]:
+      with self.subTest(estimator=estimator_class.__name__):
+        result = estimator_class(estimation_data).get_estimations('urtica', None, None)
+        expected_result = estimator_class(expected).get_estimations('urtica', None, None)
+        self.assertTrue(result.index.equals(expected_result.index))
+        self.assertTrue(result['extra_data'].equals(expected_result['extra_data']))
+        self.assertTrue(np.allclose(result['value'], expected_result['value'], rtol=1e-6, equal_nan=True))
+
+    window_data = estimation_data.with_actuals(estimation_data.actuals.iloc[:100])
+    self.assertEqual(window_data.actuals['urtica'].dtype, np.float32)
+    self.assertEqual(window_data.actuals['timestamp'].cat.categories.tolist(), window_data.timestamps.tolist())
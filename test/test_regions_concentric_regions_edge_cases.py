@@ -125,6 +125,38 @@ class TestRegionEdgeCases(unittest.TestCase):
     self.assertIsInstance(result, pd.DataFrame)
     self.assertTrue(result.equals(self.results_islands))
 
+  def test_update_estimations_no_other_readings(self):
+    """
+    Test that updating estimations at a timestamp where only the changed sites have readings re-estimates every
+    region, including those that cannot reach the sites (which have no ring when there are no readings at all)
+    """
+    actuals = self.actuals_islands.copy()
+    actuals.loc[actuals['timestamp'] == '2019-10-15', 'NO2_mean'] = np.NaN
+    corrected = self.actuals_islands.loc[(self.actuals_islands['timestamp'] == '2019-10-15') &
+                                         (self.actuals_islands['site_id'] == 'Northern Ireland [FAKE]')]
+    expected_actuals = actuals.copy()
+    expected_actuals.loc[corrected.index, 'NO2_mean'] = corrected['NO2_mean']
+
+    for backend in ['serial', 'vectorized']:
+      with self.subTest(backend=backend):
+        estimation_data = EstimationData(self.sites_islands.copy(), self.regions_islands.copy(), actuals)
+        estimator = ConcentricRegionsEstimator(estimation_data, verbose=0, backend=backend)
+        previous = estimator.get_estimations('NO2_mean', None, None)
+
+        # From no readings to a reading
+        estimation_data.append_actuals(corrected, replace=True)
+        result = estimator.update_estimations(previous, corrected)
+        expected = ConcentricRegionsEstimator(
+          EstimationData(self.sites_islands.copy(), self.regions_islands.copy(), expected_actuals),
+          verbose=0).get_estimations('NO2_mean', None, None)
+        self.assertTrue(result.equals(expected))
+        self.assertFalse(result.equals(previous))
+
+        # And back to no readings
+        removed = corrected.assign(NO2_mean=np.NaN)
+        estimation_data.append_actuals(removed, replace=True)
+        self.assertTrue(estimator.update_estimations(result, removed).equals(previous))
+
   def test_non_touching(self):
     """
     Test that a ConcentricRegionsEstimator object can be initialized with region data containing regions that are
@@ -183,3 +215,25 @@ class TestRegionEdgeCases(unittest.TestCase):
     self.assertIsNotNone(result)
     self.assertIsInstance(result, pd.DataFrame)
     self.assertTrue(result.fillna(np.NaN).equals(self.results_empty_measurements))
+
+  def test_vectorized(self):
+    """
+    Test that the vectorized ConcentricRegionsEstimator engine gives the expected results for the edge cases
+    """
+    cases = {
+      'islands': (self.sites_islands, self.regions_islands, self.actuals_islands, self.results_islands, 'NO2_mean',
+                  '2019-10-15'),
+      'non_touching': (self.sites_non_touching, self.regions_non_touching, self.actuals_non_touching,
+                       self.results_non_touching, 'NO2_mean', '2019-10-15'),
+      'overlap': (self.sites_overlap, self.regions_overlap, self.actuals_overlap, self.results_overlap, 'NO2_mean',
+                  '2019-10-15'),
+      'empty_measurements': (self.sites_empty_measurements, self.regions_empty_measurements,
+                             self.actuals_empty_measurements, self.results_empty_measurements, 'alnus', '2017-06-15')
+    }
+
+    for case, (sites, regions, actuals, expected, measurement, timestamp) in cases.items():
+      with self.subTest(case=case):
+        estimation_data = EstimationData(sites, regions, actuals)
+        estimator = ConcentricRegionsEstimator(estimation_data, verbose=0)
+        result = estimator.get_estimations(measurement, None, timestamp, backend='vectorized').fillna(value=np.NaN)
+        self.assertTrue(result.equals(expected))
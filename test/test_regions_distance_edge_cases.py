@@ -139,3 +139,40 @@ class TestRegionEdgeCases(unittest.TestCase):
     self.assertIsNotNone(result)
     self.assertIsInstance(result, pd.DataFrame)
     self.assertTrue(result.equals(self.results_overlap))
+
+  def test_vectorized(self):
+    """
+    Test that the vectorized DistanceSimpleEstimator engine gives the expected results for the edge cases
+    """
+    cases = {
+      'islands': (self.sites_islands, self.regions_islands, self.actuals_islands, self.results_islands),
+      'non_touching': (self.sites_non_touching, self.regions_non_touching, self.actuals_non_touching,
+                       self.results_non_touching),
+      'overlap': (self.sites_overlap, self.regions_overlap, self.actuals_overlap, self.results_overlap)
+    }
+
+    for case, (sites, regions, actuals, expected) in cases.items():
+      with self.subTest(case=case):
+        estimation_data = EstimationData(sites, regions, actuals)
+        estimator = DistanceSimpleEstimator(estimation_data, verbose=0)
+        result = estimator.get_estimations('NO2_mean', None, '2019-10-15', backend='vectorized')
+        self.assertTrue(result.equals(expected))
+
+  def test_spatial_index(self):
+    """
+    Test that the spatial index search for the closest sites gives the expected results for the edge cases
+    """
+    cases = {
+      'islands': (self.sites_islands, self.regions_islands, self.actuals_islands, self.results_islands),
+      'non_touching': (self.sites_non_touching, self.regions_non_touching, self.actuals_non_touching,
+                       self.results_non_touching),
+      'overlap': (self.sites_overlap, self.regions_overlap, self.actuals_overlap, self.results_overlap)
+    }
+
+    for case, (sites, regions, actuals, expected) in cases.items():
+      with self.subTest(case=case):
+        estimation_data = EstimationData(sites, regions, actuals)
+        estimator = DistanceSimpleEstimator(estimation_data, verbose=0)
+        estimator.max_distance_matrix_size = 0
+        result = estimator.get_estimations('NO2_mean', None, '2019-10-15')
+        self.assertTrue(result.equals(expected))